@@ -31,10 +31,8 @@ setup(
     zip_safe=False,
     install_requires=[
         'paramiko',
-        'transitions',
         'paramiko-expect',
         # 'git+https://github.com/fgimian/paramiko-expect.git',
-        # 'git+https://github.com/tyarkoni/transitions.git'
     ],
     dependency_links=[
         'http://github.com/fgimian/paramiko-expect/tarball/master#egg=paramiko-expect',
@@ -48,7 +46,8 @@ setup(
         'Programming Language :: Python',
         'Programming Language :: Python :: 2.7',
     ),
-    scripts=[os.path.join('wiper', 'wiper.py')],
+    scripts=[os.path.join('wiper', 'wiper.py'), os.path.join('wiper', 'wiperd.py'),
+             os.path.join('wiper', 'worker.py')],
     entry_points={
         "console_scripts": [
             "apic_wiper=wiper:main",
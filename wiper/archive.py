@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+
+# wiper - the APIC provisioner
+#
+# Copyright (C) 2015 Cisco Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+"""
+A compressed console archive per APIC, with an index to jump straight to any state or prompt.
+
+With --archive everything sent to and received from the consoles of an APIC is written to
+<directory>/<cimc>.transcript.gz, as the JSON lines of a transcript (see transcript.py) with a mark
+line wherever a state was entered or a prompt was matched.  The file is a series of gzip members:
+a new member is started with every state and once a member holds BLOCK_SIZE bytes, so zcat reads
+the whole file and a reader can start decompressing at the start of any member.
+<directory>/<cimc>.transcript.idx has a JSON line for every mark with the offset of the member it
+is in and how far into that member it is, so one exchange is found without decompressing the rest:
+
+    python archive.py archive/10.0.0.17.transcript.gz --list
+    python archive.py archive/10.0.0.17.transcript.gz --state provide_oob_address
+
+The provisioning threads only put what they send and receive on a queue, compressing and writing is
+done by one thread for every APIC of the process, at the fastest compression level.
+"""
+
+# Standard Library imports
+from argparse import ArgumentParser
+import atexit
+import json
+import os
+import Queue
+import sys
+import threading
+import time
+import zlib
+
+# Local imports
+from transcript import RECORDED_OPTIONS, SECRET_OPTIONS, mask
+
+ARCHIVE_SUFFIX = '.transcript.gz'
+INDEX_SUFFIX = '.transcript.idx'
+# The uncompressed size at which a new gzip member is started, the most a reader decompresses to
+# get to a prompt
+BLOCK_SIZE = 256 * 1024
+COMPRESS_LEVEL = 1
+# How often the archives are flushed while the consoles are active, an archive is complete once
+# its node is done
+FLUSH_SECONDS = 5
+READ_SIZE = 64 * 1024
+
+
+class ArchiveNode(object):
+    """ The archive of one APIC, passed to RecordingChannel like a TranscriptWriter. """
+    def __init__(self, writer, node, clock=time):
+        self.writer = writer
+        self.node = node
+        self.clock = clock
+        self.started = clock.time()
+        self.path = os.path.join(writer.directory, node + ARCHIVE_SUFFIX)
+
+    def record(self, conn_type, direction, data):
+        self.writer.queue.put((self.node, 'record', round(self.clock.time() - self.started, 3),
+                               (conn_type, direction, data)))
+
+    def mark(self, kind, name, conn_type=None):
+        """ Index a state that was entered or a prompt that was matched on conn_type. """
+        self.writer.queue.put((self.node, 'mark', round(self.clock.time() - self.started, 3),
+                               (kind, name, conn_type)))
+
+    def close(self):
+        self.writer.queue.put((self.node, 'close', None, None))
+
+
+class _NodeArchive(object):
+    """ The files of one APIC, only used by the writer thread. """
+    def __init__(self, directory, node):
+        path = os.path.join(directory, node)
+        # Every run of the APIC is added to its archive, the erase and configure waves included
+        self.archive_file = open(path + ARCHIVE_SUFFIX, 'ab')
+        self.archive_file.seek(0, os.SEEK_END)
+        self.index_file = open(path + INDEX_SUFFIX, 'a')
+        self.secrets = ()
+        self.compressor = None
+        self.block = 0
+        self.block_bytes = 0
+        # Where the last output read on each console starts, prompts are indexed from there
+        self.last_recv = {}
+
+    def write(self, event, new_block=False):
+        if self.compressor is not None and (new_block or self.block_bytes >= BLOCK_SIZE):
+            self.archive_file.write(self.compressor.flush())
+            self.compressor = None
+        if self.compressor is None:
+            self.block = self.archive_file.tell()
+            self.block_bytes = 0
+            # A gzip member of its own, zcat reads the members one after the other
+            self.compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        position = (self.block, self.block_bytes)
+        line = json.dumps(event) + '\n'
+        self.archive_file.write(self.compressor.compress(line))
+        self.block_bytes += len(line)
+        return position
+
+    def index(self, entry):
+        self.index_file.write(json.dumps(entry) + '\n')
+
+    def flush(self):
+        if self.compressor is not None:
+            # Everything written so far can be decompressed, even though the member goes on
+            self.archive_file.write(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+        self.archive_file.flush()
+        self.index_file.flush()
+
+    def close(self):
+        if self.compressor is not None:
+            self.archive_file.write(self.compressor.flush())
+        self.archive_file.close()
+        self.index_file.close()
+
+
+class ArchiveWriter(object):
+    """ Compress and write the archives of every APIC in a directory from one thread.
+
+    Args:
+        directory (str): Where the archives are written.
+        clock: Where the time comes from.
+    """
+    def __init__(self, directory, clock=time):
+        self.directory = os.path.expanduser(directory)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.clock = clock
+        # Not bounded, unlike the event log nothing of a console is left out
+        self.queue = Queue.Queue()
+        self.archives = {}
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def open(self, opts):
+        """ Start the archive of a node.
+
+        Returns:
+            ArchiveNode: What its consoles are recorded with.
+        """
+        node = ArchiveNode(self, opts['cimc_ip'], self.clock)
+        self.queue.put((node.node, 'open', None, (
+            dict((name, opts[name]) for name in RECORDED_OPTIONS if name in opts),
+            node.started, tuple(opts[name] for name in SECRET_OPTIONS if opts.get(name)))))
+        return node
+
+    def flush(self):
+        """ Wait until everything queued has been written out. """
+        self.queue.put((None, 'flush', None, None))
+        self.queue.join()
+
+    def _run(self):
+        flushed = self.clock.time()
+        while True:
+            item = self.queue.get()
+            try:
+                self._write(*item)
+                # Flushing ends a deflate block, doing it after every write would cost both
+                # compression and CPU
+                if item[1] == 'flush' or self.clock.time() - flushed >= FLUSH_SECONDS:
+                    for archive in self.archives.values():
+                        archive.flush()
+                    flushed = self.clock.time()
+            except (IOError, OSError), err:
+                print("Unable to write the console archive: {0}".format(err))
+            finally:
+                self.queue.task_done()
+
+    def _write(self, node, kind, when, values):
+        if kind == 'flush':
+            return
+        if kind == 'open':
+            opts, started, secrets = values
+            archive = self.archives[node] = _NodeArchive(self.directory, node)
+            archive.secrets = secrets
+            archive.write({'opts': opts, 'started': started})
+            return
+        archive = self.archives.get(node)
+        if archive is None:
+            return
+        if kind == 'close':
+            archive.close()
+            del self.archives[node]
+        elif kind == 'record':
+            conn_type, direction, data = values
+            # Only what is sent is masked, like a transcript
+            if direction == 'send':
+                data = mask(data, archive.secrets)
+            position = archive.write({'t': when, 'conn': conn_type, 'dir': direction,
+                                      'data': data.decode('latin-1')})
+            if direction == 'recv':
+                archive.last_recv[conn_type] = position
+        else:
+            mark, name, conn_type = values
+            if mark == 'state':
+                # Every state starts a member, the exchange of a state is read from its start
+                position = archive.write({'t': when, 'mark': mark, 'name': name}, new_block=True)
+            else:
+                archive.write({'t': when, 'mark': mark, 'name': name, 'conn': conn_type})
+                # The prompt was matched in the output read last
+                position = archive.last_recv.get(conn_type, (archive.block, archive.block_bytes))
+            archive.index({'t': when, 'mark': mark, 'name': name, 'block': position[0],
+                           'skip': position[1]})
+
+
+_ARCHIVES = {}
+_ARCHIVES_LOCK = threading.Lock()
+
+
+def archive_for(opts):
+    """ Get the ArchiveWriter for the archive option, every node in the process shares the same one.
+
+    Returns:
+        ArchiveWriter: The writer, or None if --archive was not used.
+    """
+    directory = opts.get('archive')
+    if not directory:
+        return None
+    with _ARCHIVES_LOCK:
+        if directory not in _ARCHIVES:
+            _ARCHIVES[directory] = ArchiveWriter(directory)
+            atexit.register(_ARCHIVES[directory].flush)
+        return _ARCHIVES[directory]
+
+
+def index_path(path):
+    if path.endswith(ARCHIVE_SUFFIX):
+        path = path[:-len(ARCHIVE_SUFFIX)]
+    return path + INDEX_SUFFIX
+
+
+def read_index(path):
+    """ The marks of an archive, in the order they were made. """
+    with open(index_path(path)) as index_file:
+        return [json.loads(line) for line in index_file if line.strip()]
+
+
+def _inflate(archive_file, block):
+    """ Decompress the gzip members from the one starting at block on. """
+    archive_file.seek(block)
+    while True:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        while not decompressor.unused_data:
+            chunk = archive_file.read(READ_SIZE)
+            if not chunk:
+                # The last member is still being written when the run has not finished
+                yield decompressor.flush()
+                return
+            yield decompressor.decompress(chunk)
+        archive_file.seek(-len(decompressor.unused_data), os.SEEK_CUR)
+
+
+def read_from(path, block=0, skip=0):
+    """ The lines of an archive from a mark on.
+
+    Args:
+        path (str): The archive.
+        block (int): The offset of the gzip member the mark is in.
+        skip (int): How far into the member the mark is.
+
+    Yields:
+        dict: Each line, the data of a console line is bytes again.
+    """
+    with open(path, 'rb') as archive_file:
+        pending = ''
+        for data in _inflate(archive_file, block):
+            if skip:
+                skipped = min(skip, len(data))
+                data, skip = data[skipped:], skip - skipped
+            lines = (pending + data).split('\n')
+            pending = lines.pop()
+            for line in lines:
+                event = json.loads(line)
+                if 'data' in event:
+                    event['data'] = event['data'].encode('latin-1')
+                yield event
+
+
+def read_archive(path):
+    """ Read a whole archive like a transcript.
+
+    Returns:
+        tuple: The (header, events) of the archive, the header of its first run and the events of
+            every run without the marks.
+    """
+    events = read_from(path)
+    header = next(events, None)
+    if header is None or 'opts' not in header:
+        raise ValueError("{0} is not a wiper console archive".format(path))
+    return header, [event for event in events if 'dir' in event]
+
+
+def read_state(path, state):
+    """ The exchange of the last time a state was entered, up to the next state or run.
+
+    Returns:
+        list: The lines of the state, an empty list if the state was never entered.
+    """
+    entries = [entry for entry in read_index(path)
+               if entry['mark'] == 'state' and entry['name'] == state]
+    if not entries:
+        return []
+    lines = []
+    for event in read_from(path, entries[-1]['block'], entries[-1]['skip']):
+        if lines and (event.get('mark') == 'state' or 'opts' in event):
+            break
+        lines.append(event)
+    return lines
+
+
+def describe(event):
+    if 'mark' in event:
+        return "{0:9.3f} -- {1} {2}".format(event['t'], event['mark'], event['name'])
+    return "{0:9.3f} {1} {2:7} {3!r}".format(event['t'], event['conn'], event['dir'],
+                                            event['data'])
+
+
+def main():
+    parser = ArgumentParser('Read wiper console archives')
+    parser.add_argument('archive', help='An archive written with --archive.')
+    parser.add_argument('-l', '--list', action='store_true', default=False,
+                        help='List the states and prompts of the archive.')
+    parser.add_argument('-s', '--state', default=None,
+                        help='Show the exchange of this state only.')
+    args = parser.parse_args()
+
+    try:
+        if args.list:
+            for entry in read_index(args.archive):
+                print("{0:9.3f} {1:6} {2} (member at {3}, +{4})".format(
+                    entry['t'], entry['mark'], entry['name'], entry['block'], entry['skip']))
+        elif args.state is not None:
+            lines = read_state(args.archive, args.state)
+            if not lines:
+                print("{0} never entered {1}".format(args.archive, args.state))
+                return 1
+            for event in lines:
+                print(describe(event))
+        else:
+            for event in read_from(args.archive):
+                if 'opts' not in event:
+                    print(describe(event))
+    except (IOError, ValueError, zlib.error), err:
+        print("Unable to read {0}: {1}".format(args.archive, err))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
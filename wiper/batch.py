@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+# wiper - the APIC provisioner
+#
+# Copyright (C) 2015 Cisco Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+"""
+Send a block of CIMC CLI commands at once and check each of them afterwards.
+
+With --batch-cimc the Serial Over LAN configuration and the power cycle commands are typed ahead in
+one write and wiper waits once, for as many responses as there are commands: the CIMC prompt after
+each command, or the question a command asks.  Every command gets a response whether it worked or
+not, so a failed command does not leave wiper waiting out the timeout.  The output is then walked
+response by response and a command is confirmed when its response is the prompt it expects and no
+error was printed before it.
+
+The commands that were not confirmed are sent again one at a time.  A CIMC a batch failed on is not
+sent batches again by the process, in case it drops input that is typed ahead.
+"""
+
+# Standard Library imports
+import re
+import threading
+
+# Local imports
+from prompts import PromptClassifier
+
+# What the CIMC CLI prints when a command did not work
+CIMC_ERRORS = re.compile(r'invalid|error|not allowed|failed|unknown', re.IGNORECASE)
+
+# CIMCs a batch failed on
+_LOCKSTEP_HOSTS = set()
+_LOCKSTEP_HOSTS_LOCK = threading.Lock()
+
+
+def batch_allowed(host):
+    with _LOCKSTEP_HOSTS_LOCK:
+        return host not in _LOCKSTEP_HOSTS
+
+
+def lockstep_only(host):
+    """ Send the commands of a CIMC one at a time from now on. """
+    with _LOCKSTEP_HOSTS_LOCK:
+        _LOCKSTEP_HOSTS.add(host)
+
+
+def _bare(prompt):
+    """ A prompt written for paramiko-expect as a plain regex, see PromptClassifier. """
+    if prompt.startswith('.*'):
+        prompt = prompt[2:]
+    if prompt.endswith('.*') and not prompt.endswith(r'\.*'):
+        prompt = prompt[:-2]
+    return prompt
+
+
+def _responses(cimc_prompts, prompts):
+    """ The regex of any response to each command, its own prompt or any CIMC prompt. """
+    name = re.escape(cimc_prompts.hostname) if cimc_prompts.hostname else r'\S+'
+    any_prompt = name + r'[^\n#]*# '
+    return ['(?:{0}|{1})'.format(_bare(prompt), any_prompt) for prompt in prompts]
+
+
+class BatchClassifier(PromptClassifier):
+    """ Matches once every command of a batch has been answered, in place of a PromptClassifier.
+
+    Args:
+        cimc_prompts (CimcPrompts): The prompts of the CIMC.
+        prompts (list): The prompt each command of the batch expects.
+    """
+    def __init__(self, cimc_prompts, prompts):
+        self.responses = [re.compile(response) for response in _responses(cimc_prompts, prompts)]
+        PromptClassifier.__init__(self, [(prompts[-1], 'batch_answered')])
+
+    def scanner(self):
+        return BatchScanner(self)
+
+
+class BatchScanner(object):
+    """ Find the responses of a batch one after the other as the output is received.
+
+    Unlike a PromptScanner the output since the last response is kept, the response to the next
+    command can come after any amount of output.
+    """
+    __slots__ = ('classifier', 'text', 'offset', 'position', 'answered', 'match_start')
+
+    def __init__(self, classifier):
+        self.classifier = classifier
+        self.text = ''
+        # The stream position of the first character of text
+        self.offset = 0
+        # Where the search for the next response starts in text
+        self.position = 0
+        self.answered = 0
+        self.match_start = None
+
+    def feed(self, data):
+        self.text += data
+        responses = self.classifier.responses
+        while self.answered < len(responses):
+            match = responses[self.answered].search(self.text, self.position)
+            if match is None:
+                break
+            self.match_start = self.offset + match.start()
+            self.position = match.end()
+            self.answered += 1
+        if self.answered == len(responses):
+            return 'batch_answered'
+        # Only the output since the last response is needed
+        self.offset += self.position
+        self.text = self.text[self.position:]
+        self.position = 0
+        return None
+
+
+def verify_batch(output, cimc_prompts, prompts):
+    """ Check the commands of a batch from its output.
+
+    Args:
+        output (str): The output of the batch.
+        cimc_prompts (CimcPrompts): The prompts of the CIMC.
+        prompts (list): The prompt each command of the batch expects.
+
+    Returns:
+        int: How many of the commands, from the first one on, were confirmed.
+    """
+    position = 0
+    for index, (response, prompt) in enumerate(zip(_responses(cimc_prompts, prompts), prompts)):
+        match = re.compile(response).search(output, position)
+        if match is None:
+            return index
+        if CIMC_ERRORS.search(output, position, match.start()):
+            return index
+        if not re.match(r'(?:{0})\Z'.format(_bare(prompt)), match.group()):
+            return index
+        position = match.end()
+    return len(prompts)
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+
+# wiper - the APIC provisioner
+#
+# Copyright (C) 2015 Cisco Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+"""
+Benchmark wiper end to end against fake CIMCs.
+
+Each run starts a fresh fakecimc server in its own process, then provisions that many APICs in a
+second process so the wall time, CPU time and peak RSS measured are wiper's alone.  Every APIC
+starts out configured, so each node goes through the whole login, eraseconfig, reboot and setup
+script path.  The nodes are reached at 127.0.0.1, 127.0.0.2 ... which all land on the loopback
+interface on Linux.
+
+Usage:
+  python benchmark.py
+  python benchmark.py --nodes 1 10 --engine eventloop --boot-delay 30 --baud 115200
+"""
+
+# Standard Library imports
+from argparse import ArgumentParser, SUPPRESS
+import json
+import os
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+NODE_COUNTS = [1, 10, 100, 500]
+ENGINES = ['threads', 'eventloop']
+
+FAKECIMC = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fakecimc.py')
+
+
+def node_address(index):
+    """ The loopback address of the index'th fake CIMC. """
+    return '127.0.{0}.{1}'.format(index / 250, index % 250 + 1)
+
+
+def node_options(index, engine, port, temp_dir):
+    """ The wiper options for one fake APIC, every 3 APICs make up a fabric of their own.
+
+    The history, cache and checkpoints are kept in temp_dir so a benchmark leaves the ones of the
+    user alone.
+    """
+    controller_id = str(index % 3 + 1)
+    cimc_ip = node_address(index)
+    return {
+        'cimc_ip': cimc_ip,
+        'cimc_port': str(port),
+        'cimc_username': 'admin',
+        'cimc_password': 'password',
+        'apic_admin_password': 'password',
+        'fabric_name': 'benchmark{0}'.format(index / 3),
+        'number_of_controllers': '3',
+        'controller_number': controller_id,
+        'controller_name': 'apic' + controller_id,
+        'tep_address_pool': '10.0.0.0/16',
+        'infra_vlan_id': '4093',
+        'bd_mc_addresses': '225.0.0.0/15',
+        'oob_ip_address': '192.168.10.{0}/24'.format(index % 250 + 1),
+        'oob_default_gateway': '192.168.10.254',
+        'int_speed': 'auto',
+        'strong_passwords': 'Y',
+        'verbose': 'False',
+        'quiet': 'True',
+        'simulator': 'False',
+        'fleet': 'True',
+        'engine': engine,
+        'history_file': os.path.join(temp_dir, 'history.json'),
+        'cache_file': os.path.join(temp_dir, 'cache.json'),
+        'checkpoint_dir': os.path.join(temp_dir, 'checkpoints'),
+        'no_resume': 'True',
+        'log_prefix': '[{0}] '.format(cimc_ip),
+    }
+
+
+def raise_file_limit():
+    """ Every node needs a few file descriptors, allow as many as the hard limit does. """
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError("The fake CIMC server did not start listening on port {0}".format(port))
+
+
+def run_nodes(count, engine, port, workers, temp_dir):
+    """ Provision count fake APICs in this process and measure it.
+
+    Returns:
+        dict: The measurements of the run.
+    """
+    # Imported here so the parent process never loads wiper
+    from engine import run_engine
+    from provisioner import run_fleet
+
+    raise_file_limit()
+    node_opts = [node_options(index, engine, port, temp_dir) for index in range(count)]
+    started = time.time()
+    if engine == 'eventloop':
+        failures = run_engine(node_opts, connect_workers=workers or 10)
+    else:
+        failures = run_fleet(node_opts, workers or count)
+    wall = time.time() - started
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return {
+        'nodes': count,
+        'engine': engine,
+        'wall_seconds': round(wall, 2),
+        'cpu_seconds': round(usage.ru_utime + usage.ru_stime, 2),
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_kb': usage.ru_maxrss,
+        'failures': len(failures),
+    }
+
+
+def benchmark(count, engine, boot_delay=5.0, baud=0, workers=None):
+    """ Run one benchmark against a fresh fake CIMC server. """
+    port = free_port()
+    temp_dir = tempfile.mkdtemp(prefix='wiper-benchmark-')
+    server = subprocess.Popen([sys.executable, FAKECIMC, '--host', '0.0.0.0', '--port', str(port),
+                               '--boot-delay', str(boot_delay), '--baud', str(baud)],
+                              stdout=open(os.devnull, 'w'), preexec_fn=raise_file_limit)
+    try:
+        wait_for_port(port)
+        command = [sys.executable, os.path.abspath(__file__), '--run', str(count), engine,
+                   '--port', str(port), '--temp-dir', temp_dir]
+        if workers:
+            command.extend(['--workers', str(workers)])
+        output = subprocess.check_output(command)
+        return json.loads(output.strip().split('\n')[-1])
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def main():
+    parser = ArgumentParser('Benchmark wiper against fake CIMCs')
+    parser.add_argument('-n', '--nodes', type=int, nargs='+', default=NODE_COUNTS,
+                        help='The numbers of APICs to provision at once.')
+    parser.add_argument('-e', '--engine', nargs='+', default=ENGINES, choices=ENGINES,
+                        help='The engines to benchmark.')
+    parser.add_argument('-b', '--boot-delay', type=float, default=5.0,
+                        help='Seconds an APIC reboot takes.')
+    parser.add_argument('--baud', type=int, default=0,
+                        help='Throttle the APIC consoles to this baud rate, 0 for no throttling.')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='Workers for the threads engine (defaults to one per node) or ' +
+                             'connect workers for the eventloop engine (defaults to 10).')
+    parser.add_argument('-o', '--output', default=None,
+                        help='Also write the results to this file as JSON.')
+    # Used by the benchmark to run wiper in a child process
+    parser.add_argument('--run', nargs=2, default=None, help=SUPPRESS)
+    parser.add_argument('--port', type=int, default=None, help=SUPPRESS)
+    parser.add_argument('--temp-dir', default=None, help=SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run_nodes(int(args.run[0]), args.run[1], args.port, args.workers,
+                                   args.temp_dir)))
+        return
+
+    results = []
+    print("{0:>6} {1:>10} {2:>10} {3:>10} {4:>14} {5:>12} {6:>14} {7:>9}".format(
+        'nodes', 'engine', 'wall (s)', 'cpu (s)', 'cpu/node (ms)', 'rss (MB)', 'rss/node (KB)',
+        'failures'))
+    for count in args.nodes:
+        for engine in args.engine:
+            result = benchmark(count, engine, boot_delay=args.boot_delay, baud=args.baud,
+                               workers=args.workers)
+            results.append(result)
+            print("{0:>6} {1:>10} {2:>10.2f} {3:>10.2f} {4:>14.1f} {5:>12.1f} {6:>14.1f} "
+                  "{7:>9}".format(count, engine, result['wall_seconds'], result['cpu_seconds'],
+                                  result['cpu_seconds'] * 1000 / count,
+                                  result['peak_rss_kb'] / 1024.0,
+                                  float(result['peak_rss_kb']) / count, result['failures']))
+            sys.stdout.flush()
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
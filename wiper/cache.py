@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+# wiper - the APIC provisioner
+#
+# Copyright (C) 2015 Cisco Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+"""
+Remember what has already been checked on each CIMC.
+
+A CIMC whose Serial Over LAN settings were found to be correct on an earlier run does not need to be
+checked again, and its prompt and hardware model are already known.  Entries are keyed by the CIMC
+address and the fingerprint of its ssh host key, so a replaced or reinstalled CIMC is never mistaken
+for the one that was checked, and they expire after a TTL.
+"""
+
+# Standard Library imports
+import json
+import os
+import threading
+import time
+
+CACHE_FILE = '~/.wiper_cache.json'
+# One day
+DEFAULT_TTL = 86400
+
+
+class CimcCache(object):
+    """ The known good state of each CIMC, shared by every node in a run.
+
+    Args:
+        path (str): The JSON file the cache is kept in, it is created on save.  Without a path the
+            cache is only kept in memory.
+        ttl (int): The number of seconds an entry is trusted for, 0 disables the cache.
+        clock: Where the time comes from, the time module unless replaying.
+    """
+    def __init__(self, path=None, ttl=DEFAULT_TTL, clock=time):
+        self.path = path and os.path.expanduser(path)
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.entries = {}
+        if self.path is None:
+            return
+        try:
+            with open(self.path) as cache_file:
+                self.entries = json.load(cache_file)
+        except (IOError, ValueError):
+            pass
+
+    @staticmethod
+    def key(host, fingerprint):
+        return '{0} {1}'.format(host, fingerprint)
+
+    def get(self, host, fingerprint):
+        """ Get the entry for a CIMC.
+
+        Returns:
+            dict: The entry, or None if there is no entry or it has expired.
+        """
+        if not fingerprint or not self.ttl:
+            return None
+        with self.lock:
+            entry = self.entries.get(self.key(host, fingerprint))
+        if entry is None or self.clock.time() - entry['checked'] > self.ttl:
+            return None
+        return entry
+
+    def update(self, host, fingerprint, **values):
+        """ Store what was found on a CIMC, the entry is good for another TTL from now. """
+        if not fingerprint:
+            return
+        with self.lock:
+            entry = self.entries.setdefault(self.key(host, fingerprint), {})
+            entry.update(values)
+            entry['checked'] = self.clock.time()
+
+    def invalidate(self, host):
+        """ Forget everything about a CIMC, whatever its host key is.
+
+        Returns:
+            int: The number of entries removed.
+        """
+        prefix = host + ' '
+        with self.lock:
+            keys = [key for key in self.entries if key.startswith(prefix)]
+            for key in keys:
+                del self.entries[key]
+        return len(keys)
+
+    def save(self):
+        """ Write the cache out, through a temporary file so a crash can not truncate it. """
+        if self.path is None:
+            return
+        with self.lock:
+            data = json.dumps(self.entries, indent=2, sort_keys=True)
+        temp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        with open(temp_path, 'w') as cache_file:
+            cache_file.write(data)
+        os.rename(temp_path, self.path)
+
+
+_CACHES = {}
+_CACHES_LOCK = threading.Lock()
+
+
+def load_cache(opts):
+    """ Get the CimcCache for the cache_file and cache_ttl options, every node shares the same one.
+    """
+    path = os.path.expanduser(opts.get('cache_file') or CACHE_FILE)
+    ttl = int(opts.get('cache_ttl') or DEFAULT_TTL)
+    with _CACHES_LOCK:
+        if path not in _CACHES:
+            _CACHES[path] = CimcCache(path, ttl=ttl)
+        return _CACHES[path]
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+# wiper - the APIC provisioner
+#
+# Copyright (C) 2015 Cisco Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+"""
+Remember how far the provisioning of each APIC got, so an interrupted run can pick up from there.
+
+Each APIC has a small JSON file in the checkpoint directory, rewritten as every state is entered.
+It holds the current state, the states completed so far, the last console prompt seen on the APIC,
+when a reboot was started and whether the setup script was finished.  A run that is interrupted
+leaves the file behind and the next run resumes from it: an APIC that is still rebooting is waited
+on rather than erased or power cycled again, and one that finished the setup script is left alone.
+A run that completes removes the file.
+"""
+
+# Standard Library imports
+import json
+import os
+import time
+
+CHECKPOINT_DIR = '~/.wiper_checkpoints'
+# A checkpoint older than this was left by an earlier job rather than a run that was interrupted
+DEFAULT_TTL = 3600
+
+
+class Checkpoint(object):
+    """ The progress of one APIC.
+
+    Args:
+        directory (str): Where the checkpoint files are kept, without a directory the checkpoint is
+            only kept in memory.
+        cimc (str): The CIMC of the APIC.
+        clock: Where the time comes from, the time module unless replaying.
+    """
+    def __init__(self, directory, cimc, clock=time):
+        self.path = None
+        if directory:
+            self.path = os.path.join(os.path.expanduser(directory), cimc + '.json')
+        self.clock = clock
+        self.values = {'steps': []}
+
+    def load(self, ttl=DEFAULT_TTL):
+        """ Get the checkpoint left by an earlier run.
+
+        Returns:
+            dict: The checkpoint, or None if there is none or it has expired.
+        """
+        if self.path is None:
+            return None
+        try:
+            with open(self.path) as checkpoint_file:
+                values = json.load(checkpoint_file)
+        except (IOError, ValueError):
+            return None
+        if self.clock.time() - values.get('updated', 0) > ttl:
+            return None
+        return values
+
+    def update(self, **values):
+        """ Record progress, a state is added to the completed steps as well. """
+        if 'state' in values and values['state'] not in self.values['steps']:
+            self.values['steps'].append(values['state'])
+        self.values.update(values)
+        self.values['updated'] = self.clock.time()
+        if self.path is None:
+            return
+        temp_path = self.path + '.tmp'
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            with open(temp_path, 'w') as checkpoint_file:
+                json.dump(self.values, checkpoint_file)
+            os.rename(temp_path, self.path)
+        except (IOError, OSError), err:
+            # Provisioning goes on, it just can not be resumed
+            print("Unable to write the checkpoint '{0}': {1}".format(self.path, err))
+            self.path = None
+
+    def clear(self):
+        """ Remove the checkpoint once the APIC is done. """
+        self.values = {'steps': []}
+        if self.path is None:
+            return
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
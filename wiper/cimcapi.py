@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+
+# wiper - the APIC provisioner
+#
+# Copyright (C) 2015 Cisco Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+"""
+Control CIMC through its XML API rather than the CLI.
+
+With --xml-api, checking and configuring Serial Over LAN and power cycling the host are each one
+request to the XML API of CIMC (POST /nuova) instead of a series of CLI commands and prompts, and
+the Serial Over LAN settings are read from attributes rather than parsed out of the show sol table.
+The session is logged in once per node and the HTTP connections are kept alive and reused for every
+request to the same CIMC, by every node of the process.
+
+The ssh session to CIMC is still used for the APIC console.  When the XML API can not be used, the
+CLI is used instead and the CIMC is not tried with the XML API again by the process.
+
+The certificate of CIMC is only verified when --xml-api-cafile is given, CIMCs ship with a self
+signed certificate.
+"""
+
+# Standard Library imports
+import httplib
+import socket
+import ssl
+import threading
+from xml.etree import ElementTree
+from xml.sax.saxutils import quoteattr
+
+SOL_DN = 'sys/rack-unit-1/sol-if'
+RACK_UNIT_DN = 'sys/rack-unit-1'
+# What Serial Over LAN is set to, like the CLI commands of ProvisionApic.on_enter_configure_sol
+SOL_SETTINGS = [('adminState', 'enable'), ('speed', '115200'), ('comport', 'com0')]
+DEFAULT_PORTS = {'https': 443, 'http': 80}
+
+# Idle keep-alive connections, by (scheme, host, port)
+_POOL = {}
+_POOL_LOCK = threading.Lock()
+
+# CIMCs the XML API failed on, the CLI is used for them from then on
+_CLI_ONLY_HOSTS = set()
+_CLI_ONLY_HOSTS_LOCK = threading.Lock()
+
+
+class CimcApiError(Exception):
+    """ The XML API of CIMC could not be used. """
+    pass
+
+
+def _attributes(values):
+    return ' '.join('{0}={1}'.format(name, quoteattr(str(value))) for name, value in values)
+
+
+class CimcXmlApi(object):
+    """ The XML API of a single CIMC.
+
+    Args:
+        host (str): The CIMC hostname or ip address.
+        username (str): The CIMC username.
+        password (str): The CIMC password.
+        scheme (str): https, or http for fakecimc.py.
+        port (int): The port of the XML API, the default port of the scheme when None.
+        cafile (str): The CA certificates to verify the certificate of CIMC with.
+        timeout (int): How long to wait on each request.
+    """
+    def __init__(self, host, username, password, scheme='https', port=None, cafile=None,
+                 timeout=30):
+        self.host = host
+        self.username = username
+        self.password = password
+        self.scheme = scheme
+        self.port = int(port or DEFAULT_PORTS[scheme])
+        self.cafile = cafile
+        self.timeout = timeout
+        self.cookie = None
+
+    def _connection(self):
+        """ An idle connection to CIMC from the pool, or a new one. """
+        with _POOL_LOCK:
+            idle = _POOL.get((self.scheme, self.host, self.port))
+            if idle:
+                return idle.pop(), True
+        if self.scheme == 'http':
+            return httplib.HTTPConnection(self.host, self.port, timeout=self.timeout), False
+        kwargs = {}
+        if self.cafile:
+            kwargs['context'] = ssl.create_default_context(cafile=self.cafile)
+        elif hasattr(ssl, '_create_unverified_context'):
+            # Python verifies certificates by default since 2.7.9
+            kwargs['context'] = ssl._create_unverified_context()
+        return httplib.HTTPSConnection(self.host, self.port, timeout=self.timeout, **kwargs), False
+
+    def _release(self, connection):
+        with _POOL_LOCK:
+            _POOL.setdefault((self.scheme, self.host, self.port), []).append(connection)
+
+    def _post(self, body):
+        """ Send one request and get the root element of the response.
+
+        Raises:
+            CimcApiError: The request failed or CIMC answered with an error.
+        """
+        connection, reused = self._connection()
+        try:
+            try:
+                response = self._request(connection, body)
+            except (httplib.HTTPException, socket.error):
+                if not reused:
+                    raise
+                # CIMC closed the idle connection, the request is sent once more on a new one
+                connection.close()
+                connection = self._new_connection()
+                response = self._request(connection, body)
+        except (httplib.HTTPException, socket.error), err:
+            connection.close()
+            raise CimcApiError("The request to {0} failed: {1!r}".format(self.host, err))
+        except CimcApiError:
+            connection.close()
+            raise
+        self._release(connection)
+        try:
+            root = ElementTree.fromstring(response)
+        except ElementTree.ParseError, err:
+            raise CimcApiError("{0} sent a response that is not XML: {1}".format(self.host, err))
+        if root.get('errorCode'):
+            raise CimcApiError("{0} refused {1}: {2} {3}".format(
+                self.host, root.tag, root.get('errorCode'), root.get('errorDescr', '')))
+        return root
+
+    def _new_connection(self):
+        """ A new connection, the other idle ones were most likely closed by CIMC as well. """
+        with _POOL_LOCK:
+            idle = _POOL.pop((self.scheme, self.host, self.port), [])
+        for connection in idle:
+            connection.close()
+        return self._connection()[0]
+
+    def _request(self, connection, body):
+        connection.request('POST', '/nuova', body, {'Content-Type': 'application/xml'})
+        response = connection.getresponse()
+        # The whole response is read so the connection can be used again
+        data = response.read()
+        if response.status != 200:
+            raise CimcApiError("{0} answered HTTP {1} {2}".format(self.host, response.status,
+                                                                  response.reason))
+        return data
+
+    def login(self):
+        if self.cookie is not None:
+            return
+        root = self._post('<aaaLogin {0} />'.format(_attributes([
+            ('inName', self.username), ('inPassword', self.password)])))
+        self.cookie = root.get('outCookie')
+        if not self.cookie:
+            raise CimcApiError("{0} did not return a session cookie".format(self.host))
+
+    def read_sol(self):
+        """ The Serial Over LAN settings of CIMC.
+
+        Returns:
+            dict: The attributes of the solIf object.
+        """
+        self.login()
+        root = self._post('<configResolveClass {0} />'.format(_attributes([
+            ('cookie', self.cookie), ('inHierarchical', 'false'), ('classId', 'solIf')])))
+        sol = root.find('outConfigs/solIf')
+        if sol is None:
+            raise CimcApiError("{0} has no Serial Over LAN settings".format(self.host))
+        return dict(sol.attrib)
+
+    def sol_configured(self):
+        """ Whether Serial Over LAN is enabled at 115200 baud on com0. """
+        sol = self.read_sol()
+        return all(sol.get(name) == value for name, value in SOL_SETTINGS)
+
+    def configure_sol(self):
+        """ Enable Serial Over LAN at 115200 baud on com0. """
+        self.login()
+        self._post('<configConfMo {0}><inConfig><solIf {1} /></inConfig></configConfMo>'.format(
+            _attributes([('cookie', self.cookie), ('dn', SOL_DN), ('inHierarchical', 'false')]),
+            _attributes([('dn', SOL_DN)] + SOL_SETTINGS)))
+        return True
+
+    def power_cycle(self):
+        """ Power cycle the host. """
+        self.login()
+        self._post('<configConfMo {0}><inConfig><computeRackUnit {1} /></inConfig>'
+                   '</configConfMo>'.format(
+                       _attributes([('cookie', self.cookie), ('dn', RACK_UNIT_DN),
+                                    ('inHierarchical', 'false')]),
+                       _attributes([('dn', RACK_UNIT_DN), ('adminPower', 'cycle-immediate')])))
+        return True
+
+    def close(self):
+        """ Log out, the connection stays in the pool. """
+        if self.cookie is None:
+            return
+        cookie, self.cookie = self.cookie, None
+        try:
+            self._post('<aaaLogout {0} />'.format(_attributes([('cookie', cookie),
+                                                               ('inCookie', cookie)])))
+        except CimcApiError:
+            # The session times out on CIMC on its own
+            pass
+
+
+def cli_only(host):
+    """ Use the CLI for a CIMC from now on. """
+    with _CLI_ONLY_HOSTS_LOCK:
+        _CLI_ONLY_HOSTS.add(host)
+
+
+def xml_api_for(opts):
+    """ Get the XML API of the CIMC of a node.
+
+    Returns:
+        CimcXmlApi: The XML API, or None when --xml-api was not used or it failed on the CIMC.
+    """
+    scheme = opts.get('xml_api')
+    if not scheme:
+        return None
+    with _CLI_ONLY_HOSTS_LOCK:
+        if opts['cimc_ip'] in _CLI_ONLY_HOSTS:
+            return None
+    return CimcXmlApi(opts['cimc_ip'], opts['cimc_username'], opts['cimc_password'],
+                      scheme=scheme, port=opts.get('xml_api_port'),
+                      cafile=opts.get('xml_api_cafile'))
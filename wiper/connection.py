@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+# wiper - the APIC provisioner
+#
+# Copyright (C) 2015 Cisco Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+"""
+SSH connection handling for wiper.
+
+Both the CIMC CLI and the APIC Serial Over LAN console are reached by ssh'ing to CIMC.  Rather than
+doing two full key exchanges and password authentications to the same host, a CimcConnection opens
+one authenticated transport and both sessions are opened as channels on it.  Some CIMC's refuse a
+second session channel, those hosts are remembered for the life of the process and from then on get
+two transports that are connected in parallel.
+"""
+
+# Standard Library imports
+import os
+import threading
+
+# Third party imports
+import paramiko
+
+_SYSTEM_HOST_KEYS = None
+_SYSTEM_HOST_KEYS_LOCK = threading.Lock()
+
+# CIMC hosts that refused a second session channel on a single transport
+_SEPARATE_TRANSPORT_HOSTS = set()
+_SEPARATE_TRANSPORT_HOSTS_LOCK = threading.Lock()
+
+
+def system_host_keys():
+    """ Get the known_hosts entries of the user running wiper.
+
+    The known_hosts file is only parsed the first time this is called, every connection made after
+    that reuses the parsed keys.
+
+    Returns:
+        paramiko.HostKeys: The parsed known_hosts entries.
+    """
+    global _SYSTEM_HOST_KEYS
+    with _SYSTEM_HOST_KEYS_LOCK:
+        if _SYSTEM_HOST_KEYS is None:
+            host_keys = paramiko.HostKeys()
+            try:
+                host_keys.load(os.path.expanduser(os.path.join('~', '.ssh', 'known_hosts')))
+            except IOError:
+                pass
+            _SYSTEM_HOST_KEYS = host_keys
+        return _SYSTEM_HOST_KEYS
+
+
+class CimcConnection(object):
+    """ The ssh connection(s) to a single CIMC.
+
+    Args:
+        host (str): The CIMC hostname or ip address.
+        username (str): The CIMC username.
+        password (str): The CIMC password.
+        port (int): The ssh port of CIMC.
+        separate_transports (bool): Always use one transport per session.
+    """
+    def __init__(self, host, username, password, port=22, separate_transports=False):
+        self.host = host
+        self.username = username
+        self.password = password
+        self.port = port
+        self.separate_transports = separate_transports
+        self.clients = []
+
+    def connect(self):
+        """ Connect to CIMC.
+
+        Returns:
+            tuple: The (cimc_client, apic_client) pair of paramiko.SSHClients, these are the same
+                client unless the CIMC needs a transport per session.
+        """
+        with _SEPARATE_TRANSPORT_HOSTS_LOCK:
+            separate = self.separate_transports or self.host in _SEPARATE_TRANSPORT_HOSTS
+        if separate:
+            cimc_client, apic_client = self._connect_parallel(2)
+        else:
+            cimc_client = apic_client = self._connect()
+        return cimc_client, apic_client
+
+    def connect_second_transport(self):
+        """ Open another transport to CIMC after it refused a second session channel.
+
+        The host is remembered so the next connection to it connects both transports in parallel.
+
+        Returns:
+            paramiko.SSHClient: The newly connected client.
+        """
+        with _SEPARATE_TRANSPORT_HOSTS_LOCK:
+            _SEPARATE_TRANSPORT_HOSTS.add(self.host)
+        return self._connect()
+
+    def host_key_fingerprint(self):
+        """ The fingerprint of the CIMC host key as hex, or None when not connected. """
+        for client in self.clients:
+            transport = client.get_transport()
+            if transport is not None:
+                return transport.get_remote_server_key().get_fingerprint().encode('hex')
+        return None
+
+    def close(self):
+        for client in self.clients:
+            client.close()
+        self.clients = []
+
+    def _connect(self):
+        client = paramiko.SSHClient()
+        client.get_host_keys().update(system_host_keys())
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(hostname=self.host, port=self.port, username=self.username,
+                       password=self.password, look_for_keys=False)
+        self.clients.append(client)
+        return client
+
+    def _connect_parallel(self, count):
+        clients = [None] * count
+        errors = []
+
+        def connect(index):
+            try:
+                clients[index] = self._connect()
+            except Exception, err:
+                errors.append(err)
+
+        threads = [threading.Thread(target=connect, args=(index,)) for index in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            self.close()
+            raise errors[0]
+        return clients
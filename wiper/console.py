@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+# wiper - the APIC provisioner
+#
+# Copyright (C) 2015 Cisco Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+"""
+Read console output with bounded memory and CPU.
+
+An APIC reboot prints megabytes of BIOS and kernel output over Serial Over LAN.  Rather than keeping
+all of it and cleaning all of it again on every read, a ConsoleReader cleans each chunk once as it
+arrives and only keeps the tail of the output that prompt matching and error messages need.
+"""
+
+# Standard Library imports
+import re
+
+# Terminal escape sequences: CSI sequences (colors, cursor movement), OSC sequences (window titles),
+# character set selection and the two character escapes.
+_ESCAPE = re.compile(r'\x1b(?:\[[0-?]*[ -/]*[@-~]|\][^\x07\x1b]*(?:\x07|\x1b\\)|' +
+                     r'[()*+].|[^\[\]()*+])')
+# The start of an escape sequence that has been cut off at the end of a chunk
+_PARTIAL_ESCAPE = re.compile(r'\x1b(?:\[[0-?]*[ -/]*|\][^\x07\x1b]*\x1b?|[()*+])?\Z')
+
+# A cut off escape sequence is held back until the rest of it arrives, unless it gets longer than
+# this in which case it is not a real escape sequence.
+_MAX_ESCAPE_SIZE = 64
+
+
+class AnsiStripper(object):
+    """ Remove terminal escape sequences and carriage returns from a stream one chunk at a time. """
+    __slots__ = ('pending',)
+
+    def __init__(self):
+        self.pending = ''
+
+    def feed(self, data):
+        data = self.pending + data
+        self.pending = ''
+        escape = data.rfind('\x1b')
+        if (escape != -1 and len(data) - escape < _MAX_ESCAPE_SIZE and
+                _PARTIAL_ESCAPE.match(data, escape)):
+            data, self.pending = data[:escape], data[escape:]
+        return _ESCAPE.sub('', data).replace('\r', '')
+
+
+class TailBuffer(object):
+    """ Keep only the last size characters of a stream.
+
+    Appends are amortized, the buffer is only trimmed once it grows past twice its size.
+    """
+    __slots__ = ('size', 'data')
+
+    def __init__(self, size):
+        self.size = size
+        self.data = ''
+
+    def append(self, data):
+        self.data += data
+        if len(self.data) > 2 * self.size:
+            self.data = self.data[-self.size:]
+
+    def value(self):
+        return self.data[-self.size:]
+
+    def clear(self):
+        self.data = ''
+
+
+class ConsoleReader(object):
+    """ Read a paramiko channel in chunks sized to how fast output is arriving.
+
+    While a console is printing boot output each read fills the buffer, so the read size doubles up
+    to max_read.  Once the console is quiet again and reads come back mostly empty it halves back
+    down to min_read.
+
+    Args:
+        channel (paramiko.Channel): The channel to read.
+        tail_size (int): How much of the cleaned output to keep.
+        min_read (int): The smallest read size.
+        max_read (int): The largest read size.
+    """
+    def __init__(self, channel, tail_size=16384, min_read=1024, max_read=65536):
+        self.channel = channel
+        self.min_read = min_read
+        self.max_read = max_read
+        self.read_size = min_read
+        self.stripper = AnsiStripper()
+        self.tail = TailBuffer(tail_size)
+        self.bytes_read = 0
+        self.closed = False
+
+    def read(self):
+        """ Do a single read of the channel, this blocks according to the channel timeout.
+
+        Raises:
+            socket.timeout: Nothing was received before the channel timeout.
+
+        Returns:
+            str: The newly received output with escape sequences removed, closed is set when the
+                channel has been closed.
+        """
+        data = self.channel.recv(self.read_size)
+        if not data:
+            self.closed = True
+            return ''
+        self.bytes_read += len(data)
+        if len(data) == self.read_size:
+            self.read_size = min(self.read_size * 2, self.max_read)
+        elif len(data) < self.read_size / 4:
+            self.read_size = max(self.read_size / 2, self.min_read)
+        data = self.stripper.feed(data)
+        self.tail.append(data)
+        return data
+
+    def output(self):
+        return self.tail.value()
+
+    def clear(self):
+        self.tail.clear()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+# wiper - the APIC provisioner
+#
+# Copyright (C) 2015 Cisco Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+"""
+Compare the setup configuration an APIC already has with the one wiper would give it.
+
+The answers to the setup script are kept on the APIC in SETUP_CONFIG_FILE, one 'name = value' line
+each.  With --if-changed the file is read from the rescue-user shell with a single command before
+eraseconfig setup is sent, and an APIC whose answers already match the options is not wiped.  The
+admin password, the default gateway, the interface speed and the strong passwords setting are not in
+the file and are not compared, and neither is the multicast address pool of a controller other than
+APIC1 since only APIC1 is asked for it.
+"""
+
+# Standard Library imports
+import re
+
+# Local imports
+from states import SETUP_ANSWERS
+
+SETUP_CONFIG_FILE = '/data/data_admin/sam_exported.config'
+SHOW_SETUP_CONFIG = 'cat ' + SETUP_CONFIG_FILE
+
+# The names in SETUP_CONFIG_FILE, the attribute of the node holding the wanted value and the option
+# it comes from
+SETUP_CONFIG = [
+    ('fabricDomain', 'fabric_name', 'fabric_name'),
+    ('clusterSize', 'num_controllers', 'number_of_controllers'),
+    ('controllerID', 'controller_id', 'controller_number'),
+    ('systemName', 'controller_name', 'controller_name'),
+    ('tepPool', 'tep_address_pool', 'tep_address_pool'),
+    ('infraVlan', 'infra_vlan_id', 'infra_vlan_id'),
+    ('GIPo', 'bd_mc_address_pool', 'bd_mc_addresses'),
+    ('oobIpAddr', 'oob_ip_addr', 'oob_ip_address'),
+]
+
+# The attributes only APIC1 is asked for by the setup script
+APIC1_ONLY = set(attribute for _, attribute, _, apic1_only, _ in SETUP_ANSWERS if apic1_only)
+
+_SETTING = re.compile(r'^\s*(\w+)\s*=\s*(.*?)\s*$', re.MULTILINE)
+
+
+def parse_setup_config(output):
+    """ Get the settings from the output of SHOW_SETUP_CONFIG.
+
+    Returns:
+        dict: The value of each name in the file.
+    """
+    return dict(_SETTING.findall(output.replace('\r', '')))
+
+
+def setup_drift(node, output):
+    """ Find the settings of an APIC that differ from the options.
+
+    Args:
+        node: The ProvisionApic or ApicTask the wanted values are taken from.
+        output (str): The output of SHOW_SETUP_CONFIG.
+
+    Returns:
+        list: (option, current value, wanted value) of every setting that differs, the current
+            value is None when the APIC does not have it.
+    """
+    current = parse_setup_config(output)
+    drift = []
+    for name, attribute, option in SETUP_CONFIG:
+        if attribute in APIC1_ONLY and str(node.controller_id) != '1':
+            continue
+        wanted = str(getattr(node, attribute))
+        if current.get(name) != wanted:
+            drift.append((option, current.get(name), wanted))
+    return drift
+
+
+def describe_drift(drift):
+    """ A line for each setting that differs. """
+    return ["{0} is {1} on the APIC, {2!r} is wanted.".format(
+        option, 'not set' if value is None else repr(value), wanted)
+        for option, value, wanted in drift]
@@ -0,0 +1,823 @@
+#!/usr/bin/env python
+
+# wiper - the APIC provisioner
+#
+# Copyright (C) 2015 Cisco Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+"""
+An event loop engine that provisions many APICs from a single thread.
+
+ProvisionApic blocks a thread in expect for every console it drives, which does not scale to the few
+hundred APICs rebuilt during a data center refresh.  The engine walks exactly the same states and
+transitions (see states.py) but each APIC is a coroutine, a generator per state that yields the
+operation it is waiting on:
+
+  Expect - optionally send a command to a console and wait for one of the prompts
+  Sleep  - wait some time without blocking the other consoles
+  Call   - run a blocking call (ssh connection setup) on a small pool of worker threads
+  Fire   - fire a trigger to move to the next state
+
+All of the consoles are multiplexed with poll() on one thread, so the thread count is fixed and the
+memory used grows only by the buffers of each console.
+"""
+
+# Standard Library imports
+import collections
+import heapq
+import os
+import Queue
+import re
+import select
+import socket
+import threading
+import time
+
+# Third party imports
+import paramiko
+
+# Local imports
+from batch import BatchClassifier, batch_allowed, lockstep_only, verify_batch
+from cache import load_cache
+from cimcapi import CimcApiError, cli_only, xml_api_for
+from connection import CimcConnection
+from drift import SHOW_SETUP_CONFIG, describe_drift, setup_drift
+from events import event_log_for
+from console import ConsoleReader
+from prompts import (CONSOLE_CLASSIFIER, POWER_CYCLE_CLASSIFIER, CimcPrompts, PromptClassifier,
+                     cimc_hostname, classifier_for)
+from retry import retry_policies
+from scheduler import FleetScheduler, setup_overdue
+from states import LOGIN_TRIGGERS, SETUP_STEPS, TRANSITION_TABLE
+from timing import BootProgress, load_history, model_from_prompt
+from typeahead import SetupAnswers
+
+
+class Expect(object):
+    """ Send cmd (unless it is None) to a console and wait for one of the prompts.
+
+    The coroutine is resumed with the index of the prompt that matched, or the result paired with
+    the prompt when prompts is a PromptClassifier.  socket.timeout is thrown into it if no prompt
+    shows up in time, or if the reboot followed by progress stalls.  retry marks a command sent
+    again after an earlier attempt failed, for the metrics.
+    """
+    __slots__ = ('console', 'cmd', 'prompts', 'timeout', 'progress', 'retry')
+
+    def __init__(self, console, cmd, prompts, timeout=10, progress=None, retry=False):
+        self.console = console
+        self.cmd = cmd
+        if not isinstance(prompts, PromptClassifier):
+            prompts = classifier_for(prompts)
+        self.prompts = prompts
+        self.timeout = timeout
+        self.progress = progress
+        self.retry = retry
+
+
+class Sleep(object):
+    __slots__ = ('seconds',)
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+
+class Call(object):
+    """ Run a blocking function on a worker thread, the coroutine is resumed with its result. """
+    __slots__ = ('func', 'args')
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+
+class Fire(object):
+    __slots__ = ('trigger',)
+
+    def __init__(self, trigger):
+        self.trigger = trigger
+
+
+class Console(object):
+    """ A shell channel that is read by the engine rather than by a blocked thread. """
+    __slots__ = ('channel', 'conn_type', 'newline', 'reader', 'closed')
+
+    def __init__(self, channel, conn_type, newline='\r'):
+        self.channel = channel
+        self.conn_type = conn_type
+        self.newline = newline
+        self.reader = ConsoleReader(channel)
+        self.closed = False
+
+    @property
+    def output(self):
+        """ The tail of the output received since the console was last cleared. """
+        return self.reader.output()
+
+    def clear(self):
+        self.reader.clear()
+
+    def fileno(self):
+        return self.channel.fileno()
+
+    def send(self, cmd):
+        self.channel.sendall(str(cmd) + self.newline)
+
+    def read(self):
+        """ Read whatever is waiting on the channel, closed is set once the channel is closed.
+
+        Returns:
+            str: The newly received output.
+        """
+        received = []
+        while self.channel.recv_ready() and not self.reader.closed:
+            received.append(self.reader.read())
+        self.closed = (self.reader.closed or self.channel.closed or
+                       self.channel.exit_status_ready())
+        return ''.join(received)
+
+
+class ApicTask(object):
+    """ The provisioning of a single APIC, driven by a ConsoleEngine.
+
+    The on_enter_* generators mirror the ProvisionApic state callbacks.
+    """
+    def __init__(self, opts, fleet_node=None, metrics=None):
+        self.cimc = opts['cimc_ip']
+        self.cimc_username = opts['cimc_username']
+        self.cimc_password = opts['cimc_password']
+        self.cimc_port = int(opts.get('cimc_port') or 22)
+        self.apic_password = opts['apic_admin_password']
+        self.quiet = opts['quiet'] == 'True'
+        self.fabric_name = opts['fabric_name']
+        self.num_controllers = opts['number_of_controllers']
+        self.controller_id = opts['controller_number']
+        self.controller_name = opts['controller_name']
+        self.tep_address_pool = opts['tep_address_pool']
+        self.infra_vlan_id = opts['infra_vlan_id']
+        self.bd_mc_address_pool = opts['bd_mc_addresses']
+        self.oob_ip_addr = opts['oob_ip_address']
+        self.oob_def_gw = opts['oob_default_gateway']
+        self.int_speed = opts['int_speed']
+        self.strong_passwd = opts['strong_passwords']
+        self.separate_transports = opts.get('separate_transports') == 'True'
+        self.type_ahead = opts.get('type_ahead') == 'True'
+        self.if_changed = opts.get('if_changed') == 'True'
+        self.log_prefix = opts.get('log_prefix', '')
+        self.connection = None
+        self.cimc_console = None
+        self.apic_console = None
+        self.provided_fabric_name = False
+        self.history = load_history(opts.get('history_file'))
+        self.hardware_model = 'unknown'
+        self.state = 'start'
+        self.state_started = time.time()
+        self.metrics = metrics
+        self.cache = load_cache(opts)
+        self.host_key_fingerprint = None
+        self.cimc_prompts = CimcPrompts()
+        self.sol_from_cache = False
+        self.retries = retry_policies(opts.get('retry'))
+        self.sol_retry = None
+        self.xml_api = xml_api_for(opts)
+        self.batch_cimc = opts.get('batch_cimc') == 'True'
+        self.fleet_node = fleet_node
+        self.coroutine = None
+        self.events = event_log_for(opts)
+        if self.events is not None:
+            self.events.open(self.cimc, [self.cimc_password, self.apic_password])
+
+    def fire(self, trigger):
+        """ Move to the state the trigger leads to from the current state and enter it. """
+        try:
+            dest = TRANSITION_TABLE[(self.state, trigger)]
+        except KeyError:
+            raise RuntimeError("Can't trigger event {0} from state {1}!".format(trigger,
+                                                                               self.state))
+        now = time.time()
+        if self.state != 'start':
+            self.history.record(self.hardware_model, self.state, now - self.state_started)
+            if self.metrics is not None:
+                self.metrics.state(self.cimc, self.hardware_model, self.state,
+                                   now - self.state_started)
+        self.state, self.state_started = dest, now
+        if self.events is not None:
+            self.events.emit(self.cimc, 'state', None, state=self.state)
+        handler = getattr(self, 'on_enter_' + self.state, None)
+        if handler is None and self.state in SETUP_STEPS:
+            handler = self.setup_step
+        self.coroutine = handler()
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+        if self.xml_api is not None:
+            # One request on a kept-alive connection, the session would hold a CIMC session slot
+            # until it times out otherwise
+            self.xml_api.close()
+            self.xml_api = None
+        if self.events is not None:
+            self.events.close(self.cimc)
+
+    def log(self, message):
+        if self.events is not None:
+            self.events.emit(self.cimc, 'info', message)
+        if not self.quiet:
+            print(self.log_prefix + message)
+
+    def apic1_timeout(self):
+        """ How long to wait for APIC1 to finish the setup script, see ProvisionApic.wait_for_apic1.
+        """
+        self.log("Waiting for APIC1 of fabric '{0}' to finish the setup script.".format(
+            self.fleet_node.fabric))
+        return 2 * self.history.deadline(self.hardware_model, 'reboot', 600)
+
+    def batch_classifier(self, cmds):
+        return BatchClassifier(self.cimc_prompts, [prompt for _, prompt, _ in cmds])
+
+    def batch_confirmed(self, cmds):
+        """ How many commands of a batch its output confirmed, see batch.py. """
+        confirmed = verify_batch(self.cimc_console.output, self.cimc_prompts,
+                                 [prompt for _, prompt, _ in cmds])
+        if confirmed < len(cmds):
+            lockstep_only(self.cimc)
+        return confirmed
+
+    def cimc_api(self, operation):
+        """ Do an operation with the CIMC XML API on a worker thread, see ProvisionApic.cimc_api.
+        """
+        started = time.time()
+        result = None
+        try:
+            result = getattr(self.xml_api, operation)()
+            return result
+        except CimcApiError, err:
+            self.log("The CIMC XML API failed ({0}), using the CLI instead.".format(err))
+            cli_only(self.cimc)
+            self.xml_api.close()
+            self.xml_api = None
+            return None
+        finally:
+            if self.metrics is not None:
+                self.metrics.command(self.cimc, self.state, 'xml_api',
+                                     operation if result is not None else None,
+                                     time.time() - started, 0)
+
+    def retry_delay(self, retry, reason):
+        """ The backoff before the next attempt at an operation, None when there are no more. """
+        delay = retry.next_delay()
+        if delay is not None:
+            self.log("{0}, trying again in {1:.1f} seconds (attempt {2} of {3}).".format(
+                reason, delay, retry.attempt, retry.policy.attempts))
+        return delay
+
+    def open_console(self, client, conn_type):
+        return Console(client.invoke_shell(), conn_type)
+
+    def on_enter_connect_cimc(self):
+        prompt = self.cimc_prompts.any
+        self.connection = CimcConnection(self.cimc, self.cimc_username, self.cimc_password,
+                                         port=self.cimc_port,
+                                         separate_transports=self.separate_transports)
+        self.log("Connecting to {0} as user {1} for CIMC and APIC control.".format(
+            self.cimc, self.cimc_username))
+        retry = self.retries['connect_cimc'].start()
+        while True:
+            try:
+                cimc_client, apic_client = yield Call(self.connection.connect)
+                break
+            except (paramiko.AuthenticationException, paramiko.BadHostKeyException):
+                raise
+            except (socket.error, EOFError, paramiko.SSHException), err:
+                self.connection.close()
+                delay = self.retry_delay(retry, "Unable to connect to CIMC ({0!r})".format(err))
+                if delay is None:
+                    raise
+            yield Sleep(delay)
+        self.cimc_console = yield Call(self.open_console, cimc_client, 'cimc')
+        try:
+            self.apic_console = yield Call(self.open_console, apic_client, 'apic')
+        except paramiko.SSHException:
+            apic_client = yield Call(self.connection.connect_second_transport)
+            self.apic_console = yield Call(self.open_console, apic_client, 'apic')
+        yield Expect(self.cimc_console, '\n', prompt)
+        self.hardware_model = model_from_prompt(self.cimc_console.output)
+        self.cimc_prompts = CimcPrompts(cimc_hostname(self.cimc_console.output))
+        yield Expect(self.apic_console, '\n', prompt)
+        self.host_key_fingerprint = self.connection.host_key_fingerprint()
+        entry = self.cache.get(self.cimc, self.host_key_fingerprint)
+        self.sol_from_cache = bool(entry and entry.get('sol_configured') and
+                                   entry.get('hostname') == self.cimc_prompts.hostname)
+        yield Fire('cimc_prompt_detected')
+
+    def on_enter_check_sol(self):
+        prompt = self.cimc_prompts.any
+        if self.sol_from_cache:
+            self.log("Serial Over LAN was found configured on an earlier run, not checking it " +
+                     "again.")
+            yield Fire('connect_to_apic')
+        self.log("Ensuring Serial Over LAN is configured properly.")
+        retry = self.retries['cimc_command'].start()
+        while True:
+            sol_configured = None
+            if self.xml_api is not None:
+                sol_configured = yield Call(self.cimc_api, 'sol_configured')
+            if sol_configured is None:
+                try:
+                    yield Expect(self.cimc_console, 'show sol', prompt, retry=retry.attempt > 1)
+                except socket.timeout:
+                    delay = self.retry_delay(retry, "The prompt was not seen")
+                    if delay is None:
+                        raise
+                    yield Sleep(delay)
+                    continue
+                # Drop the echoed command so the lines line up with what ProvisionApic parses
+                output = self.cimc_console.output.replace('show sol\n', '', 1)
+                try:
+                    sol_list = re.split(r'\s*', output.split('\n')[2])
+                    sol_enabled, sol_baud, sol_com = sol_list[0], sol_list[1], sol_list[2]
+                except IndexError:
+                    delay = self.retry_delay(retry,
+                                             "The command output for 'show sol' was not valid")
+                    if delay is None:
+                        raise RuntimeError("The command output for 'show sol' was not valid")
+                    yield Sleep(delay)
+                    continue
+                sol_configured = 'yes' in sol_enabled and '115200' in sol_baud and 'com0' in sol_com
+            if sol_configured:
+                self.log("Serial Over LAN is configured.")
+                self.cache.update(self.cimc, self.host_key_fingerprint,
+                                  hostname=self.cimc_prompts.hostname, model=self.hardware_model,
+                                  sol_configured=True)
+                yield Fire('connect_to_apic')
+            # It is configured straight away the first time, the attempts after that are limited
+            if self.sol_retry is None:
+                self.sol_retry = self.retries['check_sol'].start()
+            else:
+                delay = self.retry_delay(self.sol_retry, "Serial Over LAN is still not configured")
+                if delay is None:
+                    raise RuntimeError("Serial Over LAN is still not configured after {0} "
+                                       "checks".format(self.sol_retry.attempt))
+                yield Sleep(delay)
+            self.log("Serial Over LAN is not configured, moving to configure it.")
+            yield Fire('sol_not_configured')
+
+    def on_enter_configure_sol(self):
+        if self.xml_api is not None and (yield Call(self.cimc_api, 'configure_sol')):
+            yield Fire('sol_config_committed')
+        sol_prompt = self.cimc_prompts.sol
+        sol_needs_commit_prompt = self.cimc_prompts.sol_needs_commit
+        top_prompt = self.cimc_prompts.top
+        cmds = [
+            ('scope sol', sol_prompt, 10),
+            ('set baud-rate 115200', sol_needs_commit_prompt, 10),
+            ('set comport com0', sol_needs_commit_prompt, 10),
+            ('set enabled yes', sol_needs_commit_prompt, 10),
+            ('commit', sol_prompt, 30),
+            ('top', top_prompt, 10),
+        ]
+        confirmed = None
+        if self.batch_cimc and batch_allowed(self.cimc):
+            self.log("Sending a batch of {0} commands to cimc".format(len(cmds)))
+            try:
+                yield Expect(self.cimc_console, self.cimc_console.newline.join(
+                    cmd for cmd, _, _ in cmds), self.batch_classifier(cmds),
+                    timeout=sum(timeout for _, _, timeout in cmds))
+            except socket.timeout:
+                pass
+            confirmed = self.batch_confirmed(cmds)
+            if confirmed < len(cmds):
+                self.log("'{0}' was not confirmed, configuring Serial Over LAN one command at a "
+                         "time.".format(cmds[confirmed][0]))
+        if confirmed == len(cmds):
+            cmds = []
+        elif confirmed is not None:
+            # The scope the batch left CIMC in is not known
+            cmds.insert(0, ('top', top_prompt, 10))
+        for cmd, prompt, timeout in cmds:
+            retry = self.retries['cimc_command'].start()
+            while True:
+                try:
+                    yield Expect(self.cimc_console, cmd, prompt, timeout=timeout,
+                                 retry=retry.attempt > 1)
+                    break
+                except socket.timeout:
+                    delay = self.retry_delay(retry, "The prompt was not seen")
+                    if delay is None:
+                        raise
+                yield Sleep(delay)
+        yield Fire('sol_config_committed')
+
+    def on_enter_connect_apic(self):
+        self.log("Trying to connect to the APIC console via Serial Over LAN, " +
+                 "using a timeout of 10 seconds.")
+        try:
+            trigger = yield Expect(self.apic_console, "connect host\n", CONSOLE_CLASSIFIER)
+        except socket.timeout:
+            trigger = None
+        # A console that missed the newline is nudged with another one, that is far cheaper than
+        # a power cycle
+        retry = self.retries['connect_apic'].start()
+        while trigger is None:
+            delay = self.retry_delay(retry, "No prompt seen from the APIC")
+            if delay is None:
+                break
+            yield Sleep(delay)
+            try:
+                trigger = yield Expect(self.apic_console, '', CONSOLE_CLASSIFIER, retry=True)
+            except socket.timeout:
+                pass
+        if trigger is None:
+            if self.sol_from_cache:
+                self.log("No prompt seen from the APIC, checking Serial Over LAN after all.")
+                self.sol_from_cache = False
+                self.cache.invalidate(self.cimc)
+                yield Fire('recheck_sol')
+            self.log("No prompt seen from the APIC, will try to power cycle the host.")
+            yield Fire('cycle_host')
+        if (trigger not in LOGIN_TRIGGERS and self.fleet_node is not None and
+                not self.fleet_node.setup_ready()):
+            # The console is already in the setup script, APIC1 still answers it first
+            timeout = self.apic1_timeout()
+            deadline = time.time() + timeout
+            while not self.fleet_node.setup_ready():
+                if time.time() >= deadline:
+                    raise setup_overdue(self.fleet_node, timeout)
+                yield Sleep(5)
+        yield Fire(trigger)
+
+    def on_enter_cycle_host(self):
+        chassis_prompt = self.cimc_prompts.chassis
+        power_cycle_prompt = r'.*Do you want to continue\?\[.*\].*'
+        top_prompt = self.cimc_prompts.top
+        if self.xml_api is not None and (yield Call(self.cimc_api, 'power_cycle')):
+            self.log("Power cycled the APIC with the CIMC XML API.")
+        else:
+            self.log("Sending APIC power cycle commands to CIMC.")
+            cmds = [
+                ('scope chassis', chassis_prompt, 10),
+                ('power cycle', power_cycle_prompt, 10),
+                ('y', chassis_prompt, 10),
+                ('top', top_prompt, 10),
+            ]
+            confirmed = None
+            if self.batch_cimc and batch_allowed(self.cimc):
+                self.log("Sending a batch of {0} commands to cimc".format(len(cmds)))
+                try:
+                    yield Expect(self.cimc_console, self.cimc_console.newline.join(
+                        cmd for cmd, _, _ in cmds), self.batch_classifier(cmds),
+                        timeout=sum(timeout for _, _, timeout in cmds))
+                except socket.timeout:
+                    pass
+                confirmed = self.batch_confirmed(cmds)
+            if confirmed == len(cmds):
+                cmds = []
+            elif confirmed is not None and confirmed >= 3:
+                # The host is power cycling, it must not be cycled again
+                cmds = [('top', top_prompt, 10)]
+            elif confirmed is not None:
+                self.log("The power cycle was not confirmed, sending it one command at a time.")
+                cmds.insert(0, ('top', top_prompt, 10))
+            for cmd, prompt, timeout in cmds:
+                yield Expect(self.cimc_console, cmd, prompt, timeout=timeout)
+        progress = BootProgress(self.history, self.hardware_model, log=self.log)
+        self.log("Waiting on a power cycle for up to {0} seconds.".format(progress.timeout))
+        trigger = yield Expect(self.apic_console, None, POWER_CYCLE_CLASSIFIER, timeout=600,
+                               progress=progress)
+        progress.finish()
+        yield Fire(trigger)
+
+    def on_enter_logout_apic(self):
+        self.log("Found a CLI prompt on the APIC, logging out.")
+        yield Expect(self.apic_console, 'exit', r'.*login:.*')
+        yield Fire('apic_login_detected')
+
+    def on_enter_login_apic(self):
+        self.log("Found a login prompt on the APIC, logging in as 'rescue-user'.")
+        index = yield Expect(self.apic_console, 'rescue-user', [r'.*Password:.*', r'.*~> .*'])
+        if index == 0:
+            self.log("Rescue-user was prompted for a password, sending the APIC admin password.")
+            # We need some extra time here because we may have just booted.
+            timeout = self.history.deadline(self.hardware_model, 'login_apic', 60)
+            yield Expect(self.apic_console, self.apic_password, r'.*~> .*', timeout=timeout)
+        yield Fire('apic_prompt_detected')
+
+    def on_enter_password_login_apic(self):
+        self.log("Login was already started, sending ctrl-d to start over.")
+        yield Expect(self.apic_console, chr(4), r'.*login:.*')
+        yield Fire('apic_login_detected')
+
+    def on_enter_eraseconfig(self):
+        if self.if_changed:
+            self.log("Reading the setup configuration of the APIC.")
+            yield Expect(self.apic_console, SHOW_SETUP_CONFIG, r'.*~> .*')
+            drift = setup_drift(self, self.apic_console.output)
+            if not drift:
+                self.log("The APIC already has the wanted setup configuration, not wiping it.")
+                yield Expect(self.apic_console, 'exit', r'.*login:.*')
+                if self.fleet_node is not None:
+                    self.fleet_node.setup_finished()
+                return
+            for line in describe_drift(drift):
+                self.log(line)
+        prompt = (r'.*Do you want to cleanup the initial setup data\? The system will be ' +
+                  r'REBOOTED. \(Y/n\):.*')
+        self.log("Sending 'eraseconfig setup' command to the APIC")
+        yield Expect(self.apic_console, 'eraseconfig setup', prompt)
+        progress = BootProgress(self.history, self.hardware_model, log=self.log)
+        self.log("Sending 'Y' to continue with the eraseconfig setup, will wait for the reboot, " +
+                 "timeout is {0} seconds.".format(progress.timeout))
+        yield Expect(self.apic_console, 'Y', r'.*Press any key to continue....*', timeout=600,
+                     progress=progress)
+        progress.finish()
+        yield Fire('press_any_key')
+
+    def setup_step(self):
+        answer_name, prompts = SETUP_STEPS[self.state]
+        answer = '' if answer_name is None else getattr(self, answer_name)
+        if (self.state == 'press_any_key' and self.fleet_node is not None and
+                not self.fleet_node.setup_ready()):
+            timeout = self.apic1_timeout()
+            deadline = time.time() + timeout
+            while not self.fleet_node.setup_ready():
+                if time.time() >= deadline:
+                    raise setup_overdue(self.fleet_node, timeout)
+                yield Sleep(5)
+        self.log("Answering the {0} setup question on the APIC.".format(self.state))
+        index = yield Expect(self.apic_console, answer, [prompt for prompt, _ in prompts])
+        if self.state == 'provide_fabric_name':
+            self.provided_fabric_name = True
+        if self.state == 'press_any_key' and self.type_ahead:
+            yield Fire('type_ahead_setup')
+        else:
+            yield Fire(prompts[index][1])
+
+    def on_enter_answer_setup(self):
+        answers = SetupAnswers(self)
+        self.log("Answering the setup script ahead of its questions on the APIC.")
+        self.provided_fabric_name = True
+        for step_answers, prompts, timeout in answers.steps():
+            index = yield Expect(self.apic_console, self.apic_console.newline.join(step_answers),
+                                 prompts, timeout=timeout)
+            if index == len(prompts) - 1:
+                break
+        mismatched = answers.mismatches(self.apic_console.output)
+        if mismatched:
+            self.log("The setup script did not take the answers for {0}, answering it again one "
+                     "question at a time.".format(', '.join(mismatched)))
+            self.provided_fabric_name = False
+            self.type_ahead = False
+        yield Fire('enter_edit_cfg')
+
+    def on_enter_provide_admin_passwd(self):
+        edit_prompt = r'.*Would you like to edit the configuration\? \(y/n\) \[.*\].*'
+        self.log("Setting the admin password on the APIC.")
+        index = yield Expect(self.apic_console, self.apic_password,
+                             [r'.*Reenter the password for admin:.*', edit_prompt])
+        if index == 0:
+            self.log("Resending the admin password to the APIC.")
+            yield Expect(self.apic_console, self.apic_password, edit_prompt)
+        yield Fire('enter_edit_cfg')
+
+    def on_enter_provide_modify_config(self):
+        if self.provided_fabric_name:
+            timeout = self.history.deadline(self.hardware_model, 'provide_modify_config', 60)
+            self.log("Completed a full setup script attempt, waiting for the APIC login prompt " +
+                     "for up to {0} seconds.".format(timeout))
+            yield Expect(self.apic_console, 'n', r'.*login:.*', timeout=timeout)
+            if self.fleet_node is not None:
+                self.fleet_node.setup_finished()
+        else:
+            self.log("Setting the fabric name to '{0}' on the APIC.".format(self.fabric_name))
+            yield Expect(self.apic_console, 'y', r'.*Enter the fabric name \[.*\]:.*')
+            yield Fire('enter_fabric_name')
+
+
+class ConsoleEngine(object):
+    """ Run many ApicTasks concurrently on one thread.
+
+    Args:
+        connect_workers (int): The number of threads used for blocking calls such as connecting.
+        scheduler (FleetScheduler): Where the APICs to provision come from, a task is started for
+            each as soon as the scheduler hands it out.
+        metrics (MetricsRecorder): The recorder of the run when --metrics is used.
+    """
+    def __init__(self, connect_workers=10, scheduler=None, metrics=None):
+        self.connect_workers = connect_workers
+        self.scheduler = scheduler
+        self.metrics = metrics
+        self.failures = {}
+        self._tasks = set()
+        self._ready = collections.deque()
+        # fileno -> (task, Expect, PromptScanner, deadline, time started, bytes read before)
+        self._waiting = {}
+        self._timers = []
+        self._calls = Queue.Queue()
+        self._results = Queue.Queue()
+        self._poller = select.poll()
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        self._poller.register(self._wakeup_read, select.POLLIN)
+
+    def add(self, task):
+        self._tasks.add(task)
+        self._ready.append((task, None, None))
+
+    def run(self):
+        """ Run until every task has either finished or failed.
+
+        Returns:
+            dict: The CIMC ip address of each task that failed mapped to the reason it failed.
+        """
+        threads = [threading.Thread(target=self._call_worker) for _ in range(self.connect_workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            self._schedule()
+            while self._tasks:
+                while self._ready:
+                    self._step(*self._ready.popleft())
+                if not self._tasks:
+                    break
+                for fd, _ in self._poller.poll(self._poll_timeout()):
+                    if fd == self._wakeup_read:
+                        self._collect_results()
+                    elif fd in self._waiting:
+                        self._read(fd)
+                self._expire()
+        finally:
+            for _ in threads:
+                self._calls.put(None)
+            for task in self._tasks:
+                task.close()
+        return self.failures
+
+    def _step(self, task, value, error):
+        try:
+            if task.coroutine is None:
+                task.fire('start')
+                operation = task.coroutine.next()
+            elif error is not None:
+                operation = task.coroutine.throw(error)
+            else:
+                operation = task.coroutine.send(value)
+        except StopIteration:
+            task.log("Provisioning finished.")
+            self._finish(task)
+            return
+        except Exception, err:
+            task.log("Provisioning failed in state {0}: {1!r}".format(task.state, err))
+            self.failures[task.cimc] = repr(err)
+            self._finish(task)
+            return
+
+        if isinstance(operation, Fire):
+            try:
+                task.fire(operation.trigger)
+            except RuntimeError, err:
+                self._ready.append((task, None, err))
+                return
+            self._ready.append((task, None, None))
+        elif isinstance(operation, Expect):
+            self._expect(task, operation)
+        elif isinstance(operation, Sleep):
+            heapq.heappush(self._timers, (time.time() + operation.seconds, id(task), task))
+        elif isinstance(operation, Call):
+            self._calls.put((task, operation))
+        else:
+            self._ready.append((task, None, TypeError("Unknown operation {0!r}".format(
+                operation))))
+
+    def _finish(self, task):
+        task.close()
+        self._tasks.discard(task)
+        if task.fleet_node is not None:
+            task.fleet_node.finished()
+            self._schedule()
+
+    def _schedule(self):
+        """ Start a task for every APIC the scheduler lets start now. """
+        if self.scheduler is None:
+            return
+        while True:
+            node = self.scheduler.take()
+            if node is None:
+                return
+            self.add(ApicTask(node.opts, fleet_node=node, metrics=self.metrics))
+
+    def _expect(self, task, expect):
+        console = expect.console
+        # Like paramiko-expect, only output received after the expect starts is searched.
+        console.clear()
+        try:
+            if expect.cmd is not None:
+                console.send(expect.cmd)
+        except Exception, err:
+            self._ready.append((task, None, err))
+            return
+        fd = console.fileno()
+        now = time.time()
+        self._waiting[fd] = (task, expect, expect.prompts.scanner(), now + expect.timeout, now,
+                             console.reader.bytes_read)
+        self._poller.register(fd, select.POLLIN)
+
+    def _read(self, fd):
+        task, expect, scanner = self._waiting[fd][:3]
+        console = expect.console
+        data = console.read()
+        if expect.progress is not None:
+            expect.progress.feed(data)
+        result = scanner.feed(data)
+        if result is not None:
+            self._stop_waiting(fd, expect.prompts.describe(result))
+            self._ready.append((task, result, None))
+        elif console.closed:
+            self._stop_waiting(fd)
+            self._ready.append((task, None, socket.error("The {0} session closed".format(
+                console.conn_type))))
+
+    def _stop_waiting(self, fd, matched=None):
+        task, expect, _, _, started, bytes_read = self._waiting.pop(fd)
+        self._poller.unregister(fd)
+        if task.metrics is not None and expect.cmd is not None:
+            task.metrics.command(task.cimc, task.state, expect.console.conn_type, matched,
+                                 time.time() - started,
+                                 expect.console.reader.bytes_read - bytes_read, retry=expect.retry)
+
+    def _expire(self):
+        now = time.time()
+        for fd, (task, expect, _, deadline, _, _) in self._waiting.items():
+            if expect.progress is not None:
+                deadline = min(deadline, expect.progress.deadline())
+            if deadline <= now:
+                self._stop_waiting(fd)
+                self._ready.append((task, None, socket.timeout(
+                    "Timed out waiting on {0!r}".format(expect.prompts))))
+        while self._timers and self._timers[0][0] <= now:
+            self._ready.append((heapq.heappop(self._timers)[2], None, None))
+
+    def _poll_timeout(self):
+        """ The number of milliseconds until the next deadline or timer. """
+        deadlines = []
+        for _, expect, _, deadline, _, _ in self._waiting.values():
+            if expect.progress is not None:
+                deadline = min(deadline, expect.progress.deadline())
+            deadlines.append(deadline)
+        if self._timers:
+            deadlines.append(self._timers[0][0])
+        if not deadlines:
+            return None
+        return max(0, int((min(deadlines) - time.time()) * 1000) + 1)
+
+    def _call_worker(self):
+        while True:
+            item = self._calls.get()
+            if item is None:
+                return
+            task, call = item
+            try:
+                self._results.put((task, call.func(*call.args), None))
+            except Exception, err:
+                self._results.put((task, None, err))
+            os.write(self._wakeup_write, 'x')
+
+    def _collect_results(self):
+        os.read(self._wakeup_read, 4096)
+        while True:
+            try:
+                self._ready.append(self._results.get_nowait())
+            except Queue.Empty:
+                return
+
+
+def run_engine(node_opts, connect_workers=10, metrics=None):
+    """ Provision every node in node_opts from a single event loop.
+
+    Args:
+        node_opts (list): A list of option dictionaries, one per APIC.
+        connect_workers (int): The number of threads used to set up ssh connections.
+        metrics (MetricsRecorder): The recorder of the run when --metrics is used.
+
+    Returns:
+        dict: The CIMC ip address of each node that failed mapped to the reason it failed.
+    """
+    scheduler = FleetScheduler()
+    for opts in node_opts:
+        scheduler.add(opts)
+    scheduler.close()
+    engine = ConsoleEngine(connect_workers=connect_workers, scheduler=scheduler, metrics=metrics)
+    failures = engine.run()
+    load_history(node_opts[0].get('history_file')).save()
+    load_cache(node_opts[0]).save()
+    return failures
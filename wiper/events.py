@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+# wiper - the APIC provisioner
+#
+# Copyright (C) 2015 Cisco Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+"""
+A JSON lines event log per APIC, written by a background thread.
+
+With --event-log every message of a node, every state it enters and, optionally, everything its
+consoles print are written to <directory>/<cimc>.events.jsonl.  The threads provisioning the nodes
+only put the message and its arguments on a bounded queue, the formatting and the writing are done
+by one writer thread.  When the writer falls behind, debug and console events are sampled once the
+queue is half full and every event is dropped once it is full, rather than holding up the
+provisioning.  How many events of a node were left out is written to its log as a dropped event.
+"""
+
+# Standard Library imports
+import atexit
+import json
+import os
+import Queue
+import threading
+import time
+
+# Local imports
+from transcript import mask
+
+EVENT_QUEUE_SIZE = 10000
+# Once the queue is this full only one in SAMPLE_RATE debug and console events is kept
+SAMPLE_ABOVE = 0.5
+SAMPLE_RATE = 10
+SAMPLED_KINDS = frozenset(['debug', 'console'])
+
+
+class EventLog(object):
+    """ The event logs of every node in a directory.
+
+    Args:
+        directory (str): Where the event logs are written.
+        size (int): How many events can wait to be written.
+        clock: Where the time comes from.
+    """
+    def __init__(self, directory, size=EVENT_QUEUE_SIZE, clock=time):
+        self.directory = os.path.expanduser(directory)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.size = size
+        self.clock = clock
+        self.queue = Queue.Queue(size)
+        self.lock = threading.Lock()
+        self.sampled = 0
+        # node -> the events left out since the last dropped event was written
+        self.dropped = {}
+        # Only used by the writer thread
+        self.files = {}
+        self.secrets = {}
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def emit(self, node, kind, message, args=(), **fields):
+        """ Queue an event, message is formatted with args by the writer.
+
+        Args:
+            node (str): The CIMC of the node.
+            kind (str): info, debug, state or console.
+            message (str): The message, or the output for a console event.
+            args (tuple): The arguments to format the message with.
+            fields: More values to write with the event.
+        """
+        if kind in SAMPLED_KINDS and self.queue.qsize() > self.size * SAMPLE_ABOVE:
+            with self.lock:
+                self.sampled += 1
+                keep = self.sampled % SAMPLE_RATE == 0
+            if not keep:
+                self._drop(node)
+                return
+        try:
+            self.queue.put_nowait((self.clock.time(), node, kind, message, args, fields))
+        except Queue.Full:
+            self._drop(node)
+
+    def open(self, node, secrets=()):
+        """ Start the log of a node, secrets are masked in its messages. """
+        self.queue.put((None, node, 'open', None, tuple(secret for secret in secrets if secret),
+                        None))
+
+    def close(self, node):
+        """ Finish the log of a node once it is done. """
+        self.queue.put((None, node, 'close', None, (), None))
+
+    def flush(self):
+        """ Wait until every queued event has been written. """
+        self.queue.join()
+
+    def _drop(self, node):
+        with self.lock:
+            self.dropped[node] = self.dropped.get(node, 0) + 1
+
+    def _run(self):
+        while True:
+            event = self.queue.get()
+            try:
+                self._write(*event)
+                if self.queue.empty():
+                    self._write_dropped()
+                    for event_file in self.files.values():
+                        event_file.flush()
+            except (IOError, OSError, ValueError), err:
+                print("Unable to write the event log: {0}".format(err))
+            finally:
+                self.queue.task_done()
+
+    def _write(self, when, node, kind, message, args, fields):
+        if kind == 'open':
+            self.secrets[node] = args
+            return
+        if kind == 'close':
+            self._write_dropped()
+            event_file = self.files.pop(node, None)
+            if event_file is not None:
+                event_file.close()
+            self.secrets.pop(node, None)
+            return
+        event = {'t': round(when, 3), 'event': kind}
+        if kind == 'console':
+            event['data'] = message.decode('latin-1')
+        elif message is not None:
+            if args:
+                message = message.format(*args)
+            event['message'] = mask(message, self.secrets.get(node, ()))
+        event.update(fields)
+        self._file(node).write(json.dumps(event) + '\n')
+
+    def _write_dropped(self):
+        with self.lock:
+            dropped, self.dropped = self.dropped, {}
+        for node, count in dropped.items():
+            self._file(node).write(json.dumps({'t': round(self.clock.time(), 3),
+                                               'event': 'dropped', 'count': count}) + '\n')
+
+    def _file(self, node):
+        if node not in self.files:
+            self.files[node] = open(os.path.join(self.directory, node + '.events.jsonl'), 'a')
+        return self.files[node]
+
+
+_EVENT_LOGS = {}
+_EVENT_LOGS_LOCK = threading.Lock()
+
+
+def event_log_for(opts):
+    """ Get the EventLog for the event_log option, every node in the process shares the same one.
+
+    Returns:
+        EventLog: The event log, or None if --event-log was not used.
+    """
+    directory = opts.get('event_log')
+    if not directory:
+        return None
+    with _EVENT_LOGS_LOCK:
+        if directory not in _EVENT_LOGS:
+            _EVENT_LOGS[directory] = EventLog(directory)
+            # The events still queued when wiper exits are written out first
+            atexit.register(_EVENT_LOGS[directory].flush)
+        return _EVENT_LOGS[directory]
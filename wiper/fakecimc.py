@@ -0,0 +1,627 @@
+#!/usr/bin/env python
+
+# wiper - the APIC provisioner
+#
+# Copyright (C) 2015 Cisco Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+"""
+A stand-in for CIMC and the APIC console so wiper can run without real hardware.
+
+The fake CIMC answers ssh on one port for every node, the node is picked by the local address the
+client connected to (127.0.0.1, 127.0.0.2 ... all reach the loopback interface on Linux).  It
+emulates enough of the CIMC CLI for wiper (show sol, scope sol, scope chassis, power cycle,
+connect host) and 'connect host' attaches the session to an emulated APIC console that walks through
+login, eraseconfig and the setup script.
+
+Faults can be injected to see how wiper copes with flaky hardware: refused logins, dropped
+sessions, reboots that never finish and slow SOL commits.
+
+With --xml-api-port the same CIMCs also answer the parts of the CIMC XML API wiper uses (login,
+reading and configuring solIf and power cycling the rack unit) over plain HTTP, see cimcapi.py.
+
+Usage:
+  python fakecimc.py --port 2200 --boot-delay 5 --baud 115200
+  wiper --cimc-port 2200 -i sample.ini 127.0.0.1
+  python fakecimc.py --port 2200 --xml-api-port 8080
+  wiper --cimc-port 2200 --xml-api http --xml-api-port 8080 -i sample.ini 127.0.0.1
+"""
+
+# Standard Library imports
+from argparse import ArgumentParser
+import BaseHTTPServer
+import random
+import socket
+import SocketServer
+import threading
+import time
+from xml.etree import ElementTree
+
+# Third party imports
+import paramiko
+
+CIMC_HOSTNAME = 'C220-FCH1234V5WX'
+
+# How each setup answer is shown in the configuration summary, the passwords are not shown
+SUMMARY_LABELS = {
+    'fabric_name': 'Fabric name',
+    'number_of_controllers': 'Number of controllers',
+    'controller_id': 'Controller ID',
+    'controller_name': 'Controller name',
+    'tep_pool': 'TEP address pool',
+    'infra_vlan': 'Infra VLAN ID',
+    'gipo': 'Multicast address pool',
+    'oob_address': 'Management IP address',
+    'oob_gateway': 'Default gateway',
+    'int_speed': 'Interface speed/duplex mode',
+    'strong_passwords': 'Strong Passwords',
+}
+
+# The name each setup answer is kept under in /data/data_admin/sam_exported.config, the passwords,
+# the default gateway, the interface speed and the strong passwords setting are not kept there
+SETUP_CONFIG_NAMES = {
+    'fabric_name': 'fabricDomain',
+    'number_of_controllers': 'clusterSize',
+    'controller_id': 'controllerID',
+    'controller_name': 'systemName',
+    'tep_pool': 'tepPool',
+    'infra_vlan': 'infraVlan',
+    'gipo': 'GIPo',
+    'oob_address': 'oobIpAddr',
+}
+
+
+class FakeApic(object):
+    """ The state of one emulated APIC and its CIMC.
+
+    Args:
+        address (str): The CIMC address the node answers on.
+        boot_delay (float): Seconds a reboot takes.
+        baud (int): The emulated SOL baud rate, 0 disables throttling.
+        faults (dict): Fault injection settings, see FakeCimcServer.
+        configured (bool): Whether the APIC has been through the setup script.
+    """
+    def __init__(self, address, boot_delay=5.0, baud=0, faults=None, configured=True):
+        self.address = address
+        self.boot_delay = boot_delay
+        self.baud = baud
+        self.faults = faults or {}
+        self.lock = threading.RLock()
+        self.sol_enabled = False
+        self.sol_pending = {}
+        self.config = {}
+        self.configured = configured
+        # Start out booted
+        self.booted_at = time.time() - boot_delay
+        self.consoles = []
+        self.power_cycles = 0
+        self.hung = False
+
+    def console_state(self):
+        """ Where the APIC console is, 'booting', 'setup' or 'login'. """
+        if self.hung:
+            return 'booting'
+        if time.time() < self.booted_at + self.boot_delay:
+            return 'booting'
+        return 'login' if self.configured else 'setup'
+
+    def reboot(self, wipe=False):
+        with self.lock:
+            if wipe:
+                self.configured = False
+            self.booted_at = time.time()
+            self.hung = random.random() < self.faults.get('hang_rate', 0.0)
+            for console in list(self.consoles):
+                console.rebooted()
+
+
+class Session(object):
+    """ One shell channel, either at the CIMC CLI or attached to the APIC console. """
+    def __init__(self, node, channel):
+        self.node = node
+        self.channel = channel
+        self.scope = ''
+        self.attached = False
+        self.apic_state = None
+        self.answers = []
+        self.pending_question = None
+        self.input = self.lines()
+
+    # Output helpers
+
+    def write(self, data):
+        data = data.replace('\n', '\r\n')
+        if self.node.baud:
+            # 10 bits per character on a serial line
+            chunk = max(1, self.node.baud / 10 / 20)
+            for start in range(0, len(data), chunk):
+                self.channel.sendall(data[start:start + chunk])
+                time.sleep(len(data[start:start + chunk]) * 10.0 / self.node.baud)
+        else:
+            self.channel.sendall(data)
+
+    def cimc_prompt(self):
+        if self.scope:
+            return '{0} /{1} {2}# '.format(CIMC_HOSTNAME, self.scope,
+                                            '*' if self.node.sol_pending else '')
+        return '{0}# '.format(CIMC_HOSTNAME)
+
+    def run(self):
+        # Wake up regularly to notice reboots started from another session
+        self.channel.settimeout(0.2)
+        try:
+            self.write(self.cimc_prompt())
+            for line in self.input:
+                if self.attached:
+                    self.apic_input(line)
+                else:
+                    self.cimc_input(line)
+        except (socket.error, EOFError):
+            pass
+        finally:
+            with self.node.lock:
+                if self in self.node.consoles:
+                    self.node.consoles.remove(self)
+            self.channel.close()
+
+    def lines(self):
+        """ Yield each line sent by the client, echoing it back like a terminal would. """
+        buf = ''
+        while True:
+            if self.attached and self.apic_state == 'booting':
+                self.boot()
+            try:
+                data = self.channel.recv(1024)
+            except socket.timeout:
+                continue
+            if not data:
+                return
+            if random.random() < self.node.faults.get('drop_rate', 0.0):
+                raise EOFError()
+            buf += data
+            while True:
+                # A bare control-d ends a login attempt
+                if buf.startswith(chr(4)):
+                    buf = buf[1:]
+                    yield chr(4)
+                    continue
+                positions = [pos for pos in (buf.find('\r'), buf.find('\n')) if pos != -1]
+                if not positions:
+                    break
+                pos = min(positions)
+                line, buf = buf[:pos], buf[pos + 1:]
+                if self.apic_state not in ('password', 'admin_password', 'admin_password2'):
+                    self.write(line + '\n')
+                else:
+                    self.write('\n')
+                yield line
+
+    # CIMC CLI
+
+    def cimc_input(self, line):
+        cmd = line.strip()
+        node = self.node
+        if not cmd:
+            pass
+        elif cmd == 'show sol':
+            self.write('Enabled Baud Rate(bps)  Com Port\n------- --------------- --------\n')
+            self.write('{0:<8}{1:<16}{2}\n'.format('yes' if node.sol_enabled else 'no',
+                                                  '115200' if node.sol_enabled else '9600',
+                                                  'com0'))
+        elif cmd in ('scope sol', 'scope chassis'):
+            self.scope = cmd.split()[1]
+        elif cmd == 'top':
+            self.scope = ''
+        elif cmd.startswith('set ') and self.scope == 'sol':
+            node.sol_pending[cmd.split()[1]] = cmd.split()[2]
+        elif cmd == 'commit' and self.scope == 'sol':
+            time.sleep(node.faults.get('commit_delay', 0.0))
+            node.sol_enabled = node.sol_pending.get('enabled', 'no') == 'yes' or node.sol_enabled
+            node.sol_pending = {}
+        elif cmd == 'power cycle' and self.scope == 'chassis':
+            self.write("This operation will change the server's power state.\n")
+            self.write('Do you want to continue?[y|N]')
+            answer = next(self.input)
+            if answer.strip() == 'y':
+                node.power_cycles += 1
+                node.reboot()
+        elif cmd == 'connect host' and not node.sol_enabled:
+            self.write('Serial Over LAN is disabled\n')
+        elif cmd == 'connect host':
+            self.write('CISCO Serial Over LAN:\nClose Network Connection to Exit\n')
+            self.attach()
+            return
+        else:
+            self.write('Invalid command: {0}\n'.format(cmd))
+        if cmd and random.random() < node.faults.get('lose_rate', 0.0):
+            return
+        self.write(self.cimc_prompt())
+
+    # APIC console
+
+    def attach(self):
+        with self.node.lock:
+            self.attached = True
+            self.node.consoles.append(self)
+            self.apic_state = self.node.console_state()
+            if self.apic_state == 'setup':
+                self.apic_state = 'press_any_key'
+
+    def rebooted(self):
+        self.apic_state = 'booting'
+
+    def boot(self):
+        """ Print boot chatter until the node has booted, then show the first prompt. """
+        node = self.node
+        self.write('\nCisco Systems, Inc.\nConfiguring and testing memory..\n')
+        while node.console_state() == 'booting':
+            self.write('[    {0:.6f}] kernel: loading modules\n'.format(time.time()))
+            time.sleep(min(1.0, max(0.01, node.booted_at + node.boot_delay - time.time())))
+        if node.configured:
+            self.apic_state = 'login'
+            self.write('\napic1 login: ')
+        else:
+            self.apic_state = 'press_any_key'
+            self.write('Press any key to continue...')
+
+    def show_apic_prompt(self):
+        state = self.apic_state
+        if state == 'login':
+            self.write('apic1 login: ')
+        elif state == 'password':
+            self.write('Password: ')
+        elif state == 'shell':
+            self.write('rescue-user@apic1:~> ')
+        elif state == 'press_any_key':
+            self.write('Press any key to continue...')
+        elif state == 'setup':
+            self.write(self.pending_question[1])
+
+    def setup_questions(self):
+        controller_id = self.node.config.get('controller_id', '1')
+        questions = [
+            ('fabric_name', 'Enter the fabric name [ACI Fabric1]: '),
+            ('number_of_controllers', 'Enter the number of controllers in the fabric (1-9) [3]: '),
+            ('controller_id', 'Enter the controller ID (1-3) [1]: '),
+            ('controller_name', 'Enter the controller name [apic1]: '),
+            ('tep_pool', 'Enter address pool for TEP addresses [10.0.0.0/16]: '),
+            ('infra_vlan', 'Enter the VLAN ID for infra network (1-4094): '),
+        ]
+        if controller_id == '1':
+            questions.append(('gipo', 'Enter address pool for BD multicast addresses (GIPO) ' +
+                              '[225.0.0.0/15]: '))
+        questions.extend([
+            ('oob_address', 'Out-of-band management configuration ...\n' +
+             'Enter the IP address [192.168.10.1/24]: '),
+            ('oob_gateway', 'Enter the IP address of the default gateway [None]: '),
+            ('int_speed', 'Enter the interface speed/duplex mode [auto]: '),
+        ])
+        if controller_id == '1':
+            questions.extend([
+                ('strong_passwords', 'Enable strong passwords? [Y]: '),
+                ('admin_password', 'Enter the password for admin: '),
+                ('admin_password2', 'Reenter the password for admin: '),
+            ])
+        return questions
+
+    def next_question(self):
+        asked = [name for name, _ in self.answers]
+        for name, question in self.setup_questions():
+            if name not in asked:
+                self.pending_question = (name, question)
+                if name.startswith('admin_password'):
+                    self.apic_state = name
+                self.write(question)
+                return
+        self.apic_state = 'edit_config'
+        self.write('\nCluster configuration ...\n')
+        for name, answer in self.answers:
+            if name in SUMMARY_LABELS:
+                self.write('  {0}: {1}\n'.format(SUMMARY_LABELS[name], answer))
+        self.write('\nWould you like to edit the configuration? (y/n) [n]: ')
+
+    def apic_input(self, line):
+        node = self.node
+        state = self.apic_state
+        if state == 'booting':
+            return
+        if state == 'press_any_key':
+            self.apic_state = 'setup'
+            self.answers = []
+            self.next_question()
+        elif state in ('setup', 'admin_password', 'admin_password2'):
+            name = self.pending_question[0]
+            self.answers.append((name, line.strip()))
+            node.config[name] = line.strip()
+            if state != 'setup' and name == 'admin_password2':
+                self.apic_state = 'setup'
+            self.next_question()
+        elif state == 'edit_config':
+            if line.strip() == 'y':
+                self.apic_state = 'setup'
+                self.answers = []
+                self.next_question()
+            else:
+                node.configured = True
+                self.apic_state = 'login'
+                self.write('\nSystem pre-configured successfully.\n\napic1 login: ')
+        elif state == 'login':
+            if line.strip() == 'rescue-user':
+                self.apic_state = 'password'
+            self.show_apic_prompt()
+        elif state == 'password':
+            if line == chr(4):
+                self.apic_state = 'login'
+            else:
+                self.apic_state = 'shell'
+            self.show_apic_prompt()
+        elif state == 'shell':
+            cmd = line.strip()
+            if cmd == 'exit':
+                self.apic_state = 'login'
+                self.write('logout\n\n')
+            elif cmd == 'eraseconfig setup':
+                self.write('Do you want to cleanup the initial setup data? The system will be ' +
+                           'REBOOTED. (Y/n): ')
+                answer = next(self.input)
+                if answer.strip() == 'Y':
+                    self.write('Broadcast message: The system is going down for reboot NOW!\n')
+                    node.reboot(wipe=True)
+                    return
+            elif cmd == 'cat /data/data_admin/sam_exported.config':
+                for name, answer in sorted(node.config.items()):
+                    if name in SETUP_CONFIG_NAMES:
+                        self.write('{0} = {1}\n'.format(SETUP_CONFIG_NAMES[name], answer))
+            elif cmd:
+                self.write('-bash: {0}: command not found\n'.format(cmd))
+            self.show_apic_prompt()
+
+
+class _ServerInterface(paramiko.ServerInterface):
+    def __init__(self, server, node):
+        self.server = server
+        self.node = node
+
+    def check_auth_password(self, username, password):
+        if random.random() < self.node.faults.get('auth_failure_rate', 0.0):
+            return paramiko.AUTH_FAILED
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_channel_request(self, kind, chanid):
+        if kind != 'session':
+            return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight,
+                                  modes):
+        return True
+
+    def check_channel_shell_request(self, channel):
+        thread = threading.Thread(target=Session(self.node, channel).run)
+        thread.daemon = True
+        thread.start()
+        return True
+
+
+class FakeCimcServer(object):
+    """ Serve any number of fake CIMCs on one port.
+
+    Args:
+        host (str): The address to listen on.
+        port (int): The port to listen on, 0 picks a free port.
+        boot_delay (float): Seconds each reboot takes.
+        baud (int): The emulated SOL baud rate, 0 disables throttling.
+        faults (dict): Fault injection, any of:
+            auth_failure_rate - chance a password authentication is refused
+            drop_rate - chance a read from the client drops the session
+            hang_rate - chance a reboot never finishes
+            lose_rate - chance the prompt after a CIMC command is never shown
+            commit_delay - seconds a SOL commit takes
+        configured (bool): Whether the APICs start out already configured.
+    """
+    def __init__(self, host='0.0.0.0', port=0, boot_delay=5.0, baud=0, faults=None,
+                 configured=True):
+        self.boot_delay = boot_delay
+        self.baud = baud
+        self.faults = faults or {}
+        self.configured = configured
+        self.nodes = {}
+        self.nodes_lock = threading.Lock()
+        self.host_key = paramiko.RSAKey.generate(1024)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(1024)
+        self.port = self.sock.getsockname()[1]
+        self._thread = None
+
+    def node(self, address):
+        with self.nodes_lock:
+            if address not in self.nodes:
+                self.nodes[address] = FakeApic(address, boot_delay=self.boot_delay,
+                                               baud=self.baud, faults=self.faults,
+                                               configured=self.configured)
+            return self.nodes[address]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        while True:
+            try:
+                client, _ = self.sock.accept()
+            except socket.error:
+                return
+            thread = threading.Thread(target=self._handle, args=(client,))
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        self.sock.close()
+
+    def _handle(self, client):
+        node = self.node(client.getsockname()[0])
+        transport = paramiko.Transport(client)
+        transport.add_server_key(self.host_key)
+        try:
+            transport.start_server(server=_ServerInterface(self, node))
+        except (paramiko.SSHException, EOFError):
+            return
+
+
+class _XmlApiHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Keeps the connection open between requests like CIMC does
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        node = self.server.cimcs.node(self.connection.getsockname()[0])
+        try:
+            request = ElementTree.fromstring(body)
+        except ElementTree.ParseError:
+            self.send_error(400)
+            return
+        data = ElementTree.tostring(self.server.answer(node, request))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeXmlApiServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ Serve the XML API of the CIMCs of a FakeCimcServer over HTTP.
+
+    Args:
+        cimcs (FakeCimcServer): Where the nodes come from, the node is picked by the local address
+            the client connected to like the ssh server does.
+        host (str): The address to listen on.
+        port (int): The port to listen on, 0 picks a free port.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, cimcs, host='0.0.0.0', port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), _XmlApiHandler)
+        self.cimcs = cimcs
+        self.port = self.server_address[1]
+        self.cookies = set()
+        self.cookies_lock = threading.Lock()
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def answer(self, node, request):
+        """ The response element to a request element. """
+        method = request.tag
+        response = ElementTree.Element(method, cookie=request.get('cookie', ''), response='yes')
+        if method == 'aaaLogin':
+            if random.random() < node.faults.get('auth_failure_rate', 0.0):
+                return self.error(response, '551', 'Authorization required')
+            cookie = '{0:032x}'.format(random.getrandbits(128))
+            with self.cookies_lock:
+                self.cookies.add(cookie)
+            response.set('outCookie', cookie)
+            response.set('outRefreshPeriod', '600')
+            return response
+        with self.cookies_lock:
+            if request.get('cookie') not in self.cookies:
+                return self.error(response, '552', 'Authorization required')
+            if method == 'aaaLogout':
+                self.cookies.discard(request.get('inCookie'))
+                return response
+        if method == 'configResolveClass' and request.get('classId') == 'solIf':
+            configs = ElementTree.SubElement(response, 'outConfigs')
+            ElementTree.SubElement(configs, 'solIf', self.sol(node))
+            return response
+        config = request.find('inConfig/*')
+        if method == 'configConfMo' and config is not None and config.tag == 'solIf':
+            time.sleep(node.faults.get('commit_delay', 0.0))
+            node.sol_enabled = (config.get('adminState') == 'enable' and
+                                config.get('speed') == '115200')
+            configs = ElementTree.SubElement(response, 'outConfig')
+            ElementTree.SubElement(configs, 'solIf', self.sol(node))
+            return response
+        if method == 'configConfMo' and config is not None and config.tag == 'computeRackUnit':
+            if config.get('adminPower') == 'cycle-immediate':
+                node.power_cycles += 1
+                node.reboot()
+            return response
+        return self.error(response, '-1', 'Not emulated by fakecimc.py')
+
+    def sol(self, node):
+        return {'dn': 'sys/rack-unit-1/sol-if', 'comport': 'com0',
+                'adminState': 'enable' if node.sol_enabled else 'disable',
+                'speed': '115200' if node.sol_enabled else '9600'}
+
+    def error(self, response, code, description):
+        response.set('errorCode', code)
+        response.set('invocationResult', 'unidentified-fail')
+        response.set('errorDescr', description)
+        return response
+
+
+def main():
+    parser = ArgumentParser('Serve fake CIMCs for testing wiper')
+    parser.add_argument('-p', '--port', type=int, default=2200, help='The port to listen on.')
+    parser.add_argument('-b', '--boot-delay', type=float, default=5.0,
+                        help='Seconds an APIC reboot takes.')
+    parser.add_argument('--baud', type=int, default=0,
+                        help='Throttle the APIC console to this baud rate, 0 for no throttling.')
+    parser.add_argument('--host', default='0.0.0.0', help='The address to listen on.')
+    parser.add_argument('--unconfigured', action='store_true', default=False,
+                        help='Start every APIC at the setup script.')
+    parser.add_argument('--auth-failure-rate', type=float, default=0.0,
+                        help='The chance a password authentication is refused.')
+    parser.add_argument('--drop-rate', type=float, default=0.0,
+                        help='The chance a read from the client drops the session.')
+    parser.add_argument('--hang-rate', type=float, default=0.0,
+                        help='The chance a reboot never finishes.')
+    parser.add_argument('--lose-rate', type=float, default=0.0,
+                        help='The chance the prompt after a CIMC command is never shown.')
+    parser.add_argument('--commit-delay', type=float, default=0.0,
+                        help='Seconds a SOL commit takes.')
+    parser.add_argument('--xml-api-port', type=int, default=None,
+                        help='Serve the CIMC XML API over HTTP on this port as well.')
+    args = parser.parse_args()
+    faults = {
+        'auth_failure_rate': args.auth_failure_rate,
+        'drop_rate': args.drop_rate,
+        'hang_rate': args.hang_rate,
+        'lose_rate': args.lose_rate,
+        'commit_delay': args.commit_delay,
+    }
+    server = FakeCimcServer(host=args.host, port=args.port, boot_delay=args.boot_delay,
+                            baud=args.baud, faults=faults, configured=not args.unconfigured)
+    print("Serving fake CIMCs on port {0}".format(server.port))
+    if args.xml_api_port is not None:
+        xml_api = FakeXmlApiServer(server, host=args.host, port=args.xml_api_port).start()
+        print("Serving the fake CIMC XML API on port {0}".format(xml_api.port))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
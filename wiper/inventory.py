@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+
+# wiper - the APIC provisioner
+#
+# Copyright (C) 2015 Cisco Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+"""
+The inventory of CIMCs, compiled once into an indexed cache.
+
+Parsing an ini file with thousands of CIMC sections and interpolating every option of a section on
+each run adds up.  The inventory is compiled into a SQLite file in the inventory cache directory, one
+row per section, so the options of a CIMC are a single indexed lookup and a fleet run streams the
+sections from it in order.  The compiled file is reused until the inventory changes, the size and
+mtime are checked first and the content hash only when they differ.  Without a writable cache
+directory the inventory is compiled in memory for the run.  The compiled files hold the passwords of
+the inventory, so only their owner can read them and the one of an inventory that is gone is removed.
+
+Besides ini files, inventories can be CSV files (a header row of option names, a cimc_ip column
+names each section and a row whose cimc_ip is DEFAULT holds the defaults) or JSON files (an object of
+section names to objects of options, including DEFAULT).
+"""
+
+# Standard Library imports
+import collections
+import ConfigParser
+import csv
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+
+INVENTORY_CACHE = '~/.wiper_inventory'
+# Bumped whenever the layout of the compiled file changes
+VERSION = '1'
+DEFAULT_SECTION = 'DEFAULT'
+
+_INTERPOLATION = re.compile(r'%(?:\(([^)]*)\)s|%)')
+# Like ConfigParser, references this deep are assumed to be a loop
+MAX_INTERPOLATION_DEPTH = 10
+
+
+class InventoryError(Exception):
+    pass
+
+
+def interpolate(name, values, overrides, depth=0):
+    """ Get an option with the %(name)s references in it replaced, like SafeConfigParser does.
+
+    Args:
+        name (str): The option to get.
+        values (dict): The options of the section, merged over the DEFAULT options.
+        overrides (dict): Options that take the place of the section options, their values are used
+            as they are.
+
+    Raises:
+        InventoryError: A reference can not be resolved.
+    """
+    if name in overrides:
+        return overrides[name]
+    if depth > MAX_INTERPOLATION_DEPTH:
+        raise InventoryError("The {0} option refers to itself".format(name))
+    value = values[name]
+    if '%' not in value:
+        return value
+
+    def replace(match):
+        if match.group(1) is None:
+            return '%'
+        reference = match.group(1).lower()
+        if reference not in overrides and reference not in values:
+            raise InventoryError("The {0} option refers to {1}, which is not set".format(
+                name, reference))
+        return interpolate(reference, values, overrides, depth + 1)
+
+    value = _INTERPOLATION.sub(replace, value)
+    return value
+
+
+def _read_ini(path):
+    parser = ConfigParser.RawConfigParser()
+    try:
+        parser.read([path])
+    except ConfigParser.Error, err:
+        raise InventoryError("Unable to read '{0}': {1}".format(path, err))
+    yield DEFAULT_SECTION, parser.defaults()
+    for section in parser.sections():
+        yield section, dict(parser.items(section))
+
+
+def _read_csv(path):
+    with open(path, 'rb') as csv_file:
+        for row in csv.DictReader(csv_file):
+            values = dict((name.strip().lower(), value.strip()) for name, value in row.items()
+                          if name and value)
+            section = values.pop('cimc_ip', None)
+            if section:
+                yield section, values
+
+
+def _read_json(path):
+    with open(path) as json_file:
+        try:
+            sections = json.load(json_file, object_pairs_hook=collections.OrderedDict)
+        except ValueError, err:
+            raise InventoryError("Unable to read '{0}': {1}".format(path, err))
+    for section, values in sections.items():
+        yield section, dict((name.lower(), str(value)) for name, value in values.items())
+
+
+def read_sections(path):
+    """ Read the sections of an inventory file one at a time.
+
+    Returns:
+        iterator: (section name, options) pairs, including the DEFAULT section.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        return _read_csv(path)
+    if extension == '.json':
+        return _read_json(path)
+    return _read_ini(path)
+
+
+def _decode(options):
+    """ The options of a compiled section, as the byte strings ConfigParser would give. """
+    return dict((name.encode('utf-8'), value.encode('utf-8'))
+                for name, value in json.loads(options).items())
+
+
+def _digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as inventory_file:
+        for block in iter(lambda: inventory_file.read(65536), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _make_private(path, mode):
+    """ Take the permissions of the other users away from a file or directory of the cache. """
+    try:
+        if os.stat(path).st_mode & 0777 != mode:
+            os.chmod(path, mode)
+    except OSError:
+        # Someone else's file, it is left as it is
+        pass
+
+
+class Inventory(object):
+    """ The compiled form of an inventory file.
+
+    Args:
+        path (str): The inventory file.
+        cache_dir (str): Where the compiled file is kept, None keeps it in memory only.
+    """
+    def __init__(self, path, cache_dir=INVENTORY_CACHE):
+        self.path = os.path.abspath(path)
+        self.lock = threading.Lock()
+        self.db = None
+        self.db_path = None
+        if cache_dir:
+            self.db_path = os.path.join(
+                os.path.expanduser(cache_dir),
+                hashlib.sha1(self.path).hexdigest() + '.db')
+        self.defaults = {}
+        self.stat = None
+
+    def refresh(self):
+        """ Make sure the compiled form matches the inventory file, compiling it if needed.
+
+        Returns:
+            bool: False when the inventory file does not exist.
+        """
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            self._forget()
+            return False
+        stat = [stat.st_mtime, stat.st_size]
+        with self.lock:
+            if stat == self.stat:
+                return True
+            if self.db is None and self.db_path is not None and os.path.exists(self.db_path):
+                # Compiled files written before they were made private
+                _make_private(self.db_path, 0600)
+                self.db = sqlite3.connect(self.db_path, check_same_thread=False)
+            if self.db is not None and not self._is_current(stat):
+                self.db.close()
+                self.db = None
+            if self.db is None:
+                self.db = self._compile(stat)
+            row = self._row(DEFAULT_SECTION)
+            self.defaults = _decode(row[0]) if row is not None else {}
+            self.stat = stat
+        return True
+
+    def _forget(self):
+        """ Remove the compiled form of an inventory file that is gone, it holds its passwords. """
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+            self.stat = None
+            if self.db_path is not None and os.path.exists(self.db_path):
+                try:
+                    os.unlink(self.db_path)
+                except OSError:
+                    pass
+
+    def _is_current(self, stat):
+        try:
+            meta = dict(self.db.execute('SELECT key, value FROM meta'))
+        except sqlite3.Error:
+            return False
+        if meta.get('version') != VERSION or 'stat' not in meta:
+            return False
+        if json.loads(meta['stat']) == stat:
+            return True
+        # Touched but not changed, no need to compile it again
+        if meta['sha1'] != _digest(self.path):
+            return False
+        with self.db:
+            self.db.execute("UPDATE meta SET value = ? WHERE key = 'stat'", (json.dumps(stat),))
+        return True
+
+    def _compile(self, stat):
+        temp_path = self._temp_path()
+        db = sqlite3.connect(temp_path or ':memory:', check_same_thread=False)
+        try:
+            with db:
+                db.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+                db.execute('CREATE TABLE sections (position INTEGER PRIMARY KEY, '
+                           'name TEXT UNIQUE, options TEXT)')
+                for section, values in read_sections(self.path):
+                    db.execute('INSERT OR REPLACE INTO sections (name, options) VALUES (?, ?)',
+                               (section, json.dumps(values)))
+                db.executemany('INSERT INTO meta VALUES (?, ?)',
+                               [('version', VERSION), ('source', self.path),
+                                ('stat', json.dumps(stat)), ('sha1', _digest(self.path))])
+        except:
+            db.close()
+            if temp_path is not None:
+                os.unlink(temp_path)
+            raise
+        if temp_path is None:
+            return db
+        db.close()
+        os.rename(temp_path, self.db_path)
+        return sqlite3.connect(self.db_path, check_same_thread=False)
+
+    def _temp_path(self):
+        """ Where to compile the inventory before it is moved into place, None to keep it in memory.
+        """
+        if self.db_path is None:
+            return None
+        cache_dir = os.path.dirname(self.db_path)
+        temp_path = '{0}.{1}.tmp'.format(self.db_path, os.getpid())
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir, 0700)
+            _make_private(cache_dir, 0700)
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            if not os.access(cache_dir, os.W_OK):
+                return None
+            # The compiled inventory is as secret as the passwords in it, it is created private
+            # before anything is written to it
+            os.close(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600))
+        except OSError:
+            return None
+        return temp_path
+
+    def _row(self, name):
+        return self.db.execute('SELECT options FROM sections WHERE name = ?', (name,)).fetchone()
+
+    def section(self, name):
+        """ Get the options of a section, merged over the DEFAULT options.
+
+        Returns:
+            dict: The options, or None if there is no such section.
+        """
+        with self.lock:
+            row = self._row(name)
+        if row is None:
+            return None
+        values = dict(self.defaults)
+        values.update(_decode(row[0]))
+        return values
+
+    def sections(self, batch=500):
+        """ The non-DEFAULT sections in the order they are in the inventory.
+
+        Returns:
+            iterator: (section name, options) pairs, read from the compiled file as they are used.
+        """
+        position = 0
+        while True:
+            with self.lock:
+                rows = self.db.execute('SELECT position, name, options FROM sections '
+                                       'WHERE position > ? AND name != ? ORDER BY position '
+                                       'LIMIT ?', (position, DEFAULT_SECTION, batch)).fetchall()
+            if not rows:
+                return
+            for position, name, options in rows:
+                values = dict(self.defaults)
+                values.update(_decode(options))
+                yield name.encode('utf-8'), values
+
+
+_INVENTORIES = {}
+_INVENTORIES_LOCK = threading.Lock()
+
+
+def load_inventory(path, cache_dir=None):
+    """ Get the compiled inventory of a file, every caller in the process shares the same one.
+
+    Returns:
+        Inventory: The compiled inventory, or None if the file does not exist.
+    """
+    path = os.path.abspath(path)
+    if cache_dir is None:
+        cache_dir = INVENTORY_CACHE
+    with _INVENTORIES_LOCK:
+        if path not in _INVENTORIES:
+            _INVENTORIES[path] = Inventory(path, cache_dir)
+        inventory = _INVENTORIES[path]
+    if not inventory.refresh():
+        return None
+    return inventory
@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+
+# wiper - the APIC provisioner
+#
+# Copyright (C) 2015 Cisco Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+"""
+A job queue in a SQLite file, shared by any number of wiper worker processes.
+
+wiper -Q/--queue adds one job per APIC and wiper worker processes take them from the queue.  A worker
+holds a lease on each job it runs and renews it while the job runs, if the worker dies the lease runs
+out and the job goes back to the queue for another worker, up to MAX_ATTEMPTS times.  Workers on
+other hosts can share the queue file as long as the filesystem it is on has working file locks.
+
+The queue keeps to the same rules as the fleet scheduler (see scheduler.py): one job per CIMC at a
+time, the max_per_fabric and max_per_subnet limits, and the other controllers of a fabric only start
+once APIC1 has and wait for it to finish the setup script.  A fabric has a single APIC1 in the queue
+and APIC1 itself never waits.
+"""
+
+# Standard Library imports
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Local imports
+from scheduler import setup_overdue, subnet_of
+
+JOB_QUEUE = '~/.wiper_queue.db'
+# How long a lease lasts without being renewed
+LEASE_SECONDS = 120
+# How many times a job is leased before it is failed
+MAX_ATTEMPTS = 3
+
+_SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY, cimc TEXT, fabric TEXT, '
+    'controller INTEGER, subnet TEXT, max_per_fabric INTEGER, max_per_subnet INTEGER, '
+    'opts TEXT, status TEXT, worker TEXT, lease_expires REAL, attempts INTEGER, '
+    'setup_done INTEGER, error TEXT, updated REAL)',
+    'CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)',
+    'CREATE INDEX IF NOT EXISTS jobs_fabric ON jobs (fabric, controller)',
+]
+
+
+def _load_opts(opts):
+    """ The options of a job, as the byte strings they were submitted as. """
+    return dict((name.encode('utf-8'),
+                 value.encode('utf-8') if isinstance(value, unicode) else value)
+                for name, value in json.loads(opts).items())
+
+
+def _limit(opts, name):
+    return int(opts.get(name) or 0)
+
+
+class QueueNode(object):
+    """ A job leased from the queue, passed to ProvisionApic like a FleetNode. """
+    __slots__ = ('queue', 'id', 'worker', 'opts', 'cimc', 'fabric', 'controller')
+
+    def __init__(self, queue, job_id, worker, opts, fabric, controller):
+        self.queue = queue
+        self.id = job_id
+        self.worker = worker
+        self.opts = opts
+        self.cimc = opts['cimc_ip']
+        self.fabric = fabric
+        self.controller = controller
+
+    def setup_ready(self):
+        """ Whether the APIC1 of the fabric is done with the setup script. """
+        return self.queue.setup_ready(self)
+
+    def wait_for_setup(self, log=None, timeout=None):
+        """ Block until the APIC1 of the fabric is done with the setup script.
+
+        Raises:
+            RuntimeError: APIC1 was not done within timeout seconds.
+        """
+        self.queue.wait_for_setup(self, log, timeout)
+
+    def setup_finished(self):
+        """ Called once the APIC has finished the setup script. """
+        self.queue.setup_finished(self)
+
+    def finished(self, error=None):
+        """ Called once the APIC has been provisioned, or has failed because of error. """
+        self.queue.complete(self, error)
+
+
+class JobQueue(object):
+    """ The jobs of a queue file.
+
+    Safe to share between threads, and between processes through the queue file.
+
+    Args:
+        path (str): The queue file, it is created if it does not exist.
+        clock: Where the time comes from.
+    """
+    def __init__(self, path=JOB_QUEUE, clock=time):
+        self.path = os.path.expanduser(path)
+        self.clock = clock
+        self.lock = threading.Lock()
+        # Transactions are started explicitly so a lease is taken by one worker only
+        self.db = sqlite3.connect(self.path, timeout=60, isolation_level=None,
+                                  check_same_thread=False)
+        # The queue is as secret as the passwords in it
+        os.chmod(self.path, 0600)
+        with self.lock:
+            for statement in _SCHEMA:
+                self.db.execute(statement)
+
+    def _transaction(self, work, *args):
+        """ Run work(*args) in a write transaction and get what it returns. """
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                result = work(*args)
+            except:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+            return result
+
+    def submit(self, node_opts):
+        """ Add a job for each APIC, an APIC that already has a job waiting or running is skipped.
+
+        Returns:
+            int: The number of jobs added.
+
+        Raises:
+            ValueError: An APIC1 was added to a fabric that already has another APIC1 in the queue,
+                nothing is added then.
+        """
+        return self._transaction(self._submit, node_opts)
+
+    def _submit(self, node_opts):
+        added = 0
+        for opts in node_opts:
+            queued = self.db.execute("SELECT COUNT(*) FROM jobs WHERE cimc = ? AND status IN "
+                                     "('pending', 'leased')", (opts['cimc_ip'],)).fetchone()[0]
+            if queued:
+                continue
+            opts = dict(opts)
+            # The jobs of a worker run side by side like fleet mode
+            opts.setdefault('log_prefix', '[{0}] '.format(opts['cimc_ip']))
+            try:
+                controller = int(opts.get('controller_number'))
+            except (TypeError, ValueError):
+                controller = 0
+            if controller == 1:
+                leader = self.db.execute(
+                    "SELECT cimc FROM jobs WHERE fabric IS ? AND controller = 1 AND "
+                    "status IN ('pending', 'leased')", (opts.get('fabric_name'),)).fetchone()
+                if leader is not None:
+                    raise ValueError("{0} and {1} are both controller 1 of fabric '{2}', give "
+                                     "each fabric its own --fabric-name".format(
+                                         leader[0], opts['cimc_ip'], opts.get('fabric_name')))
+            self.db.execute(
+                "INSERT INTO jobs (cimc, fabric, controller, subnet, max_per_fabric, "
+                "max_per_subnet, opts, status, attempts, setup_done, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, 'pending', 0, 0, ?)",
+                (opts['cimc_ip'], opts.get('fabric_name'), controller,
+                 subnet_of(opts['cimc_ip'], int(opts.get('subnet_prefix') or 24)),
+                 _limit(opts, 'max_per_fabric'), _limit(opts, 'max_per_subnet'),
+                 json.dumps(opts), self.clock.time()))
+            added += 1
+        return added
+
+    def lease(self, worker, seconds=LEASE_SECONDS):
+        """ Take the job that should start next, if one can start now.
+
+        Args:
+            worker (str): Who the lease is for.
+            seconds (int): How long the lease lasts unless it is renewed.
+
+        Returns:
+            QueueNode: The job, or None if no job can start now.
+        """
+        return self._transaction(self._lease, worker, seconds)
+
+    def _lease(self, worker, seconds):
+        now = self.clock.time()
+        self._expire(now)
+        cimcs = set()
+        fabrics = {}
+        subnets = {}
+        for cimc, fabric, subnet in self.db.execute(
+                "SELECT cimc, fabric, subnet FROM jobs WHERE status = 'leased'"):
+            cimcs.add(cimc)
+            fabrics[fabric] = fabrics.get(fabric, 0) + 1
+            subnets[subnet] = subnets.get(subnet, 0) + 1
+        rows = self.db.execute("SELECT id, cimc, fabric, controller, subnet, max_per_fabric, "
+                               "max_per_subnet FROM jobs WHERE status = 'pending' "
+                               "ORDER BY id").fetchall()
+        for job_id, cimc, fabric, controller, subnet, max_per_fabric, max_per_subnet in rows:
+            if cimc in cimcs:
+                continue
+            if max_per_fabric and fabrics.get(fabric, 0) >= max_per_fabric:
+                continue
+            if max_per_subnet and subnets.get(subnet, 0) >= max_per_subnet:
+                continue
+            # Like the fleet scheduler, nothing of a fabric starts before its APIC1 has
+            waiting_leaders = self.db.execute(
+                "SELECT COUNT(*) FROM jobs WHERE fabric IS ? AND controller = 1 AND "
+                "controller != ? AND status = 'pending'", (fabric, controller)).fetchone()[0]
+            if waiting_leaders:
+                continue
+            self.db.execute("UPDATE jobs SET status = 'leased', worker = ?, lease_expires = ?, "
+                            "attempts = attempts + 1, setup_done = 0, updated = ? WHERE id = ?",
+                            (worker, now + seconds, now, job_id))
+            opts = self.db.execute('SELECT opts FROM jobs WHERE id = ?', (job_id,)).fetchone()[0]
+            return QueueNode(self, job_id, worker, _load_opts(opts), fabric, controller)
+        return None
+
+    def _expire(self, now):
+        """ Put the jobs of workers that stopped renewing their lease back in the queue. """
+        self.db.execute("UPDATE jobs SET status = 'failed', error = 'The lease expired ' || "
+                        "attempts || ' times, last held by ' || worker, updated = ? "
+                        "WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?",
+                        (now, now, MAX_ATTEMPTS))
+        self.db.execute("UPDATE jobs SET status = 'pending', error = 'The lease held by ' || "
+                        "worker || ' expired', updated = ? "
+                        "WHERE status = 'leased' AND lease_expires < ?", (now, now))
+
+    def renew(self, node, seconds=LEASE_SECONDS):
+        """ Extend the lease on a job.
+
+        Returns:
+            bool: False when the lease was lost, the job may be running on another worker.
+        """
+        with self.lock:
+            now = self.clock.time()
+            cursor = self.db.execute("UPDATE jobs SET lease_expires = ?, updated = ? "
+                                     "WHERE id = ? AND worker = ? AND status = 'leased'",
+                                     (now + seconds, now, node.id, node.worker))
+            return cursor.rowcount == 1
+
+    def complete(self, node, error=None):
+        """ Record the result of a job, unless the lease on it was lost. """
+        with self.lock:
+            self.db.execute("UPDATE jobs SET status = ?, error = ?, lease_expires = NULL, "
+                            "updated = ? WHERE id = ? AND worker = ? AND status = 'leased'",
+                            ('failed' if error is not None else 'done', error,
+                             self.clock.time(), node.id, node.worker))
+
+    def setup_finished(self, node):
+        with self.lock:
+            self.db.execute('UPDATE jobs SET setup_done = 1 WHERE id = ?', (node.id,))
+
+    def setup_ready(self, node):
+        if node.controller == 1:
+            return True
+        with self.lock:
+            return not self.db.execute(
+                "SELECT COUNT(*) FROM jobs WHERE fabric IS ? AND controller = 1 AND id != ? AND "
+                "setup_done = 0 AND status IN ('pending', 'leased')",
+                (node.fabric, node.id)).fetchone()[0]
+
+    def wait_for_setup(self, node, log=None, timeout=None, poll=5):
+        if self.setup_ready(node):
+            return
+        if log is not None:
+            log("Waiting for APIC1 of fabric '{0}' to finish the setup script.".format(
+                node.fabric))
+        deadline = None if timeout is None else self.clock.time() + timeout
+        while not self.setup_ready(node):
+            if deadline is not None and self.clock.time() >= deadline:
+                raise setup_overdue(node, timeout)
+            self.clock.sleep(poll)
+
+    def pending(self):
+        """ Whether any job is still waiting or running. """
+        with self.lock:
+            return bool(self.db.execute("SELECT COUNT(*) FROM jobs WHERE status IN "
+                                        "('pending', 'leased')").fetchone()[0])
+
+    def jobs(self):
+        """ The jobs in the order they were added.
+
+        Returns:
+            list: (CIMC, status, worker, attempts, error) of each job.
+        """
+        with self.lock:
+            return self.db.execute('SELECT cimc, status, worker, attempts, error FROM jobs '
+                                   'ORDER BY id').fetchall()
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+
+# wiper - the APIC provisioner
+#
+# Copyright (C) 2015 Cisco Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+"""
+Measure where the time goes when provisioning APICs.
+
+With --metrics every node of a run reports to one MetricsRecorder: how long each state took and
+how long each command took to get its prompt back, along with the prompt that matched, the bytes
+read and whether the command was a retry.  At the end of the run the recorder writes a JSON report
+of everything it saw and a Prometheus textfile collector file (wiper.prom) with histograms
+aggregated across all of the nodes.
+
+Commands are never recorded, some of them are passwords.
+"""
+
+# Standard Library imports
+import json
+import os
+import threading
+import time
+
+# Histogram buckets in seconds, a state can include a reboot while a command is usually quick
+STATE_BUCKETS = [1, 5, 10, 30, 60, 120, 300, 600, 1200]
+COMMAND_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 600]
+
+REPORT_FILE = 'wiper.json'
+PROMETHEUS_FILE = 'wiper.prom'
+
+
+class Histogram(object):
+    """ A Prometheus style cumulative histogram. """
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for index, bucket in enumerate(self.buckets):
+            if value <= bucket:
+                self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def lines(self, name, labels):
+        """ The exposition format lines for this histogram. """
+        lines = []
+        for bucket, count in zip(self.buckets, self.counts):
+            lines.append('{0}_bucket{1} {2}'.format(name, _labels(labels, le=bucket), count))
+        lines.append('{0}_bucket{1} {2}'.format(name, _labels(labels, le='+Inf'), self.count))
+        lines.append('{0}_sum{1} {2}'.format(name, _labels(labels), self.sum))
+        lines.append('{0}_count{1} {2}'.format(name, _labels(labels), self.count))
+        return lines
+
+
+def _labels(labels, **extra):
+    items = sorted(labels) + sorted(extra.items())
+    if not items:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(name, str(value).replace('\\', r'\\').replace(
+        '"', r'\"')) for name, value in items) + '}'
+
+
+class MetricsRecorder(object):
+    """ Collect the timings of every node in a run, safe to share between threads. """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.states = []
+        self.commands = []
+        self.nodes = {}
+        self._state_histograms = {}
+        self._command_histograms = {}
+        self._bytes_read = {}
+        self._retries = {}
+
+    def state(self, node, model, state, seconds):
+        """ Record the time a node spent in a state. """
+        with self.lock:
+            self.states.append({'node': node, 'model': model, 'state': state,
+                                'seconds': round(seconds, 3)})
+            key = (('model', model), ('state', state))
+            if key not in self._state_histograms:
+                self._state_histograms[key] = Histogram(STATE_BUCKETS)
+            self._state_histograms[key].observe(seconds)
+
+    def command(self, node, state, conn_type, matched, seconds, bytes_read, retry=False):
+        """ Record a command round trip.
+
+        Args:
+            node (str): The CIMC ip address of the node.
+            state (str): The state the command was sent from.
+            conn_type (str): 'cimc' or 'apic', or 'xml_api' for a CIMC XML API request.
+            matched (str): The prompt or trigger that matched, None when the command timed out.
+            seconds (float): The time from sending the command to seeing the prompt.
+            bytes_read (int): The bytes read from the console while waiting on the prompt.
+            retry (bool): The command was sent again by a retry policy (see retry.py) after an
+                earlier attempt failed.
+        """
+        with self.lock:
+            self.commands.append({'node': node, 'state': state, 'conn_type': conn_type,
+                                  'matched': matched, 'seconds': round(seconds, 3),
+                                  'bytes_read': bytes_read, 'retry': retry})
+            key = (('conn_type', conn_type), ('state', state))
+            if key not in self._command_histograms:
+                self._command_histograms[key] = Histogram(COMMAND_BUCKETS)
+            self._command_histograms[key].observe(seconds)
+            self._bytes_read[key] = self._bytes_read.get(key, 0) + bytes_read
+            if retry:
+                self._retries[key] = self._retries.get(key, 0) + 1
+
+    def node_result(self, node, failure=None):
+        with self.lock:
+            self.nodes[node] = failure
+
+    def report(self):
+        """ Everything recorded as a JSON serializable dictionary. """
+        with self.lock:
+            return {
+                'started': self.started,
+                'seconds': round(time.time() - self.started, 3),
+                'nodes': dict((node, {'provisioned': failure is None, 'failure': failure})
+                              for node, failure in self.nodes.items()),
+                'states': list(self.states),
+                'commands': list(self.commands),
+            }
+
+    def prometheus(self):
+        """ The metrics in the Prometheus text exposition format. """
+        with self.lock:
+            lines = [
+                '# HELP wiper_state_duration_seconds Time spent in each provisioning state.',
+                '# TYPE wiper_state_duration_seconds histogram',
+            ]
+            for key in sorted(self._state_histograms):
+                lines.extend(self._state_histograms[key].lines('wiper_state_duration_seconds',
+                                                               key))
+            lines.extend([
+                '# HELP wiper_command_duration_seconds Time from sending a command to its prompt.',
+                '# TYPE wiper_command_duration_seconds histogram',
+            ])
+            for key in sorted(self._command_histograms):
+                lines.extend(self._command_histograms[key].lines(
+                    'wiper_command_duration_seconds', key))
+            lines.extend([
+                '# HELP wiper_console_bytes_read_total Console output read waiting on prompts.',
+                '# TYPE wiper_console_bytes_read_total counter',
+            ])
+            for key in sorted(self._bytes_read):
+                lines.append('wiper_console_bytes_read_total{0} {1}'.format(
+                    _labels(key), self._bytes_read[key]))
+            lines.extend([
+                '# HELP wiper_command_retries_total Commands sent again after a failed attempt.',
+                '# TYPE wiper_command_retries_total counter',
+            ])
+            for key in sorted(self._retries):
+                lines.append('wiper_command_retries_total{0} {1}'.format(_labels(key),
+                                                                          self._retries[key]))
+            failed = len([failure for failure in self.nodes.values() if failure is not None])
+            lines.extend([
+                '# HELP wiper_nodes Nodes in the last run by result.',
+                '# TYPE wiper_nodes gauge',
+                'wiper_nodes{{result="provisioned"}} {0}'.format(len(self.nodes) - failed),
+                'wiper_nodes{{result="failed"}} {0}'.format(failed),
+                '# HELP wiper_run_duration_seconds Wall clock time of the last run.',
+                '# TYPE wiper_run_duration_seconds gauge',
+                'wiper_run_duration_seconds {0}'.format(time.time() - self.started),
+                '# HELP wiper_last_run_timestamp_seconds When the last run finished.',
+                '# TYPE wiper_last_run_timestamp_seconds gauge',
+                'wiper_last_run_timestamp_seconds {0}'.format(int(time.time())),
+            ])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, directory):
+        """ Write the JSON report and the Prometheus textfile into a directory.
+
+        The files are renamed into place so the textfile collector never reads half a file.
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        _write_file(os.path.join(directory, REPORT_FILE),
+                    json.dumps(self.report(), indent=2, sort_keys=True))
+        _write_file(os.path.join(directory, PROMETHEUS_FILE), self.prometheus())
+
+
+def _write_file(path, data):
+    temp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(temp_path, 'w') as output_file:
+        output_file.write(data)
+    os.rename(temp_path, path)
+
+
+def metrics_for(opts):
+    """ Get a new recorder for a run, or None if --metrics was not used.
+
+    The recorder is made once per run, or per wiperd job, and handed to every node of it.
+    """
+    if not opts.get('metrics'):
+        return None
+    return MetricsRecorder()
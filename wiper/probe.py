@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+# wiper - the APIC provisioner
+#
+# Copyright (C) 2015 Cisco Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+"""
+wiper probe - find out where the console of every APIC stands before a rebuild.
+
+The probe takes the same arguments as wiper, connects to every CIMC at once, checks Serial Over LAN
+with show sol and classifies the APIC console with the same prompts provisioning uses.  Nothing is
+changed, with one exception: the wake-up sent to a quiet console is a newline, which answers the
+setup script question an APIC may be sitting at with its default (wiper edits the configuration
+again when it provisions it).
+
+    wiper probe -i sample.ini --fleet --probe-report probe.json
+    wiper -i sample.ini --fleet --probe-report probe.json
+
+Given the report, the provisioning run starts the APICs that have the most to do first and does not
+retry the console of an APIC the probe found unresponsive before power cycling it, nor power cycle
+one the probe found booting.
+"""
+
+# Standard Library imports
+import json
+import sys
+import threading
+
+# How the console of each APIC was found, by the trigger of the prompt it showed
+CONSOLE_STATES = {
+    'apic_login_detected': 'login',
+    'apic_password_detected': 'login',
+    'apic_prompt_detected': 'shell',
+}
+# The APICs with the most to do first: an unresponsive console needs a power cycle and a login or a
+# shell the eraseconfig reboot, an APIC in the setup script only has the questions left.  CIMCs that
+# could not be reached come last.
+PROBE_ORDER = ['unresponsive', 'no_sol', 'login', 'shell', 'booting', 'setup', 'unreachable']
+
+
+def console_state(trigger):
+    """ How the console was found, given the trigger of the prompt it showed. """
+    return CONSOLE_STATES.get(trigger, 'setup')
+
+
+def run_probe(node_opts, workers):
+    """ Probe many APICs at once using a bounded pool of worker threads.
+
+    Returns:
+        list: The result of each node (see ProvisionApic.probe), in the order of node_opts.
+    """
+    # Imported here so --help and reading a report do not wait on paramiko
+    from provisioner import ProbeApic
+    results = [None] * len(node_opts)
+    remaining = list(enumerate(node_opts))
+    remaining_lock = threading.Lock()
+
+    def worker():
+        while True:
+            with remaining_lock:
+                if not remaining:
+                    return
+                index, opts = remaining.pop(0)
+            # Only the result of each APIC is shown
+            pa = ProbeApic(dict(opts, quiet='True'))
+            results[index] = pa.probe()
+            print("{0}{1}".format(opts.get('log_prefix', ''), describe(results[index])))
+
+    threads = [threading.Thread(target=worker) for _ in range(min(workers, len(node_opts)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    # Join with a timeout so a ctrl-c still reaches the main thread
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(1)
+    # Serial Over LAN found configured is remembered for the provisioning run
+    if node_opts:
+        ProbeApic(node_opts[0]).cache.save()
+    return results
+
+
+def describe(result):
+    if result['error']:
+        return "{0}: {1}".format(result['console'], result['error'])
+    if result['prompt']:
+        return "{0} ({1})".format(result['console'], result['prompt'])
+    return result['console']
+
+
+def write_report(path, results):
+    with open(path, 'w') as report_file:
+        json.dump(results, report_file, indent=2)
+
+
+def load_report(path):
+    """ Read a probe report.
+
+    Returns:
+        dict: The CIMC ip address of each node mapped to its result.
+    """
+    with open(path) as report_file:
+        return dict((result['cimc_ip'], result) for result in json.load(report_file))
+
+
+def apply_report(node_opts, path):
+    """ Order the nodes by how much they have to do and tell each one how its console was found.
+
+    Returns:
+        list: The option dictionaries, the nodes the probe did not see keep their place after the
+            others.
+    """
+    try:
+        report = load_report(path)
+    except (IOError, ValueError, KeyError), err:
+        print("Unable to read the probe report '{0}': {1}".format(path, err))
+        sys.exit(-1)
+    ranks = dict((console, rank) for rank, console in enumerate(PROBE_ORDER))
+    for opts in node_opts:
+        result = report.get(opts['cimc_ip'])
+        if result is not None:
+            opts['probe_console'] = result['console'].encode('utf-8')
+    # sorted is stable, so the inventory order is kept within each rank
+    return sorted(node_opts, key=lambda opts: ranks.get(opts.get('probe_console'),
+                                                        len(PROBE_ORDER)))
+
+
+def main(argv):
+    # Imported here, wiper imports this module
+    from wiper import parse_args, resolve_options
+    args = parse_args(argv)
+    report_path, args.probe_report = args.probe_report, None
+    node_opts = resolve_options(args)
+    # A probe takes seconds rather than minutes, more of them are run at once by default
+    workers = int(node_opts[0].get('workers') or 50)
+    print("Probing {0} APICs using up to {1} workers.".format(len(node_opts), workers))
+    results = run_probe(node_opts, workers)
+    if report_path is not None:
+        write_report(report_path, results)
+    counts = {}
+    for result in results:
+        counts[result['console']] = counts.get(result['console'], 0) + 1
+    print(', '.join('{0} {1}'.format(counts[console], console)
+                    for console in PROBE_ORDER if console in counts))
+    return 0
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+# wiper - the APIC provisioner
+#
+# Copyright (C) 2015 Cisco Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+"""
+Recognize console prompts without rescanning everything the console has printed.
+
+paramiko-expect matches every prompt regex against the whole output received so far on every read,
+so while an APIC reboots for 10 minutes each read gets slower.  A PromptClassifier compiles all of
+the prompts into one regex with a named group per prompt, and a PromptScanner only searches the
+newly received data plus a small window of what came before it.
+"""
+
+# Standard Library imports
+import re
+import threading
+
+# Local imports
+from states import CONSOLE_PROMPTS, POWER_CYCLE_PROMPTS
+
+# How much of the previous output is searched again with new data, prompts longer than this can not
+# be recognized when they are split across reads.
+WINDOW_SIZE = 512
+
+
+class PromptClassifier(object):
+    """ A compiled set of prompts, safe to share between threads.
+
+    Prompts are written the way paramiko-expect expects them, a leading '.*' is dropped and a
+    trailing '.*' means the prompt may be followed by more output, otherwise the prompt has to be at
+    the very end of the output.
+
+    Args:
+        prompts (list): A list of (regex, result) tuples, the result is what a scanner returns when
+            the regex matches.
+    """
+    def __init__(self, prompts):
+        self.results = [result for _, result in prompts]
+        self.patterns = [prompt for prompt, _ in prompts]
+        groups = []
+        for index, (prompt, _) in enumerate(prompts):
+            if prompt.startswith('.*'):
+                prompt = prompt[2:]
+            if prompt.endswith('.*') and not prompt.endswith(r'\.*'):
+                prompt = prompt[:-2]
+            else:
+                prompt += '$'
+            groups.append('(?P<p{0}>{1})'.format(index, prompt))
+        self.regex = re.compile('|'.join(groups))
+
+    def __repr__(self):
+        # Shown when a prompt is logged, see ProvisionApic.send_and_classify
+        return 'PromptClassifier({0!r})'.format(self.patterns)
+
+    def scanner(self):
+        return PromptScanner(self)
+
+    def describe(self, result):
+        """ A readable name for a result, the trigger it fires or the prompt that matched. """
+        if isinstance(result, basestring):
+            return result
+        return self.patterns[self.results.index(result)]
+
+
+class PromptScanner(object):
+    """ Feed console output to a PromptClassifier as it is received. """
+    __slots__ = ('classifier', 'tail', 'offset', 'match_start')
+
+    def __init__(self, classifier):
+        self.classifier = classifier
+        self.tail = ''
+        # The stream position of the first character of tail
+        self.offset = 0
+        # The stream position of the prompt that was recognized
+        self.match_start = None
+
+    def feed(self, data):
+        """ Search newly received data for a prompt.
+
+        When several prompts are in the data the last one wins, it is where the console is now.
+
+        Returns:
+            The result paired with the prompt that matched or None.
+        """
+        text = self.tail + data
+        last = None
+        for match in self.classifier.regex.finditer(text):
+            last = match
+        if last is not None:
+            self.match_start = self.offset + last.start()
+            return self.classifier.results[int(last.lastgroup[1:])]
+        if len(text) > WINDOW_SIZE:
+            self.offset += len(text) - WINDOW_SIZE
+            text = text[-WINDOW_SIZE:]
+        self.tail = text
+        return None
+
+
+class CimcPrompts(object):
+    """ The CLI prompts of one CIMC, built from the name it gives itself (C220-FCH1234V5WX).
+
+    Args:
+        hostname (str): The name in the CIMC prompt, any name is matched when it is None.
+    """
+    __slots__ = ('hostname', 'any', 'top', 'sol', 'sol_needs_commit', 'chassis')
+
+    def __init__(self, hostname=None):
+        self.hostname = hostname
+        name = re.escape(hostname) if hostname else r'\S+'
+        self.any = r'.*{0}.*# '.format(name)
+        self.top = r'{0}.*# '.format(name)
+        self.sol = r'{0} /sol # '.format(name)
+        self.sol_needs_commit = r'{0} /sol \*# '.format(name)
+        self.chassis = r'{0} /chassis # '.format(name)
+
+
+def cimc_hostname(output):
+    """ Get the name CIMC gives itself in its prompt, from the output ending with the prompt.
+
+    Returns:
+        str: The hostname or None if the output does not end with a CIMC prompt.
+    """
+    match = re.search(r'(\S+?)(?: /\S+)? ?\*?# ?$', output.rstrip('\n'))
+    if match is None:
+        return None
+    return match.group(1)
+
+
+_CLASSIFIERS = {}
+_CLASSIFIERS_LOCK = threading.Lock()
+
+
+def classifier_for(prompts):
+    """ Get the classifier for a prompt or list of prompts, the result of each prompt is its index.
+
+    The classifiers are cached so the same list of prompts is only compiled once.
+    """
+    if isinstance(prompts, basestring):
+        prompts = [prompts]
+    key = tuple(prompts)
+    with _CLASSIFIERS_LOCK:
+        if key not in _CLASSIFIERS:
+            _CLASSIFIERS[key] = PromptClassifier([(prompt, index)
+                                                  for index, prompt in enumerate(prompts)])
+        return _CLASSIFIERS[key]
+
+
+# The APIC console prompts classified straight to the trigger to fire
+CONSOLE_CLASSIFIER = PromptClassifier(CONSOLE_PROMPTS)
+POWER_CYCLE_CLASSIFIER = PromptClassifier(POWER_CYCLE_PROMPTS)
@@ -0,0 +1,1241 @@
+#!/usr/bin/env python
+
+# wiper - the APIC provisioner
+#
+# Copyright (C) 2015 Cisco Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+"""
+The state machine that provisions an APIC through the consoles of its CIMC.
+
+This is kept apart from the command line handling in wiper.py so that paramiko is only imported once
+there is an APIC to provision, wiper --help and checking the options do not wait on it.
+"""
+
+# Standard Library imports
+import logging
+import os
+import re
+import socket
+import sys
+import threading
+import time
+
+# Third party imports
+import paramiko
+from paramikoe import SSHClientInteraction
+
+# Local imports
+from archive import archive_for
+from batch import BatchClassifier, batch_allowed, lockstep_only, verify_batch
+from cache import load_cache
+from checkpoint import CHECKPOINT_DIR, Checkpoint
+from cimcapi import CimcApiError, cli_only, xml_api_for
+from connection import CimcConnection
+from drift import SHOW_SETUP_CONFIG, describe_drift, setup_drift
+from events import event_log_for
+from console import ConsoleReader
+from retry import retry_policies
+from scheduler import FleetScheduler
+from probe import console_state
+from prompts import (CONSOLE_CLASSIFIER, POWER_CYCLE_CLASSIFIER, CimcPrompts, PromptClassifier,
+                     cimc_hostname, classifier_for)
+from states import LOGIN_TRIGGERS, StateMachine
+from timing import BootProgress, load_history, model_from_prompt
+from transcript import RecordingChannel, TranscriptWriter
+from typeahead import SetupAnswers
+
+
+class WiperApicInteract(SSHClientInteraction):
+    def __init__(self, client, **kwargs):
+        if 'timeout' not in kwargs or kwargs['timeout'] is None:
+            kwargs['timeout'] = 60
+        if 'newline' not in kwargs or kwargs['newline'] is None:
+            kwargs['newline'] = '\r'
+        if 'buffer_size' not in kwargs or kwargs['buffer_size'] is None:
+            kwargs['buffer_size'] = 1024
+        if 'display' not in kwargs or kwargs['display'] is None:
+            kwargs['display'] = False
+        if 'conn_type' not in kwargs or kwargs['conn_type'] is None:
+            self.conn_type = ''
+        else:
+            self.conn_type = kwargs['conn_type']
+        # Called with the conn_type and each read of console output, instead of the synchronous
+        # write to stdout display makes
+        self.echo = kwargs.get('echo')
+        SSHClientInteraction.__init__(self, client, kwargs['timeout'],
+                                      kwargs['newline'], kwargs['buffer_size'],
+                                      kwargs['display'])
+        for recorder in (kwargs.get('transcript'), kwargs.get('archive')):
+            if recorder is not None:
+                self.channel = RecordingChannel(self.channel, recorder, self.conn_type)
+        # All reads go through here so only the tail of the console output is kept in memory
+        self.reader = ConsoleReader(self.channel, min_read=self.buffer_size)
+
+    def classify(self, classifier, timeout=None, progress=None):
+        """ Read output until one of the prompts of a classifier is seen.
+
+        Unlike expect, only the newly received output is searched on each read and only the tail of
+        the output is kept in current_output.
+
+        Args:
+            classifier (PromptClassifier): The prompts to look for.
+            timeout (int): The time to wait before timing out.
+            progress (BootProgress): Follows a reboot through the output, the wait is cut short
+                when the reboot stalls.
+
+        Raises:
+            socket.timeout: No prompt was seen in time.
+
+        Returns:
+            The result paired with the prompt that was seen.
+        """
+        if timeout is not None:
+            self.channel.settimeout(timeout)
+        else:
+            timeout = self.channel.gettimeout()
+        scanner = classifier.scanner()
+        self.reader.clear()
+        received = 0
+        try:
+            while True:
+                if progress is not None:
+                    remaining = progress.remaining()
+                    if remaining <= 0:
+                        raise socket.timeout("The reboot stalled")
+                    self.channel.settimeout(min(timeout, remaining))
+                buffer = self.reader.read()
+                if self.reader.closed:
+                    raise socket.error("The {0} session was closed".format(self.conn_type))
+                if self.echo is not None:
+                    self.echo(self.conn_type, buffer)
+                elif self.display:
+                    sys.stdout.write(buffer)
+                    sys.stdout.flush()
+                received += len(buffer)
+                if progress is not None:
+                    progress.feed(buffer)
+                result = scanner.feed(buffer)
+                if result is not None:
+                    break
+        finally:
+            self.current_output = self.reader.output()
+        # Like expect, the clean output has neither the command that was sent nor the prompt
+        tail_start = received - len(self.current_output)
+        self.current_output_clean = self.current_output[:max(scanner.match_start - tail_start, 0)]
+        if self.current_send_string:
+            self.current_output_clean = self.current_output_clean.replace(
+                self.current_send_string + '\n', '')
+        self.current_send_string = ''
+        return result
+
+
+class ProvisionApic(StateMachine):
+    """ The provisioning of a single APIC.
+
+    The states and transitions are shared by every instance (see states.py), an instance only holds
+    the setup answers and the sessions of its own APIC.
+
+    Args:
+        opts (dict): The options for the APIC.
+        clock: Where the time comes from and how to sleep, replay.py passes a virtual clock.
+        connection_factory: Called like CimcConnection to get the connection to CIMC.
+        history (StateHistory): The history to size waits from, instead of the history file.
+        cache (CimcCache): The known good CIMCs, instead of the cache file.
+        fleet_node (FleetNode): The APIC in the fleet scheduler, used to start the setup script only
+            once APIC1 of the fabric has finished it.
+        checkpoint (Checkpoint): Where the progress is kept, instead of the checkpoint directory.
+        metrics (MetricsRecorder): The recorder of the run when --metrics is used, see metrics.py.
+
+    With --waves, opts['wave'] is set by run_waves: in the 'erase' wave the reboot is started and the
+    sessions are closed without waiting on it, in the 'configure' wave the APIC is expected to be
+    rebooting or waiting in the setup script already.
+    """
+    __slots__ = (
+        'cimc', 'cimc_username', 'cimc_password', 'cimc_port', 'apic_password', 'verbose', 'quiet',
+        'simulator', 'fabric_name', 'num_controllers', 'controller_id', 'controller_name',
+        'tep_address_pool', 'infra_vlan_id', 'bd_mc_address_pool', 'oob_ip_addr', 'oob_def_gw',
+        'int_speed', 'strong_passwd', 'separate_transports', 'type_ahead', 'log_prefix',
+        'connection', 'cimc_client', 'apic_client', 'cimc_interact', 'apic_interact',
+        'provided_fabric_name', 'clock', 'connection_factory', 'history', 'hardware_model',
+        'state_started', 'cache', 'host_key_fingerprint', 'cimc_prompts', 'sol_from_cache',
+        'transcript', 'metrics', 'retries', 'sol_retry', 'fleet_node',
+        'wave', 'checkpoint', 'resumed', 'last_prompt', 'probed', 'if_changed', 'events', 'echo',
+        'archive', 'xml_api', 'batch_cimc',
+    )
+
+    def __init__(self, opts, clock=time, connection_factory=CimcConnection, history=None,
+                 cache=None, fleet_node=None, checkpoint=None, metrics=None):
+        self.cimc = opts['cimc_ip']
+        self.cimc_username = opts['cimc_username']
+        self.cimc_password = opts['cimc_password']
+        self.cimc_port = int(opts.get('cimc_port') or 22)
+        self.apic_password = opts['apic_admin_password']
+        if opts['verbose'] == "True":
+            self.verbose = True
+        else:
+            self.verbose = False
+        if opts['quiet'] == 'True':
+            self.quiet = True
+        else:
+            self.quiet = False
+        if opts['simulator'] == True:
+            self.simulator = True
+        else:
+            self.simulator = False
+        self.fabric_name = opts['fabric_name']
+        self.num_controllers = opts['number_of_controllers']
+        self.controller_id = opts['controller_number']
+        self.controller_name = opts['controller_name']
+        self.tep_address_pool = opts['tep_address_pool']
+        self.infra_vlan_id = opts['infra_vlan_id']
+        self.bd_mc_address_pool = opts['bd_mc_addresses']
+        self.oob_ip_addr = opts['oob_ip_address']
+        self.oob_def_gw = opts['oob_default_gateway']
+        self.int_speed = opts['int_speed']
+        self.strong_passwd = opts['strong_passwords']
+        self.separate_transports = opts.get('separate_transports') == 'True'
+        # Answer the setup script ahead of its questions, see typeahead.py
+        self.type_ahead = opts.get('type_ahead') == 'True'
+        # Leave an APIC that already has the wanted setup configuration alone, see drift.py
+        self.if_changed = opts.get('if_changed') == 'True'
+        # Prepended to every message so concurrent nodes can be told apart in fleet mode
+        self.log_prefix = opts.get('log_prefix', '')
+        # The ssh transport(s) to CIMC, both of the clients below come from here
+        self.connection = None
+        # Used to execute commands in CIMC
+        self.cimc_client = None
+        # Used to do things on the APIC, has to go through CIMC first of course
+        self.apic_client = None
+        self.cimc_interact = None
+        self.apic_interact = None
+        self.provided_fabric_name = False
+        self.clock = clock
+        self.connection_factory = connection_factory
+        # How long each state took on earlier runs, used to size the long waits
+        self.history = history or load_history(opts.get('history_file'))
+        self.hardware_model = 'unknown'
+        self.state_started = clock.time()
+        # What earlier runs found on this CIMC, the SOL check is skipped when it is known good
+        self.cache = cache or load_cache(opts)
+        self.host_key_fingerprint = None
+        self.cimc_prompts = CimcPrompts()
+        self.sol_from_cache = False
+        # Everything sent and received on the consoles is written here when --record is used
+        self.transcript = None
+        if opts.get('record'):
+            self.transcript = TranscriptWriter(os.path.join(opts['record'],
+                                                            self.cimc + '.jsonl'), opts, clock)
+        # The compressed and indexed console archive when --archive is used, see archive.py
+        self.archive = None
+        if archive_for(opts) is not None:
+            self.archive = archive_for(opts).open(opts)
+        # Shared by every node of the run when --metrics is used, otherwise None
+        self.metrics = metrics
+        # How each operation is retried, see retry.py
+        self.retries = retry_policies(opts.get('retry'))
+        # The SOL checks made so far, they are shared by check_sol and configure_sol
+        self.sol_retry = None
+        # Serial Over LAN and power are controlled with the CIMC XML API when --xml-api is used,
+        # see cimcapi.py
+        self.xml_api = xml_api_for(opts)
+        # Type the CIMC command blocks ahead in one write, see batch.py
+        self.batch_cimc = opts.get('batch_cimc') == 'True'
+        self.fleet_node = fleet_node
+        # 'erase' or 'configure' when the fleet is provisioned in waves, see run_waves
+        self.wave = opts.get('wave')
+        # How far this APIC got, see checkpoint.py
+        self.checkpoint = checkpoint or Checkpoint(opts.get('checkpoint_dir') or CHECKPOINT_DIR,
+                                                   self.cimc, clock)
+        # The checkpoint of an earlier run that was interrupted, if it is resumed
+        self.resumed = None
+        if opts.get('no_resume') != 'True':
+            self.resumed = self.checkpoint.load()
+        # The last prompt seen on the APIC console
+        self.last_prompt = None
+        # Where wiper probe found the console, see probe.py
+        self.probed = opts.get('probe_console')
+        # The messages, states and console output of the node when --event-log is used, see
+        # events.py
+        self.events = event_log_for(opts)
+        if self.events is not None:
+            self.events.open(self.cimc, [self.cimc_password, self.apic_password])
+        # Whether the console output is echoed to stdout, a single APIC run with --verbose echoes
+        # it like it always has
+        echo = opts.get('echo_console') or ''
+        self.echo = (echo == 'all' or self.cimc in echo.split(',') or
+                     (self.verbose and not self.log_prefix))
+        StateMachine.__init__(self, initial='start')
+
+    def on_enter_connect_cimc(self):
+        prompt = self.cimc_prompts.any
+        self.connection = self.connection_factory(self.cimc, self.cimc_username,
+                                                  self.cimc_password, port=self.cimc_port,
+                                                  separate_transports=self.separate_transports)
+
+        retry = self.retries['connect_cimc'].start(self.clock)
+        while True:
+            try:
+                self.log("Connecting to {0} as user {1} for CIMC and APIC control.".format(
+                    self.cimc, self.cimc_username), print_only=True)
+                self.cimc_client, self.apic_client = self.connection.connect()
+                break
+            except paramiko.ssh_exception.PasswordRequiredException, err:
+                print("{0}Unable to connect to CIMC - Password is required because: {1}".format(
+                    self.log_prefix, err))
+                sys.exit(-1)
+            except (paramiko.AuthenticationException, paramiko.BadHostKeyException):
+                # Trying again would not change anything
+                raise
+            except (socket.error, EOFError, paramiko.SSHException), err:
+                self.connection.close()
+                if not self.wait_to_retry(retry, "Unable to connect to CIMC ({0!r})".format(err)):
+                    raise
+
+        self.cimc_interact = WiperApicInteract(self.cimc_client, timeout=10, conn_type='cimc',
+                                               transcript=self.transcript,
+                                               archive=self.archive, echo=self.echo_callback())
+        self.cimc_interact.send('\n')
+
+        try:
+            self.apic_interact = WiperApicInteract(self.apic_client, timeout=10,
+                                                   conn_type='apic', transcript=self.transcript,
+                                                   archive=self.archive,
+                                                   echo=self.echo_callback())
+        except paramiko.SSHException, err:
+            self.log("CIMC refused a second session ({0}), connecting again for ".format(err) +
+                     "APIC control.", print_only=True)
+            self.apic_client = self.connection.connect_second_transport()
+            self.apic_interact = WiperApicInteract(self.apic_client, timeout=10,
+                                                   conn_type='apic', transcript=self.transcript,
+                                                   archive=self.archive,
+                                                   echo=self.echo_callback())
+        self.apic_interact.send('\n')
+
+        try:
+            self.cimc_interact.classify(classifier_for(prompt), timeout=10)
+            self.hardware_model = model_from_prompt(self.cimc_interact.current_output)
+            self.cimc_prompts = CimcPrompts(cimc_hostname(self.cimc_interact.current_output))
+            self.clear_interact_output(self.cimc_interact)
+            self.apic_interact.classify(classifier_for(prompt), timeout=10)
+            self.clear_interact_output(self.apic_interact)
+
+        except:
+            print("{0}Failed to detect CIMC prompt using '{1}'".format(self.log_prefix, prompt))
+            raise
+
+        self.host_key_fingerprint = self.connection.host_key_fingerprint()
+        # A transcript always records the full walk so it can be replayed without the cache
+        if self.transcript is None:
+            entry = self.cache.get(self.cimc, self.host_key_fingerprint)
+            self.sol_from_cache = bool(entry and entry.get('sol_configured') and
+                                       entry.get('hostname') == self.cimc_prompts.hostname)
+
+    def on_enter_check_sol(self):
+        if self.sol_from_cache:
+            self.log("Serial Over LAN was found configured on an earlier run, not checking it " +
+                     "again.", print_only=True)
+            return
+        self.log("Ensuring Serial Over LAN is configured properly.", print_only=True)
+        if self.read_sol():
+            self.log("Serial Over LAN is configured.", print_only=True)
+            return
+        # It is configured straight away the first time, the attempts after that are limited
+        if self.sol_retry is None:
+            self.sol_retry = self.retries['check_sol'].start(self.clock)
+        elif not self.wait_to_retry(self.sol_retry, "Serial Over LAN is still not configured"):
+            raise RuntimeError("Serial Over LAN is still not configured after {0} "
+                               "checks".format(self.sol_retry.attempt))
+        self.log("Serial Over LAN is not configured, moving to configure it.", print_only=True)
+        self.sol_not_configured()
+
+    def read_sol(self):
+        """ Check the Serial Over LAN settings of CIMC, without changing them.
+
+        Returns:
+            bool: Whether Serial Over LAN is configured, a CIMC that is gets cached.
+        """
+        sol_configured = self.cimc_api('sol_configured')
+        if sol_configured is None:
+            sol_configured = self.show_sol()
+        if sol_configured:
+            self.cache.update(self.cimc, self.host_key_fingerprint,
+                              hostname=self.cimc_prompts.hostname,
+                              model=self.hardware_model, sol_configured=True)
+        return sol_configured
+
+    def show_sol(self):
+        """ Check the Serial Over LAN settings of CIMC with the show sol command. """
+        prompt = self.cimc_prompts.any
+        retry = self.retries['cimc_command'].start(self.clock)
+        while True:
+            self.do_cmd('show sol', prompt, self.cimc_interact, retry='cimc_command',
+                        resent=retry.attempt > 1)
+            try:
+                sol_list = re.split(r'\s*', self.cimc_interact.current_output_clean.split('\n')[2])
+                sol_enabled, sol_baud, sol_com = sol_list[0], sol_list[1], sol_list[2]
+                break
+            except (KeyError, IndexError):
+                if not self.wait_to_retry(retry, "The command output for 'show sol' was not valid"):
+                    raise RuntimeError("The command output for 'show sol' was not valid")
+        return 'yes' in sol_enabled and '115200' in sol_baud and 'com0' in sol_com
+
+    def on_enter_configure_sol(self):
+        if self.cimc_api('configure_sol'):
+            self.log("Serial Over LAN is configured.", print_only=True)
+            self.sol_config_committed()
+            return
+        sol_prompt = self.cimc_prompts.sol
+        sol_needs_commit_prompt = self.cimc_prompts.sol_needs_commit
+        top_prompt = self.cimc_prompts.top
+        cmds = list()
+        cmds.append(('scope sol', sol_prompt, True, 10))
+        cmds.append(('set baud-rate 115200', sol_needs_commit_prompt, True, 10))
+        cmds.append(('set comport com0', sol_needs_commit_prompt, True, 10))
+        cmds.append(('set enabled yes', sol_needs_commit_prompt, True, 10))
+        cmds.append(('commit', sol_prompt, True, 30))
+        cmds.append(('top', top_prompt, True, 10))
+        confirmed = self.do_batch(cmds, self.cimc_interact)
+        if confirmed is None:
+            self.do_cmds(cmds, self.cimc_interact, retry='cimc_command')
+        elif confirmed < len(cmds):
+            self.log("'{0}' was not confirmed, configuring Serial Over LAN one command at a "
+                     "time.", cmds[confirmed][0], print_only=True)
+            # The scope the batch left CIMC in is not known
+            self.do_cmds([('top', top_prompt, True, 10)] + cmds, self.cimc_interact,
+                         retry='cimc_command')
+        self.log("Serial Over LAN is configured.", print_only=True)
+        self.sol_config_committed()
+
+    def on_enter_connect_apic(self):
+        timeout = 10
+        if self.wave == 'configure':
+            self.wait_for_apic1()
+            # The reboot was started by the erase wave and may still be going, how far along it is
+            # is not known so the whole reboot is allowed for
+            timeout = self.history.deadline(self.hardware_model, 'reboot', 600)
+        reboot_started = self.resumed and self.resumed.get('reboot_started')
+        if reboot_started:
+            self.resumed = None
+            elapsed = self.clock.time() - reboot_started
+            remaining = self.history.deadline(self.hardware_model, 'reboot', 600) - elapsed
+            if remaining > 0:
+                # Waiting on the reboot an earlier run started, rather than starting another one
+                self.log("Resuming: the APIC has been rebooting for {0:.0f} seconds, ".format(
+                    elapsed) + "waiting for it to come up.", print_only=True)
+                timeout = max(int(round(remaining)), 10)
+        # The probe only tells where the console was before the first connection
+        probed, self.probed = self.probed, None
+        if probed == 'booting' and timeout == 10:
+            timeout = self.history.deadline(self.hardware_model, 'reboot', 600)
+            self.log("The probe found the APIC booting, waiting for it to come up.",
+                     print_only=True)
+        # connect to the APIC console and send a newline
+        try:
+            self.log("Trying to connect to the APIC console via Serial Over LAN, " +
+                     "using a timeout of {0} seconds.".format(timeout), print_only=True)
+            # When we see one of the console prompts we transition to the state for it.
+            trigger = self.do_cmd("connect host\n", CONSOLE_CLASSIFIER, self.apic_interact,
+                                  clear_outputs=True, timeout=timeout)
+        except socket.timeout:
+            trigger = None
+        if self.wave == 'erase' and trigger is not None and trigger not in LOGIN_TRIGGERS:
+            self.log("The APIC is already in the setup script, leaving it for the configure " +
+                     "wave.", print_only=True)
+            return
+        # A console that missed the newline is nudged with another one, that is far cheaper than
+        # a power cycle, unless the probe already found it unresponsive
+        retry = self.retries['connect_apic'].start(self.clock)
+        if trigger is None and probed == 'unresponsive':
+            self.log("The probe found the APIC console unresponsive as well, not trying again.",
+                     print_only=True)
+            retry = None
+        while trigger is None and retry is not None and self.wait_to_retry(
+                retry, "No prompt seen from the APIC"):
+            try:
+                trigger = self.do_cmd('', CONSOLE_CLASSIFIER, self.apic_interact, resent=True)
+            except socket.timeout:
+                pass
+        if trigger is None:
+            if self.sol_from_cache:
+                # Serial Over LAN may have been changed since it was cached, check it this time
+                self.log("No prompt seen from the APIC, checking Serial Over LAN after all.")
+                self.sol_from_cache = False
+                self.cache.invalidate(self.cimc)
+                self.recheck_sol()
+                self.connect_to_apic()
+                return
+            # Unable to connect to CIMC, try to power cycle the host
+            self.log("No prompt seen from the APIC, will try to power cycle the host.")
+            self.cycle_host()
+            return
+        if trigger not in LOGIN_TRIGGERS:
+            # The console is already in the setup script, APIC1 still answers it first
+            self.wait_for_apic1()
+        # Transition to the state needed by the prompt we get back.
+        getattr(self, trigger)()
+
+    def on_enter_cycle_host(self):
+        # If you connect to the APIC via KVM and start the initial setup script, the console (ttyS0)
+        # is no longer connected/updating.  So we have to cycle the host to recover.
+        chassis_prompt = self.cimc_prompts.chassis
+        power_cycle_prompt = r'.*Do you want to continue\?\[.*\].*'
+        top_prompt = self.cimc_prompts.top
+        cmds = list()
+        cmds.append(('scope chassis', chassis_prompt, True, 10))
+        cmds.append(('power cycle', power_cycle_prompt, True, 10))
+        cmds.append(('y', chassis_prompt, True, 10))
+        cmds.append(('top', top_prompt, True, 10))
+        self.checkpoint.update(reboot_started=self.clock.time())
+        if self.cimc_api('power_cycle'):
+            self.log("Power cycled the APIC with the CIMC XML API.", print_only=True)
+        else:
+            self.log("Sending APIC power cycle commands to CIMC.", print_only=True)
+            confirmed = self.do_batch(cmds, self.cimc_interact)
+            if confirmed is None:
+                self.do_cmds(cmds, self.cimc_interact)
+            elif confirmed < 3:
+                self.log("The power cycle was not confirmed, sending it one command at a time.",
+                         print_only=True)
+                self.do_cmds([('top', top_prompt, True, 10)] + cmds, self.cimc_interact)
+            elif confirmed < len(cmds):
+                # The host is power cycling, it must not be cycled again
+                self.do_cmds([('top', top_prompt, True, 10)], self.cimc_interact)
+        if self.wave == 'erase':
+            self.log("The APIC is rebooting, the configure wave will wait for it.",
+                     print_only=True)
+            return
+        # hopefully we would only end up at press any key, not sure how we end up in the others
+        # after no response from the APIC.
+        progress = BootProgress(self.history, self.hardware_model, log=self.log,
+                                clock=self.clock)
+        self.log("Waiting on a power cycle for up to {0} seconds.".format(progress.timeout),
+                 print_only=True)
+        try:
+            trigger = self.apic_interact.classify(POWER_CYCLE_CLASSIFIER, timeout=600,
+                                                  progress=progress)
+        except socket.timeout:
+            print "{0}Unable to get a response from the controller after a power cycle.".format(
+                self.log_prefix)
+            print "{0}Please verify that the controller software is installed correctly".format(
+                self.log_prefix)
+            print "{0}and that the controller boots up fine.".format(self.log_prefix)
+            raise
+        progress.finish()
+        self.checkpoint.update(reboot_started=None)
+        getattr(self, trigger)()
+
+    def on_enter_disconnect_cimc(self):
+        self.log("Disconnecting from both CIMC and the APIC by closing the connections.",
+                 print_only=True)
+        self.connection.close()
+        self.cimc_client = self.apic_client = None
+        if self.transcript is not None:
+            self.transcript.close()
+
+    def on_enter_logout_apic(self):
+        prompt = r'.*login:.*'
+        self.log("Found a CLI prompt on the APIC, logging out.", print_only=True)
+        self.do_cmd("exit", prompt, self.apic_interact)
+        self.apic_login_detected()
+
+    def on_enter_login_apic(self):
+        prompts = [
+            r'.*Password:.*',
+            r'.*~> .*',
+        ]
+        self.log("Found a login prompt on the APIC, logging in as 'rescue-user'.", print_only=True)
+        index = self.do_cmd('rescue-user', prompts, self.apic_interact)
+        if index == 0:
+            # Typically this would be APIC1
+            prompt = r'.*~> .*'
+            self.log("Rescue-user was prompted for a password, sending the APIC admin password.",
+                     print_only=True)
+            # We need some extra time here because we may have just booted.
+            timeout = self.history.deadline(self.hardware_model, 'login_apic', 60)
+            self.do_cmd(self.apic_password, prompt, self.apic_interact, timeout=timeout)
+            self.apic_prompt_detected()
+        elif index == 1:
+            self.log("Found a CLI prompt on the apic.", print_only=True)
+            self.apic_prompt_detected()
+        else:
+            raise ValueError("Index was invalid, this should never happen")
+
+    def on_enter_password_login_apic(self):
+        prompt = r'.*login:.*'
+        self.log("Login was already started, sending ctrl-d to start over.", print_only=True)
+        # Send a control-d (EOF) to start the login process over.
+        self.do_cmd(chr(4), prompt, self.apic_interact)
+        self.apic_login_detected()
+
+    def on_enter_eraseconfig(self):
+        if self.if_changed and self.setup_matches():
+            return
+        prompt = (r'.*Do you want to cleanup the initial setup data\? The system will be ' +
+                  r'REBOOTED. \(Y/n\):.*')
+        self.log("Sending 'eraseconfig setup' command to the APIC", print_only=True)
+        self.do_cmd('eraseconfig setup', prompt, self.apic_interact)
+        self.checkpoint.update(reboot_started=self.clock.time())
+        if self.wave == 'erase':
+            self.log("Sending 'Y' to continue with the eraseconfig setup, the configure wave " +
+                     "will wait for the reboot.", print_only=True)
+            self.apic_interact.send('Y')
+            return
+        prompt = r'.*Press any key to continue....*'
+        progress = BootProgress(self.history, self.hardware_model, log=self.log,
+                                clock=self.clock)
+        self.log("Sending 'Y' to continue with the eraseconfig setup, will wait for the reboot, " +
+                 "timeout is {0} seconds.".format(progress.timeout), print_only=True)
+        self.do_cmd('Y', prompt, self.apic_interact, timeout=600, progress=progress)
+        progress.finish()
+        self.checkpoint.update(reboot_started=None)
+        self.press_any_key()
+
+    def setup_matches(self):
+        """ Compare the setup configuration of the APIC with the options, see drift.py.
+
+        Returns:
+            bool: True when they match, the APIC is logged out of and left as it is.
+        """
+        self.log("Reading the setup configuration of the APIC.", print_only=True)
+        self.do_cmd(SHOW_SETUP_CONFIG, r'.*~> .*', self.apic_interact)
+        drift = setup_drift(self, self.apic_interact.current_output)
+        if drift:
+            for line in describe_drift(drift):
+                self.log(line, print_only=True)
+            return False
+        self.log("The APIC already has the wanted setup configuration, not wiping it.",
+                 print_only=True)
+        self.do_cmd('exit', r'.*login:.*', self.apic_interact)
+        if self.fleet_node is not None:
+            self.fleet_node.setup_finished()
+        return True
+
+    def on_enter_press_any_key(self):
+        prompt = r'.*Enter the fabric name \[.*\]:.*'
+        self.wait_for_apic1()
+        self.log("Starting the setup script on the APIC.", print_only=True)
+        # May need to wrap this in a try/except for socket.timeout if someone is able to catch
+        # steal the I/O on KVM before we get started, seems like a very unlikely thing to have
+        # happen though
+        self.do_cmd("", prompt, self.apic_interact)
+        if self.type_ahead:
+            self.type_ahead_setup()
+        else:
+            self.enter_fabric_name()
+
+    def on_enter_answer_setup(self):
+        answers = SetupAnswers(self)
+        self.log("Answering the setup script ahead of its questions on the APIC.", print_only=True)
+        self.provided_fabric_name = True
+        for step_answers, prompts, timeout in answers.steps():
+            index = self.do_cmd(self.apic_interact.newline.join(step_answers), prompts,
+                                self.apic_interact, timeout=timeout)
+            if index == len(prompts) - 1:
+                break
+        mismatched = answers.mismatches(self.apic_interact.current_output)
+        if mismatched:
+            self.log("The setup script did not take the answers for {0}, answering it again one "
+                     "question at a time.".format(', '.join(mismatched)), print_only=True)
+            self.provided_fabric_name = False
+            self.type_ahead = False
+        self.enter_edit_cfg()
+
+    def on_enter_provide_fabric_name(self):
+        prompt = r'.*Enter the number of controllers in the fabric \(1-9\) \[[0-9]+]:.*'
+        self.log("Setting the fabric name to '{0}' on the APIC.".format(self.fabric_name),
+                 print_only=True)
+        self.do_cmd(self.fabric_name, prompt, self.apic_interact)
+        self.provided_fabric_name = True
+        self.enter_num_ctrlrs()
+
+    def on_enter_provide_number_ctrlrs(self):
+        prompt = r'.*Enter the controller ID \(1-[1-5]\) \[[0-9]+\]:.*'
+        self.log("Setting number of controllers to '{0}' on the APIC.".format(self.num_controllers),
+                 print_only=True)
+        self.do_cmd(self.num_controllers, prompt, self.apic_interact)
+        self.enter_ctrlr_id()
+
+    def on_enter_provide_ctrlr_id(self):
+        prompt = r'.*Enter the controller name \[.*\]:.*'
+        self.log("Setting the controller id to '{0}' on the APIC.".format(self.controller_id),
+                 print_only=True)
+        self.do_cmd(self.controller_id, prompt, self.apic_interact)
+        self.enter_ctrlr_name()
+
+    def on_enter_provide_ctrlr_name(self):
+        prompt = r'.*Enter address pool for TEP addresses \[.*\]:.*'
+        self.log("Setting the controller name to '{0}' on the APIC.".format(self.controller_name),
+                 print_only=True)
+        self.do_cmd(self.controller_name, prompt, self.apic_interact)
+        self.enter_tep_addr_pool()
+
+    def on_enter_provide_tep_addr_pool(self):
+        prompt = r'.*Enter the VLAN ID for infra network \(1-4094\).*:.*'
+        self.log("Setting the TEP Address Pool to '{0}' on the APIC.".format(self.tep_address_pool),
+                 print_only=True)
+        self.do_cmd(self.tep_address_pool, prompt, self.apic_interact)
+        self.enter_infra_vlan_id()
+
+    def on_enter_provide_infra_vlan_id(self):
+        # APICs other than APIC1 go to a different prompt.
+        prompts = [
+            r'.*Enter address pool for BD multicast addresses \(GIPO\) \[.*\]:.*',
+            r'.*Enter the IP address \[.*\].*',
+        ]
+        self.log("Setting the infra VLAN ID to '{0}' on the APIC.".format(self.infra_vlan_id),
+                 print_only=True)
+        index = self.do_cmd(self.infra_vlan_id, prompts, self.apic_interact)
+        if index == 0:
+            self.enter_bd_mc_addr_pool()
+        elif index == 1:
+            self.enter_oob_ip_addr()
+
+    def on_enter_provide_bd_mc_addr_pool(self):
+        prompt = r'.*Enter the IP address \[.*\].*'
+        self.log("Setting the BD Multicast Address Pool to '{0}' on the APIC".format(
+            self.bd_mc_address_pool),
+                 print_only=True)
+        self.do_cmd(self.bd_mc_address_pool, prompt, self.apic_interact)
+        self.enter_oob_ip_addr()
+
+    def on_enter_provide_oob_address(self):
+        prompt = r'.*Enter the IP address of the default gateway \[.*\]:.*'
+        self.log("Setting the Out Of Band IP address to {0} on the APIC.".format(self.oob_ip_addr),
+                 print_only=True)
+        self.do_cmd(self.oob_ip_addr, prompt, self.apic_interact)
+        self.enter_oob_def_gw()
+
+    def on_enter_provide_oob_def_gw(self):
+        prompt = r'.*Enter the interface speed/duplex mode \[.*\]:.*'
+        self.log("Setting the Out Of Band default gateway to {0} ".format(self.oob_def_gw) +
+                 "on the APIC", print_only=True)
+        self.do_cmd(self.oob_def_gw, prompt, self.apic_interact)
+        self.enter_int_speed()
+
+    def on_enter_provide_int_speed(self):
+        prompts = [
+            r'.*Enable strong passwords\? \[.*\]:.*',
+            r'.*Would you like to edit the configuration\? \(y/n\) \[.*\].*',
+        ]
+        self.log("Setting the Out Of Band interface speed/duplex to {0} ".format(self.int_speed) +
+                 "on the APIC.", print_only=True)
+        index = self.do_cmd(self.int_speed, prompts, self.apic_interact)
+        if index == 0:
+            # We are on APIC1
+            self.enter_strong_passwd()
+        elif index == 1:
+            # We are not on APIC1
+            self.enter_edit_cfg()
+        else:
+            # Should never happen
+            raise ValueError("Index can not be {0}".format(index) + " here.")
+
+    def on_enter_provide_strong_passwd(self):
+        prompt = r'.*Enter the password for admin:.*'
+        self.log("Sending '{0}' for enabling strong passwords ".format(self.strong_passwd) +
+                 "on the APIC", print_only=True)
+        self.do_cmd(self.strong_passwd, prompt, self.apic_interact)
+        self.enter_admin_passwd()
+
+    def on_enter_provide_admin_passwd(self):
+        prompts = [
+            r'.*Reenter the password for admin:.*',
+            r'.*Would you like to edit the configuration\? \(y/n\) \[.*\].*',
+        ]
+        self.log("Setting the admin password on the APIC.", print_only=True)
+        index = self.do_cmd(self.apic_password, prompts, self.apic_interact)
+        if index == 0:
+            prompt = r'.*Would you like to edit the configuration\? \(y/n\) \[.*\].*'
+            self.log("Resending the admin password to the APIC.", print_only=True)
+            self.do_cmd(self.apic_password, prompt, self.apic_interact)
+        self.enter_edit_cfg()
+
+    def on_enter_provide_modify_config(self):
+        if self.provided_fabric_name:
+            timeout = self.history.deadline(self.hardware_model, 'provide_modify_config', 60)
+            self.log("Completed a full setup script attempt, waiting for the APIC login prompt " +
+                     "for up to {0} seconds.".format(timeout), print_only=True)
+            self.do_cmd('n', r'.*login:.*', self.apic_interact, timeout=timeout)
+            self.checkpoint.update(setup_finished=True)
+            if self.fleet_node is not None:
+                self.fleet_node.setup_finished()
+        else:
+            prompt = r'.*Enter the fabric name \[.*\]:.*'
+            self.log("Setting the fabric name to '{0}' on the APIC.".format(self.fabric_name),
+                 print_only=True)
+            self.do_cmd('y', prompt, self.apic_interact)
+            self.enter_fabric_name()
+
+    def do_cmds(self, cmd_list, interact, clear_outputs=True, retry=None):
+        """ Do multiple commands in a row
+
+        Each command needs to have its prompt defined.  This does not allow
+        identification of which prompt matched.
+
+        Args:
+            cmd_list (list of tuples):  A list of tuples in the form:
+
+                (cmd, prompt)
+
+            cmd is a string and prompt could be a string or a list of strings.
+
+            retry (str): The retry policy of every command, see do_cmd.
+        """
+        self.log("Sending a bulk set of commands to {0}", interact.conn_type)
+        for cmd_prompt in cmd_list:
+            if len(cmd_prompt) == 2:
+                self.do_cmd(cmd_prompt[0], cmd_prompt[1], interact,
+                            clear_outputs=clear_outputs, retry=retry)
+            elif len(cmd_prompt) == 3:
+                self.do_cmd(cmd_prompt[0], cmd_prompt[1], interact,
+                            clear_outputs=cmd_prompt[2], retry=retry)
+            elif len(cmd_prompt) == 4:
+                self.do_cmd(cmd_prompt[0], cmd_prompt[1], interact,
+                            clear_outputs=cmd_prompt[2], timeout=cmd_prompt[3], retry=retry)
+            else:
+                raise ValueError("Invalid command tuple do_cmds {0}".format(
+                    cmd_prompt))
+
+    def do_batch(self, cmd_list, interact):
+        """ Send a block of CIMC commands in one write and check each of them, see batch.py.
+
+        Args:
+            cmd_list (list of tuples): (cmd, prompt, clear_outputs, timeout) tuples like do_cmds.
+
+        Returns:
+            int: How many of the commands, from the first one on, were confirmed.  The others have
+                to be sent again with do_cmds.  None when the commands were not batched.
+        """
+        if not self.batch_cimc or not batch_allowed(self.cimc):
+            return None
+        prompts = [cmd_prompt[1] for cmd_prompt in cmd_list]
+        self.log("Sending a batch of {0} commands to {1}", len(cmd_list), interact.conn_type)
+        try:
+            self.do_cmd(interact.newline.join(cmd_prompt[0] for cmd_prompt in cmd_list),
+                        BatchClassifier(self.cimc_prompts, prompts), interact,
+                        timeout=sum(cmd_prompt[3] for cmd_prompt in cmd_list))
+        except socket.timeout:
+            pass
+        confirmed = verify_batch(interact.current_output, self.cimc_prompts, prompts)
+        if confirmed < len(cmd_list):
+            lockstep_only(self.cimc)
+        return confirmed
+
+    def do_cmd(self, cmd, prompt, interact, **kwargs):
+        """ Do a command and expect a prompt.
+
+        Args:
+            cmd (str): the command to run
+            prompt (str, list or PromptClassifier): the prompt to expect
+            clear_outputs (bool): TODO
+            timeout (int): The time to wait before timing out the command
+            progress (BootProgress): Follows a reboot the command starts, see classify
+            retry (str): The retry policy (see retry.py) used to send the command again when the
+                prompt is not seen, only for commands that are safe to send twice.  By default
+                the command is not retried.
+            resent (bool): The command is itself another attempt at one that failed, for the
+                metrics.
+
+        Raises:
+            Exception: Could raise an exception on send or expect.
+
+        Returns:
+            int: The index in the prompts list that matched, or the result paired with the prompt
+                that matched for a PromptClassifier.
+        """
+        clear_outputs = kwargs.get('clear_outputs')
+        if clear_outputs is None:
+            clear_outputs = True
+        timeout = kwargs.get('timeout')
+        if timeout is None:
+            timeout = 10
+
+        if not interact:
+            raise RuntimeError("Paramiko-expect interact not initialized yet")
+        if not isinstance(prompt, PromptClassifier):
+            prompt = classifier_for(prompt)
+        retry = None
+        if kwargs.get('retry') is not None:
+            retry = self.retries[kwargs['retry']].start(self.clock)
+        resent = kwargs.get('resent') is True
+        while True:
+            try:
+                return self.send_and_classify(cmd, prompt, interact, clear_outputs, timeout,
+                                              kwargs.get('progress'), resent)
+            except socket.timeout:
+                if retry is None or not self.wait_to_retry(retry, "The prompt was not seen"):
+                    raise
+                resent = True
+
+    def send_and_classify(self, cmd, prompt, interact, clear_outputs, timeout, progress,
+                          resent=False):
+        """ Make a single attempt at a command, see do_cmd. """
+        if clear_outputs is True:
+            self.clear_interact_output(interact)
+        started = self.clock.time()
+        bytes_read = interact.reader.bytes_read
+        try:
+            self.log("Sending cmd: '{0}'", cmd, debug_only=True)
+            interact.send(str(cmd))
+        except:
+            print("{0}Failed to send the command: '{1}'".format(self.log_prefix, cmd))
+            raise
+        matched = None
+        try:
+            self.log("Expecting prompt: '{0}' with a timeout of {1} seconds", prompt, timeout,
+                     debug_only=True)
+            result = interact.classify(prompt, timeout=timeout, progress=progress)
+            matched = prompt.describe(result)
+            if interact is self.apic_interact:
+                self.last_prompt = matched
+            if self.archive is not None:
+                self.archive.mark('prompt', matched, interact.conn_type)
+            return result
+        except socket.timeout:
+            print("{0}Failed to detect the prompt using: '{1}'".format(self.log_prefix,
+                                                                      prompt.patterns))
+            print("{0}current_output: {1}".format(self.log_prefix, interact.current_output))
+            if self.archive is not None:
+                print("{0}The full console output is in {1}".format(self.log_prefix,
+                                                                  self.archive.path))
+            raise
+        finally:
+            if self.metrics is not None:
+                self.metrics.command(self.cimc, self.state, interact.conn_type, matched,
+                                     self.clock.time() - started,
+                                     interact.reader.bytes_read - bytes_read, retry=resent)
+
+    def cimc_api(self, operation):
+        """ Do an operation with the CIMC XML API, see cimcapi.py.
+
+        Args:
+            operation (str): sol_configured, configure_sol or power_cycle.
+
+        Returns:
+            What the operation returns, None when the CLI has to be used instead.
+        """
+        if self.xml_api is None:
+            return None
+        started = self.clock.time()
+        result = None
+        try:
+            result = getattr(self.xml_api, operation)()
+            return result
+        except CimcApiError, err:
+            self.log("The CIMC XML API failed ({0}), using the CLI instead.", err, print_only=True)
+            cli_only(self.cimc)
+            self.xml_api.close()
+            self.xml_api = None
+            return None
+        finally:
+            if self.metrics is not None:
+                self.metrics.command(self.cimc, self.state, 'xml_api',
+                                     operation if result is not None else None,
+                                     self.clock.time() - started, 0)
+
+    def wait_to_retry(self, retry, reason):
+        """ Wait out the backoff before the next attempt at an operation.
+
+        Args:
+            retry (Retry): The attempts made at the operation so far.
+            reason (str): Why the last attempt failed.
+
+        Returns:
+            bool: False when no more attempts are allowed.
+        """
+        delay = retry.next_delay()
+        if delay is None:
+            return False
+        self.log("{0}, trying again in {1:.1f} seconds (attempt {2} of {3}).".format(
+            reason, delay, retry.attempt, retry.policy.attempts), print_only=True)
+        self.clock.sleep(delay)
+        return True
+
+    def state_changing(self):
+        """ Called by the state machine as each state is left to learn how long it took. """
+        now = self.clock.time()
+        if self.state != 'start':
+            self.history.record(self.hardware_model, self.state, now - self.state_started)
+            if self.metrics is not None:
+                self.metrics.state(self.cimc, self.hardware_model, self.state,
+                                   now - self.state_started)
+        self.state_started = now
+
+    def wait_for_apic1(self):
+        """ Wait until APIC1 of the fabric is done with the setup script before answering it here.
+
+        Raises:
+            RuntimeError: APIC1 took longer than two reboots, it has most likely stalled.
+        """
+        if self.fleet_node is None:
+            return
+        # APIC1 is started no later than the other controllers, so it is at most a reboot and its
+        # setup script behind
+        self.fleet_node.wait_for_setup(
+            self.log, timeout=2 * self.history.deadline(self.hardware_model, 'reboot', 600))
+
+    def state_entered(self):
+        """ Called by the state machine as each state is entered to checkpoint the progress. """
+        self.checkpoint.update(state=self.state, prompt=self.last_prompt)
+        if self.events is not None:
+            self.events.emit(self.cimc, 'state', None, state=self.state)
+        if self.archive is not None:
+            self.archive.mark('state', self.state)
+
+    def clear_interact_output(self, interact):
+        if not interact:
+            raise RuntimeError("Paramiko-expect interact not initialized yet")
+        self.log("Clearing interact output for - {0}", interact.conn_type, debug_only=True)
+        interact.current_output = ''
+        interact.current_output_clean = ''
+        interact.reader.clear()
+
+
+    def echo_callback(self):
+        """ What the sessions call with console output, None when nothing is done with it. """
+        if self.echo or self.events is not None:
+            return self.echo_console
+        return None
+
+    def echo_console(self, conn_type, output):
+        if self.events is not None:
+            self.events.emit(self.cimc, 'console', output, conn=conn_type)
+        if self.echo:
+            sys.stdout.write(output)
+            sys.stdout.flush()
+
+    def log(self, message, *args, **kwargs):
+        """ Show a message, it is only formatted with args when it is printed or logged.
+
+        Args:
+            message (str): The message, a format string when args are given.
+            debug_only (bool): Only log the message with --verbose, it is not printed.
+            print_only (bool): Only print the message, it is not logged with --verbose.
+        """
+        debug_only = kwargs.get('debug_only', False)
+        print_only = kwargs.get('print_only', False)
+        if self.events is not None:
+            self.events.emit(self.cimc, 'debug' if debug_only else 'info', message, args)
+        show = not self.quiet and not debug_only
+        debug = self.verbose and not print_only
+        if not show and not debug:
+            return
+        if args:
+            message = message.format(*args)
+        message = self.log_prefix + message
+        if show:
+            print(message)
+        if debug:
+            logging.info(message)
+
+
+class ProbeApic(ProvisionApic):
+    """ Find out where the console of an APIC stands without provisioning it, see probe.py. """
+    __slots__ = ()
+
+    def state_changing(self):
+        # A probe is not a run, how long it took says nothing about the next run
+        pass
+
+    def state_entered(self):
+        # A probe must not replace the checkpoint of a run that was interrupted
+        pass
+
+    def probe(self, timeout=10, listen=2):
+        """ Connect to CIMC and classify the APIC console.
+
+        Args:
+            timeout (int): How long to wait for a console prompt after the wake-up.
+            listen (int): How long to listen to the console before sending the wake-up.
+
+        Returns:
+            dict: The CIMC, how the console was found (see probe.CONSOLE_STATES), the prompt seen,
+                whether Serial Over LAN is configured, the CIMC hostname and model and the error
+                when CIMC could not be reached.
+        """
+        started = self.clock.time()
+        result = {'cimc_ip': self.cimc, 'console': None, 'prompt': None, 'sol_configured': None,
+                  'hostname': None, 'model': None, 'error': None}
+        try:
+            self.to_connect_cimc()
+            result['hostname'] = self.cimc_prompts.hostname
+            result['model'] = self.hardware_model
+            result['sol_configured'] = self.sol_from_cache or self.read_sol()
+            if result['sol_configured']:
+                result['prompt'], result['console'] = self.probe_console(timeout, listen)
+            else:
+                result['console'] = 'no_sol'
+        # SystemExit is caught too, connect_cimc exits when a password is needed
+        except (Exception, SystemExit), err:
+            result['console'] = 'unreachable'
+            result['error'] = repr(err)
+        finally:
+            if self.connection is not None:
+                self.connection.close()
+            if self.xml_api is not None:
+                self.xml_api.close()
+        result['seconds'] = round(self.clock.time() - started, 1)
+        return result
+
+    def probe_console(self, timeout, listen):
+        interact = self.apic_interact
+        interact.send('connect host')
+        try:
+            # A console that is printing on its own may give its state away without the wake-up
+            trigger = interact.classify(CONSOLE_CLASSIFIER, timeout=listen)
+        except socket.timeout:
+            bytes_read = interact.reader.bytes_read
+            interact.send('')
+            try:
+                trigger = interact.classify(CONSOLE_CLASSIFIER, timeout=timeout)
+            except socket.timeout:
+                # A booting APIC keeps printing but has no prompt yet, more than the echo of
+                # the wake-up
+                if interact.reader.bytes_read - bytes_read > 32:
+                    return None, 'booting'
+                return None, 'unresponsive'
+        return trigger, console_state(trigger)
+
+
+def provision(opts, **kwargs):
+    """ Provision one APIC, kwargs are passed on to ProvisionApic.
+
+    Returns:
+        ProvisionApic: The state machine of the APIC once it is done.
+    """
+    pa = ProvisionApic(opts=opts, **kwargs)
+    try:
+        return provision_apic(pa)
+    finally:
+        if pa.events is not None:
+            pa.events.close(pa.cimc)
+        if pa.archive is not None:
+            pa.archive.close()
+        if pa.xml_api is not None:
+            pa.xml_api.close()
+
+
+def provision_apic(pa):
+    """ Take an APIC through the states, see provision. """
+    if pa.resumed and pa.resumed.get('setup_finished'):
+        pa.log("Resuming: the setup script was already completed by an earlier run, there is " +
+               "nothing left to do.", print_only=True)
+        if pa.fleet_node is not None:
+            pa.fleet_node.setup_finished()
+        if pa.wave != 'erase':
+            pa.checkpoint.clear()
+        return pa
+
+    # The start transition automatically moves the state to connect_cimc
+    pa.start()
+    # Once connected to CIMC, use the cimc_prompt_detected transition to move
+    # to the check_sol state, when this returns, we know we can connect to the
+    # apic over serial over LAN.
+    pa.cimc_prompt_detected()
+    # SOL is configured, so move the state to connect_apic via the connect_to_apic transition
+    # this is the heart of the provisioning process.  When this returns, the APIC
+    # should be provisioned.
+    pa.connect_to_apic()
+
+    # If we get here and still have a client, disconnect from it and set it to None (just in case)
+    if pa.cimc_client is not None:
+        pa.to_disconnect_cimc()
+    pa.history.save()
+    pa.cache.save()
+    # The configure wave carries on from the checkpoint of the erase wave
+    if pa.wave != 'erase':
+        pa.checkpoint.clear()
+    return pa
+
+
+def run_fleet(node_opts, workers, metrics=None):
+    """ Provision many APICs at once using a bounded pool of worker threads.
+
+    Nearly all of the time spent provisioning an APIC is spent waiting on a reboot, so running the
+    nodes concurrently brings the wall clock time down to roughly one reboot cycle.  The order they
+    run in and the other limits on them come from the scheduler, see scheduler.py.
+
+    Args:
+        node_opts (list): A list of option dictionaries, one per APIC.
+        workers (int): The maximum number of APICs provisioned at the same time.
+        metrics (MetricsRecorder): The recorder of the run when --metrics is used.
+
+    Returns:
+        dict: The CIMC ip address of each node that failed mapped to the reason it failed.
+    """
+    scheduler = FleetScheduler(workers)
+    for opts in node_opts:
+        scheduler.add(opts)
+    scheduler.close()
+    failures = {}
+    failures_lock = threading.Lock()
+
+    def worker():
+        while True:
+            node = scheduler.next()
+            if node is None:
+                return
+            try:
+                provision(node.opts, fleet_node=node, metrics=metrics)
+            # SystemExit is caught too, a single node bailing out should not stop the fleet
+            except (Exception, SystemExit), err:
+                with failures_lock:
+                    failures[node.cimc] = repr(err)
+                print("{0}Provisioning failed: {1!r}".format(node.opts['log_prefix'], err))
+            finally:
+                node.finished()
+
+    threads = [threading.Thread(target=worker) for _ in range(min(workers, len(node_opts)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    # Join with a timeout so a ctrl-c still reaches the main thread
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(1)
+    return failures
+
+
+def run_waves(node_opts, workers, run=run_fleet, metrics=None):
+    """ Provision a fleet in two waves so that the reboots of every APIC overlap.
+
+    The erase wave connects to each APIC, starts the eraseconfig setup reboot (or a power cycle) and
+    moves on without waiting for it.  The configure wave then connects to each APIC again and
+    answers the setup script as it comes up, so a worker is only held for the minutes a node
+    needs attention rather than for the whole reboot.  The APICs that failed the erase wave are left
+    out of the configure wave.
+
+    Args:
+        node_opts (list): A list of option dictionaries, one per APIC.
+        workers (int): The maximum number of APICs provisioned at the same time.
+        run: Runs a wave like run_fleet does.
+        metrics (MetricsRecorder): The recorder of the run when --metrics is used.
+
+    Returns:
+        dict: The CIMC ip address of each node that failed mapped to the reason it failed.
+    """
+    failures = {}
+    for wave in ('erase', 'configure'):
+        wave_opts = []
+        for opts in node_opts:
+            if opts['cimc_ip'] not in failures:
+                opts = dict(opts)
+                opts['wave'] = wave
+                wave_opts.append(opts)
+        if not wave_opts:
+            break
+        print("Starting the {0} wave for {1} APICs.".format(wave, len(wave_opts)))
+        failures.update(run(wave_opts, workers, metrics=metrics))
+    return failures
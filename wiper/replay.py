@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+
+# wiper - the APIC provisioner
+#
+# Copyright (C) 2015 Cisco Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+"""
+Replay recorded transcripts through ProvisionApic without any hardware.
+
+A transcript recorded with --record is fed back to the real ProvisionApic state machine, console
+reader and prompt matching through stand-in ssh channels.  Time is a virtual clock that jumps to the
+time each recorded event happened, so reboots and read timeouts take no time at all and a full walk
+through the states takes milliseconds.
+
+Everything wiper sends is checked against what was sent when the transcript was recorded, a replay
+that sends something else or keeps waiting where the recording moved on fails with a ReplayError.
+That makes a set of transcripts (an APIC1 and an APIC2/3 walk at least) a quick regression check for
+the state machine and the prompts.
+
+Usage:
+  python replay.py transcripts/10.0.0.1.jsonl transcripts/10.0.0.2.jsonl
+  python replay.py --repeat 100 --profile transcripts/10.0.0.1.jsonl
+"""
+
+# Standard Library imports
+from argparse import ArgumentParser
+import collections
+import cProfile
+import pstats
+import socket
+import sys
+import time
+
+# Local imports
+from cache import CimcCache
+from checkpoint import Checkpoint
+from timing import StateHistory
+from transcript import SECRET, read_transcript
+from provisioner import provision
+
+
+class ReplayError(Exception):
+    """ wiper did something other than what the transcript recorded. """
+
+
+class VirtualClock(object):
+    """ A stand-in for the time module that only moves when told to. """
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def advance_to(self, when):
+        self.now = max(self.now, when)
+
+
+class ReplayChannel(object):
+    """ A stand-in for a paramiko channel that plays back the events of one console. """
+    def __init__(self, conn_type, events, clock):
+        self.conn_type = conn_type
+        self.events = collections.deque(events)
+        self.clock = clock
+        self.timeout = None
+        self.closed = False
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def gettimeout(self):
+        return self.timeout
+
+    def recv_ready(self):
+        return bool(self.events) and self.events[0]['dir'] == 'recv'
+
+    def exit_status_ready(self):
+        return False
+
+    def recv(self, nbytes):
+        if not self.events:
+            raise ReplayError("The {0} transcript ended while wiper was waiting on a prompt".format(
+                self.conn_type))
+        event = self.events[0]
+        if event['dir'] == 'send':
+            raise ReplayError("wiper is waiting on a prompt on {0} where the recording sent "
+                              "{1!r}".format(self.conn_type, event['data']))
+        if event['dir'] == 'timeout':
+            self.events.popleft()
+            self.clock.advance_to(event['t'])
+            raise socket.timeout()
+        self.clock.advance_to(event['t'])
+        data = event['data']
+        if len(data) > nbytes:
+            event['data'] = data[nbytes:]
+            return data[:nbytes]
+        self.events.popleft()
+        return data
+
+    def send(self, data):
+        for index, event in enumerate(self.events):
+            if event['dir'] == 'send':
+                break
+        else:
+            raise ReplayError("wiper sent {0!r} on {1} after the recording stopped sending".format(
+                data, self.conn_type))
+        if data != event['data']:
+            raise ReplayError("wiper sent {0!r} on {1} where the recording sent {2!r}".format(
+                data, self.conn_type, event['data']))
+        del self.events[index]
+        self.clock.advance_to(event['t'])
+        return len(data)
+
+    def sendall(self, data):
+        self.send(data)
+
+    def close(self):
+        self.closed = True
+
+
+class ReplayConnection(object):
+    """ A stand-in for CimcConnection, the first shell opened is CIMC and the second the APIC. """
+    def __init__(self, events, clock):
+        self.channels = collections.deque()
+        for conn_type in ('cimc', 'apic'):
+            self.channels.append(ReplayChannel(
+                conn_type, [event for event in events if event['conn'] == conn_type], clock))
+        self.opened = list(self.channels)
+
+    def connect(self):
+        return self, self
+
+    def connect_second_transport(self):
+        return self
+
+    def invoke_shell(self, *args, **kwargs):
+        return self.channels.popleft()
+
+    def host_key_fingerprint(self):
+        return None
+
+    def close(self):
+        pass
+
+    def unsent(self):
+        """ The commands that were recorded but never sent by the replay. """
+        return [(channel.conn_type, event['data']) for channel in self.opened
+                for event in channel.events if event['dir'] == 'send']
+
+
+def replay(path, verbose=False):
+    """ Replay one transcript.
+
+    Raises:
+        ReplayError: wiper did not do what the transcript recorded.
+
+    Returns:
+        tuple: The ProvisionApic after the replay and the virtual seconds the replay took.
+    """
+    header, events = read_transcript(path)
+    opts = {'verbose': 'False', 'quiet': 'False' if verbose else 'True', 'simulator': 'False'}
+    opts.update(header['opts'])
+    opts['cimc_password'] = opts['apic_admin_password'] = SECRET
+    clock = VirtualClock()
+    connection = ReplayConnection(events, clock)
+    pa = provision(opts, clock=clock, connection_factory=lambda *args, **kwargs: connection,
+                   history=StateHistory(), cache=CimcCache(),
+                   checkpoint=Checkpoint(None, opts['cimc_ip'], clock))
+    unsent = connection.unsent()
+    if unsent:
+        raise ReplayError("wiper finished without sending {0!r} on {1}".format(unsent[0][1],
+                                                                              unsent[0][0]))
+    return pa, clock.time()
+
+
+def main():
+    parser = ArgumentParser('Replay wiper transcripts')
+    parser.add_argument('transcripts', nargs='+', help='Transcripts recorded with --record.')
+    parser.add_argument('-r', '--repeat', type=int, default=1,
+                        help='Replay each transcript this many times.')
+    parser.add_argument('-p', '--profile', action='store_true', default=False,
+                        help='Profile the replays and show where the time went.')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False,
+                        help='Show the wiper messages of the replay.')
+    args = parser.parse_args()
+
+    profiler = cProfile.Profile() if args.profile else None
+    failed = False
+    for path in args.transcripts:
+        started = time.time()
+        try:
+            for _ in range(args.repeat):
+                if profiler is not None:
+                    profiler.enable()
+                try:
+                    pa, virtual_seconds = replay(path, verbose=args.verbose)
+                finally:
+                    if profiler is not None:
+                        profiler.disable()
+        except ReplayError, err:
+            print("{0}: FAILED: {1}".format(path, err))
+            failed = True
+            continue
+        elapsed = (time.time() - started) / args.repeat
+        print("{0}: reached {1} after {2:.0f} virtual seconds in {3:.1f} ms".format(
+            path, pa.state, virtual_seconds, elapsed * 1000))
+    if profiler is not None:
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
+    if failed:
+        sys.exit(-1)
+
+
+if __name__ == '__main__':
+    main()
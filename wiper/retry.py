@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+# wiper - the APIC provisioner
+#
+# Copyright (C) 2015 Cisco Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+"""
+How often and how quickly each operation is tried again.
+
+Every operation that is worth trying again has a RetryPolicy: the number of attempts it gets, the
+backoff before the second attempt (doubled for each attempt after that, with jitter so a fleet does
+not retry in lock step) and an overall deadline after which it is given up on no matter how many
+attempts are left.  The defaults can be changed with the retry option, a list of
+operation:attempts[:backoff[:deadline]] entries, for example in the ini file:
+
+  retry = check_sol:10:5:300 connect_apic:5
+
+A deadline of 0 means there is none.
+"""
+
+# Standard Library imports
+import random
+import threading
+import time
+
+# The longest wait between two attempts, in seconds
+MAX_BACKOFF = 30
+# Each wait is shortened by up to this fraction of it
+JITTER = 0.5
+
+# operation -> (attempts, backoff, deadline)
+DEFAULT_POLICIES = {
+    # Setting up the ssh connection to CIMC, authentication failures are never tried again
+    'connect_cimc': (3, 2, 60),
+    # A CIMC CLI command that can be sent again safely (show, scope, set, commit, top)
+    'cimc_command': (3, 1, 60),
+    # Checking 'show sol' until Serial Over LAN is configured, each check after the first
+    # configuration attempt counts
+    'check_sol': (4, 3, 120),
+    # Nudging a silent APIC console with a newline before paying for a power cycle
+    'connect_apic': (3, 2, 60),
+}
+
+
+class RetryPolicy(object):
+    """ How an operation is retried.
+
+    Args:
+        attempts (int): The total number of attempts, 1 means the operation is never retried.
+        backoff (float): The seconds to wait before the second attempt.
+        deadline (float): The seconds after the first attempt when no more attempts are made, None
+            for no deadline.
+    """
+    __slots__ = ('attempts', 'backoff', 'deadline', 'max_backoff', 'jitter')
+
+    def __init__(self, attempts, backoff=1, deadline=None, max_backoff=MAX_BACKOFF, jitter=JITTER):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.deadline = deadline
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+
+    def delay(self, attempt, rng=random):
+        """ The seconds to wait after a failed attempt, attempts are counted from 1. """
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        return delay * (1 - self.jitter * rng.random())
+
+    def start(self, clock=time):
+        """ Start the first attempt at the operation. """
+        return Retry(self, clock)
+
+
+class Retry(object):
+    """ The attempts made at one operation so far. """
+    __slots__ = ('policy', 'clock', 'started', 'attempt')
+
+    def __init__(self, policy, clock=time):
+        self.policy = policy
+        self.clock = clock
+        self.started = clock.time()
+        self.attempt = 1
+
+    def next_delay(self):
+        """ Count another attempt after the current one failed.
+
+        Returns:
+            float: The seconds to wait before making the attempt, or None when the attempts or the
+                deadline of the policy have run out.
+        """
+        policy = self.policy
+        if self.attempt >= policy.attempts:
+            return None
+        delay = policy.delay(self.attempt)
+        if (policy.deadline is not None and
+                self.clock.time() + delay - self.started > policy.deadline):
+            return None
+        self.attempt += 1
+        return delay
+
+
+def parse_policies(spec):
+    """ Parse the retry option into policies.
+
+    Raises:
+        ValueError: The option is not a list of operation:attempts[:backoff[:deadline]] entries.
+
+    Returns:
+        dict: Every operation mapped to its RetryPolicy, operations not in spec keep the default.
+    """
+    settings = dict(DEFAULT_POLICIES)
+    for entry in (spec or '').replace(',', ' ').split():
+        fields = entry.split(':')
+        name = fields[0]
+        if name not in DEFAULT_POLICIES or not 2 <= len(fields) <= 4:
+            raise ValueError("Invalid retry policy '{0}', expected operation:attempts[:backoff"
+                             "[:deadline]] with one of the operations {1}".format(
+                                 entry, ', '.join(sorted(DEFAULT_POLICIES))))
+        attempts, backoff, deadline = settings[name]
+        try:
+            attempts = int(fields[1])
+            if len(fields) > 2:
+                backoff = float(fields[2])
+            if len(fields) > 3:
+                deadline = float(fields[3])
+        except ValueError:
+            raise ValueError("Invalid retry policy '{0}', the values must be numbers".format(entry))
+        if attempts < 1:
+            raise ValueError("Invalid retry policy '{0}', at least 1 attempt is needed".format(
+                entry))
+        settings[name] = (attempts, backoff, deadline)
+    return dict((name, RetryPolicy(attempts, backoff, deadline or None))
+                for name, (attempts, backoff, deadline) in settings.items())
+
+
+_POLICIES = {}
+_POLICIES_LOCK = threading.Lock()
+
+
+def retry_policies(spec=None):
+    """ Get the policies for a retry option, each distinct option is only parsed once. """
+    with _POLICIES_LOCK:
+        if spec not in _POLICIES:
+            _POLICIES[spec] = parse_policies(spec)
+        return _POLICIES[spec]
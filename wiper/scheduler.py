@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+
+# wiper - the APIC provisioner
+#
+# Copyright (C) 2015 Cisco Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+"""
+Decide which APIC of a fleet is provisioned next.
+
+The controllers of a fabric (the APICs with the same fabric_name) can be wiped at the same time, but
+APIC1 has to finish the setup script before the other controllers of its fabric start theirs.  Every
+other controller depends on the APIC1 of its fabric: it is not started before APIC1 is, and it waits
+at the start of the setup script until APIC1 is done with it (or has failed).  A fabric has a single
+APIC1, check_leaders rejects a fleet with more, and APIC1 itself never waits.
+
+How many APICs are provisioned at once is limited in total, per fabric (max_per_fabric), per
+management subnet of the CIMC addresses (max_per_subnet, the subnet is subnet_prefix bits long) and
+to one per CIMC.  Of the APICs that can start, fabrics that have already started come first and then
+the fabrics with the fewest APICs left, so that whole fabrics finish as early as possible.  Within a
+fabric the controllers start in controller number order.
+"""
+
+# Standard Library imports
+import bisect
+import socket
+import struct
+import threading
+import time
+
+
+def subnet_of(host, prefix):
+    """ The subnet a CIMC is reached through, the host itself when it is not an IPv4 address. """
+    try:
+        address = struct.unpack('!I', socket.inet_aton(host))[0]
+    except (socket.error, struct.error):
+        return host
+    mask = (0xffffffff << (32 - prefix)) & 0xffffffff
+    return '{0}/{1}'.format(socket.inet_ntoa(struct.pack('!I', address & mask)), prefix)
+
+
+def _limit(opts, name):
+    return int(opts.get(name) or 0)
+
+
+def check_leaders(node_opts):
+    """ Make sure no fabric has more than one APIC1, they would each wait on the other.
+
+    Raises:
+        ValueError: Two nodes are controller 1 of the same fabric.
+    """
+    leaders = {}
+    for opts in node_opts:
+        try:
+            if int(opts.get('controller_number')) != 1:
+                continue
+        except (TypeError, ValueError):
+            continue
+        fabric = opts.get('fabric_name')
+        if fabric in leaders:
+            raise ValueError("{0} and {1} are both controller 1 of fabric '{2}', give each fabric "
+                             "its own --fabric-name".format(leaders[fabric], opts['cimc_ip'],
+                                                            fabric))
+        leaders[fabric] = opts['cimc_ip']
+
+
+def setup_overdue(node, timeout):
+    """ The error a node fails with when APIC1 took longer than timeout to get through setup. """
+    return RuntimeError("APIC1 of fabric '{0}' did not finish the setup script within {1:.0f} "
+                        "seconds".format(node.fabric, timeout))
+
+
+class FleetNode(object):
+    """ One APIC of the fleet, handed out by FleetScheduler.next or FleetScheduler.take.
+
+    Args:
+        data: Anything the caller wants to keep with the node.
+    """
+    __slots__ = ('scheduler', 'opts', 'data', 'position', 'cimc', 'fabric', 'subnet',
+                 'controller', 'state', 'setup_done')
+
+    def __init__(self, scheduler, opts, data, position):
+        self.scheduler = scheduler
+        self.opts = opts
+        self.data = data
+        self.position = position
+        self.cimc = opts['cimc_ip']
+        self.fabric = opts.get('fabric_name')
+        self.subnet = subnet_of(self.cimc, int(opts.get('subnet_prefix') or 24))
+        try:
+            self.controller = int(opts.get('controller_number'))
+        except (TypeError, ValueError):
+            self.controller = 0
+        # pending, running or finished
+        self.state = 'pending'
+        self.setup_done = False
+
+    def setup_ready(self):
+        """ Whether the APIC1 of the fabric is done with the setup script. """
+        return self.scheduler.setup_ready(self)
+
+    def wait_for_setup(self, log=None, timeout=None):
+        """ Block until the APIC1 of the fabric is done with the setup script.
+
+        Raises:
+            RuntimeError: APIC1 was not done within timeout seconds.
+        """
+        self.scheduler.wait_for_setup(self, log, timeout)
+
+    def setup_finished(self):
+        """ Called once the APIC has finished the setup script. """
+        self.scheduler.setup_finished(self)
+
+    def finished(self):
+        """ Called once the APIC has been provisioned or has failed. """
+        self.scheduler.finished(self)
+
+
+class _Group(object):
+    """ The APICs that share a fabric, a subnet or a CIMC. """
+    __slots__ = ('running', 'started', 'pending')
+
+    def __init__(self):
+        self.running = 0
+        self.started = 0
+        # (controller number, position, node) of the nodes not started yet, fabrics keep them in
+        # the order they should start
+        self.pending = []
+
+
+class FleetScheduler(object):
+    """ Hand out the APICs of a fleet as their prerequisites and the concurrency limits allow.
+
+    Safe to share between threads.
+
+    Args:
+        limit (int): The most APICs provisioned at once, 0 for no limit.
+    """
+    def __init__(self, limit=0):
+        self.limit = limit
+        self.running = 0
+        self.closed = False
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self._count = 0
+        self._fabrics = {}
+        self._subnets = {}
+        self._cimcs = {}
+        # fabric -> the APIC1 nodes of the fabric, the prerequisites of every other node in it
+        self._leaders = {}
+
+    def add(self, opts, data=None):
+        """ Add an APIC to be provisioned.
+
+        Returns:
+            FleetNode: The node of the APIC.
+        """
+        with self.lock:
+            node = FleetNode(self, opts, data, self._count)
+            self._count += 1
+            fabric = self._fabrics.setdefault(node.fabric, _Group())
+            bisect.insort(fabric.pending, (node.controller, node.position, node))
+            self._subnets.setdefault(node.subnet, _Group())
+            self._cimcs.setdefault(node.cimc, _Group())
+            if node.controller == 1:
+                self._leaders.setdefault(node.fabric, []).append(node)
+            self.changed.notify_all()
+        return node
+
+    def close(self):
+        """ No more APICs will be added, next returns None once every APIC has been handed out. """
+        with self.lock:
+            self.closed = True
+            self.changed.notify_all()
+
+    def take(self):
+        """ Hand out the APIC that should start next, if one can start now.
+
+        Returns:
+            FleetNode: The node, or None if no APIC can start now.
+        """
+        with self.lock:
+            return self._take()
+
+    def next(self):
+        """ Wait until an APIC can start and hand it out.
+
+        Returns:
+            FleetNode: The node, or None once the scheduler is closed and every APIC was handed out.
+        """
+        with self.lock:
+            while True:
+                node = self._take()
+                if node is not None:
+                    return node
+                if self.closed and not self._pending():
+                    return None
+                # Waiting with a timeout so a ctrl-c still reaches the main thread
+                self.changed.wait(1)
+
+    def pending(self):
+        """ Whether there are APICs that have not been handed out yet. """
+        with self.lock:
+            return self._pending()
+
+    def finished(self, node):
+        with self.lock:
+            if node.state != 'running':
+                return
+            node.state = 'finished'
+            self.running -= 1
+            for group in self._groups(node):
+                group.running -= 1
+            self.changed.notify_all()
+
+    def setup_finished(self, node):
+        with self.lock:
+            node.setup_done = True
+            self.changed.notify_all()
+
+    def setup_ready(self, node):
+        with self.lock:
+            return self._setup_ready(node)
+
+    def wait_for_setup(self, node, log=None, timeout=None):
+        with self.lock:
+            if self._setup_ready(node):
+                return
+            if log is not None:
+                log("Waiting for APIC1 of fabric '{0}' to finish the setup script.".format(
+                    node.fabric))
+            deadline = None if timeout is None else time.time() + timeout
+            while not self._setup_ready(node):
+                if deadline is not None and time.time() >= deadline:
+                    raise setup_overdue(node, timeout)
+                self.changed.wait(1)
+
+    def _pending(self):
+        return any(fabric.pending for fabric in self._fabrics.values())
+
+    def _groups(self, node):
+        return (self._fabrics[node.fabric], self._subnets[node.subnet], self._cimcs[node.cimc])
+
+    def _setup_ready(self, node):
+        if node.controller == 1:
+            return True
+        for leader in self._leaders.get(node.fabric, []):
+            if leader is not node and not (leader.setup_done or leader.state == 'finished'):
+                return False
+        return True
+
+    def _can_start(self, node):
+        for leader in self._leaders.get(node.fabric, []):
+            if leader.controller != node.controller and leader.state == 'pending':
+                return False
+        if self._subnets[node.subnet].running >= (_limit(node.opts, 'max_per_subnet') or
+                                                  float('inf')):
+            return False
+        return self._cimcs[node.cimc].running == 0
+
+    def _take(self):
+        if self.limit and self.running >= self.limit:
+            return None
+        best = None
+        for fabric in self._fabrics.values():
+            if not fabric.pending:
+                continue
+            if fabric.running >= (_limit(fabric.pending[0][2].opts, 'max_per_fabric') or
+                                  float('inf')):
+                continue
+            key = (fabric.started == 0, len(fabric.pending), fabric.pending[0][1])
+            if best is not None and key >= best[0]:
+                continue
+            for index, (_, _, node) in enumerate(fabric.pending):
+                if self._can_start(node):
+                    best = (key, fabric, index)
+                    break
+        if best is None:
+            return None
+        _, fabric, index = best
+        node = fabric.pending.pop(index)[2]
+        node.state = 'running'
+        self.running += 1
+        for group in self._groups(node):
+            group.running += 1
+            group.started += 1
+        return node
@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+
+# wiper - the APIC provisioner
+#
+# Copyright (C) 2015 Cisco Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+"""
+The states, transitions and console prompts used to provision an APIC.
+
+These are shared by the threaded ProvisionApic state machine and the event loop engine so both walk
+exactly the same states.  The transition table is built and checked once when this module is
+imported, every APIC provisioned by the process then shares it.
+"""
+
+# Each state's callback is the on_enter_<state> method of the model, it is looked up by name when
+# the state is entered.
+STATES = [
+    # Start and initialization states
+    'start',
+    'connect_cimc',
+    # CIMC related states
+    'check_sol',
+    'configure_sol',
+    'disconnect_cimc',
+    'cycle_host',
+    # APIC specific initialization states
+    'connect_apic',
+    'logout_apic',
+    'login_apic',
+    'password_login_apic',
+    'eraseconfig',
+    # Setup script related states
+    'press_any_key',
+    'provide_fabric_name',
+    'provide_number_ctrlrs',
+    'provide_ctrlr_id',
+    'provide_ctrlr_name',
+    'provide_tep_addr_pool',
+    'provide_infra_vlan_id',
+    'provide_bd_mc_addr_pool',
+    'provide_oob_address',
+    'provide_oob_def_gw',
+    'provide_int_speed',
+    'provide_strong_passwd',
+    'provide_admin_passwd',
+    'provide_modify_config',
+    'answer_setup',
+]
+
+TRANSITIONS = [
+    {'trigger': 'start', 'source': 'start', 'dest': 'connect_cimc'},
+
+    {'trigger': 'cimc_prompt_detected', 'source': 'connect_cimc', 'dest': 'check_sol'},
+
+    {'trigger': 'sol_not_configured', 'source': 'check_sol', 'dest': 'configure_sol'},
+
+    {'trigger': 'sol_config_committed', 'source': 'configure_sol', 'dest': 'check_sol'},
+
+    {'trigger': 'cycle_host', 'source': 'connect_apic', 'dest': 'cycle_host'},
+
+    # The SOL check was skipped because of the CIMC cache but the APIC console did not answer
+    {'trigger': 'recheck_sol', 'source': 'connect_apic', 'dest': 'check_sol'},
+
+    # We can enter the connect_apic state from multiple sources, this states
+    # entry callback will need to be smarter than the average bear.
+    {'trigger': 'connect_to_apic', 'source': ['check_sol', 'logout_apic'], 'dest': 'connect_apic'},
+
+    {'trigger': 'apic_prompt_detected', 'source': 'connect_apic', 'dest': 'logout_apic'},
+
+    {'trigger': 'apic_login_detected',
+     'source': ['connect_apic', 'logout_apic', 'password_login_apic', 'cycle_host'],
+     'dest': 'login_apic'},
+
+    {'trigger': 'apic_password_detected',
+     'source': ['connect_apic', 'cycle_host'],
+     'dest': 'password_login_apic'},
+
+    {'trigger': 'apic_prompt_detected', 'source': ['login_apic', 'cycle_host'],
+     'dest': 'eraseconfig'},
+
+    {'trigger': 'press_any_key', 'source': ['connect_apic', 'eraseconfig', 'cycle_host'],
+     'dest': 'press_any_key'},
+
+    # This transition can happen from connect_apic or provide_modify_config
+    {'trigger': 'enter_fabric_name',
+     'source': ['connect_apic', 'provide_modify_config', 'press_any_key'],
+     'dest': 'provide_fabric_name'},
+
+    {'trigger': 'enter_num_ctrlrs', 'source': ['connect_apic', 'provide_fabric_name'],
+     'dest': 'provide_number_ctrlrs'},
+
+    {'trigger': 'enter_ctrlr_id', 'source': ['connect_apic', 'provide_number_ctrlrs'],
+     'dest': 'provide_ctrlr_id'},
+
+    {'trigger': 'enter_ctrlr_name', 'source': ['connect_apic', 'provide_ctrlr_id'],
+     'dest': 'provide_ctrlr_name'},
+
+    {'trigger': 'enter_tep_addr_pool', 'source': ['connect_apic', 'provide_ctrlr_name'],
+     'dest': 'provide_tep_addr_pool'},
+
+    {'trigger': 'enter_infra_vlan_id', 'source': ['connect_apic', 'provide_tep_addr_pool'],
+     'dest': 'provide_infra_vlan_id'},
+
+    {'trigger': 'enter_bd_mc_addr_pool', 'source': ['connect_apic', 'provide_infra_vlan_id'],
+     'dest': 'provide_bd_mc_addr_pool'},
+
+    {'trigger': 'enter_oob_ip_addr',
+     'source': ['connect_apic', 'provide_bd_mc_addr_pool', 'provide_infra_vlan_id'],
+     'dest': 'provide_oob_address'},
+
+    {'trigger': 'enter_oob_def_gw', 'source': ['connect_apic', 'provide_oob_address'],
+     'dest': 'provide_oob_def_gw'},
+
+    {'trigger': 'enter_int_speed', 'source': ['connect_apic', 'provide_oob_def_gw'],
+     'dest': 'provide_int_speed'},
+
+    {'trigger': 'enter_strong_passwd', 'source': ['connect_apic', 'provide_int_speed'],
+     'dest': 'provide_strong_passwd'},
+
+    {'trigger': 'enter_admin_passwd', 'source': ['connect_apic', 'provide_strong_passwd'],
+     'dest': 'provide_admin_passwd'},
+
+    {'trigger': 'reenter_admin_passwd', 'source': ['connect_apic', 'provide_admin_passwd'],
+     'dest': 'provide_admin_passwd'},
+
+    # With --type-ahead every answer is given from a single state, see typeahead.py
+    {'trigger': 'type_ahead_setup', 'source': 'press_any_key', 'dest': 'answer_setup'},
+
+    {'trigger': 'enter_edit_cfg',
+     'source': ['connect_apic', 'provide_admin_passwd', 'provide_int_speed', 'answer_setup'],
+     'dest': 'provide_modify_config'},
+
+    {'trigger': 'restart_setup', 'source': 'provide_modify_config', 'dest': 'provide_fabric_name'},
+]
+
+
+def build_transition_table(states, transitions):
+    """ Flatten the transitions into a lookup table, checking them against the states.
+
+    Raises:
+        ValueError: A transition uses an unknown state, or a trigger leads to two states from the
+            same source.
+
+    Returns:
+        dict: (source state, trigger) -> destination state
+    """
+    table = {}
+    for transition in transitions:
+        sources = transition['source']
+        if not isinstance(sources, list):
+            sources = [sources]
+        for state in sources + [transition['dest']]:
+            if state not in states:
+                raise ValueError("The {0} transition uses the unknown state {1}".format(
+                    transition['trigger'], state))
+        for source in sources:
+            key = (source, transition['trigger'])
+            if table.get(key, transition['dest']) != transition['dest']:
+                raise ValueError("The {0} transition leads to both {1} and {2} from {3}".format(
+                    transition['trigger'], table[key], transition['dest'], source))
+            table[key] = transition['dest']
+    return table
+
+
+# (source state, trigger) -> destination state
+TRANSITION_TABLE = build_transition_table(STATES, TRANSITIONS)
+
+
+def _trigger(name):
+    def trigger(self):
+        return self.fire(name)
+    trigger.__name__ = name
+    return trigger
+
+
+def _to_state(dest):
+    def to_state(self):
+        return self.enter(dest)
+    to_state.__name__ = 'to_' + dest
+    return to_state
+
+
+class StateMachine(object):
+    """ The states and transitions above, shared by every instance.
+
+    Each trigger is a method of the class, as is a to_<state> method for every state, so an instance
+    only holds its current state.  The on_enter_<state> method of the subclass is called as each
+    state is entered, state_changing just before the state changes and state_entered just after.
+    """
+    __slots__ = ('state',)
+
+    def __init__(self, initial='start'):
+        self.state = initial
+
+    def fire(self, trigger):
+        """ Move to the state the trigger leads to from the current state and enter it. """
+        try:
+            dest = TRANSITION_TABLE[(self.state, trigger)]
+        except KeyError:
+            raise RuntimeError("Can't trigger event {0} from state {1}!".format(trigger,
+                                                                               self.state))
+        return self.enter(dest)
+
+    def enter(self, dest):
+        self.state_changing()
+        self.state = dest
+        self.state_entered()
+        callback = getattr(self, 'on_enter_' + dest, None)
+        if callback is not None:
+            callback()
+        return True
+
+    def state_changing(self):
+        pass
+
+    def state_entered(self):
+        pass
+
+
+for _name in set(transition['trigger'] for transition in TRANSITIONS):
+    setattr(StateMachine, _name, _trigger(_name))
+for _name in STATES:
+    setattr(StateMachine, 'to_' + _name, _to_state(_name))
+
+# When we see one of these regex's on the APIC console we fire the paired trigger.
+CONSOLE_PROMPTS = [
+    (r'.*login:.*', 'apic_login_detected'),
+    (r'.*Password:.*', 'apic_password_detected'),
+    (r'.*:~> ', 'apic_prompt_detected'),
+    (r'.*Press any key to continue....*', 'press_any_key'),
+    (r'.*Enter the fabric name \[.*\]:.*', 'enter_fabric_name'),
+    (r'.*Enter the number of controllers in the fabric \(1-[1-5]\) \[[0-9]+]:.*',
+     'enter_num_ctrlrs'),
+    (r'.*Enter the controller ID \(1-[1-5]\) \[[0-9]+\]:.*', 'enter_ctrlr_id'),
+    (r'.*Enter the controller name \[.*\]:.*', 'enter_ctrlr_name'),
+    (r'.*Enter address pool for TEP addresses \[.*\]:.*', 'enter_tep_addr_pool'),
+    (r'.*Enter the VLAN ID for infra network \(1-4094\).*:.*', 'enter_infra_vlan_id'),
+    (r'.*Enter address pool for BD multicast addresses \(GIPO\) \[.*\]:.*',
+     'enter_bd_mc_addr_pool'),
+    (r'.*Enter the IP address \[.*\].*', 'enter_oob_ip_addr'),
+    (r'.*Enter the IP address of the default gateway \[.*\]:.*', 'enter_oob_def_gw'),
+    (r'.*Enter the interface speed/duplex mode \[.*\]:.*', 'enter_int_speed'),
+    (r'.*Enable strong passwords\? \[.*\]:.*', 'enter_strong_passwd'),
+    (r'.*Enter the password for admin:.*', 'enter_admin_passwd'),
+    (r'.*Reenter the password for admin:.*', 'reenter_admin_passwd'),
+    (r'.*Would you like to edit the configuration\? \(y/n\) \[.*\].*', 'enter_edit_cfg'),
+]
+
+# The console triggers of an APIC that is not in the setup script, every other one answers it
+LOGIN_TRIGGERS = ('apic_login_detected', 'apic_password_detected', 'apic_prompt_detected')
+
+# After a power cycle we hopefully would only end up at press any key, not sure how we end up in
+# the others after no response from the APIC.
+POWER_CYCLE_PROMPTS = [
+    (r'.*login:.*', 'apic_login_detected'),
+    (r'.*Password:.*', 'apic_password_detected'),
+    (r'.*:~> ', 'apic_prompt_detected'),
+    (r'.*Press any key to continue....*', 'press_any_key'),
+]
+
+# The setup script questions that are answered the same way on every APIC.  Each state sends the
+# named answer and then fires the trigger paired with whichever prompt shows up next, APIC1 is asked
+# more questions than the other controllers so some states can be followed by more than one prompt.
+SETUP_STEPS = {
+    'press_any_key': (None, [
+        (r'.*Enter the fabric name \[.*\]:.*', 'enter_fabric_name'),
+    ]),
+    'provide_fabric_name': ('fabric_name', [
+        (r'.*Enter the number of controllers in the fabric \(1-9\) \[[0-9]+]:.*',
+         'enter_num_ctrlrs'),
+    ]),
+    'provide_number_ctrlrs': ('num_controllers', [
+        (r'.*Enter the controller ID \(1-[1-5]\) \[[0-9]+\]:.*', 'enter_ctrlr_id'),
+    ]),
+    'provide_ctrlr_id': ('controller_id', [
+        (r'.*Enter the controller name \[.*\]:.*', 'enter_ctrlr_name'),
+    ]),
+    'provide_ctrlr_name': ('controller_name', [
+        (r'.*Enter address pool for TEP addresses \[.*\]:.*', 'enter_tep_addr_pool'),
+    ]),
+    'provide_tep_addr_pool': ('tep_address_pool', [
+        (r'.*Enter the VLAN ID for infra network \(1-4094\).*:.*', 'enter_infra_vlan_id'),
+    ]),
+    'provide_infra_vlan_id': ('infra_vlan_id', [
+        (r'.*Enter address pool for BD multicast addresses \(GIPO\) \[.*\]:.*',
+         'enter_bd_mc_addr_pool'),
+        (r'.*Enter the IP address \[.*\].*', 'enter_oob_ip_addr'),
+    ]),
+    'provide_bd_mc_addr_pool': ('bd_mc_address_pool', [
+        (r'.*Enter the IP address \[.*\].*', 'enter_oob_ip_addr'),
+    ]),
+    'provide_oob_address': ('oob_ip_addr', [
+        (r'.*Enter the IP address of the default gateway \[.*\]:.*', 'enter_oob_def_gw'),
+    ]),
+    'provide_oob_def_gw': ('oob_def_gw', [
+        (r'.*Enter the interface speed/duplex mode \[.*\]:.*', 'enter_int_speed'),
+    ]),
+    'provide_int_speed': ('int_speed', [
+        (r'.*Enable strong passwords\? \[.*\]:.*', 'enter_strong_passwd'),
+        (r'.*Would you like to edit the configuration\? \(y/n\) \[.*\].*', 'enter_edit_cfg'),
+    ]),
+    'provide_strong_passwd': ('strong_passwd', [
+        (r'.*Enter the password for admin:.*', 'enter_admin_passwd'),
+    ]),
+}
+
+# The setup script questions in the order they are asked, answered ahead of time with --type-ahead.
+# Each is (prompt, answer attribute, label in the configuration summary, only asked of APIC1, can be
+# typed ahead).  The passwords are not typed ahead, they are read with any input typed ahead thrown
+# away, and they are not shown in the summary.
+SETUP_ANSWERS = [
+    (r'.*Enter the fabric name \[.*\]:.*', 'fabric_name', 'Fabric name', False, True),
+    (r'.*Enter the number of controllers in the fabric \(1-9\) \[[0-9]+]:.*', 'num_controllers',
+     'Number of controllers', False, True),
+    (r'.*Enter the controller ID \(1-[1-5]\) \[[0-9]+\]:.*', 'controller_id', 'Controller ID',
+     False, True),
+    (r'.*Enter the controller name \[.*\]:.*', 'controller_name', 'Controller name', False, True),
+    (r'.*Enter address pool for TEP addresses \[.*\]:.*', 'tep_address_pool', 'TEP address pool',
+     False, True),
+    (r'.*Enter the VLAN ID for infra network \(1-4094\).*:.*', 'infra_vlan_id', 'Infra VLAN ID',
+     False, True),
+    (r'.*Enter address pool for BD multicast addresses \(GIPO\) \[.*\]:.*', 'bd_mc_address_pool',
+     'Multicast address pool', True, True),
+    (r'.*Enter the IP address \[.*\].*', 'oob_ip_addr', 'Management IP address', False, True),
+    (r'.*Enter the IP address of the default gateway \[.*\]:.*', 'oob_def_gw', 'Default gateway',
+     False, True),
+    (r'.*Enter the interface speed/duplex mode \[.*\]:.*', 'int_speed',
+     'Interface speed/duplex mode', False, True),
+    (r'.*Enable strong passwords\? \[.*\]:.*', 'strong_passwd', 'Strong Passwords', True, True),
+    (r'.*Enter the password for admin:.*', 'apic_password', None, True, False),
+    (r'.*Reenter the password for admin:.*', 'apic_password', None, True, False),
+]
+EDIT_CONFIG_PROMPT = r'.*Would you like to edit the configuration\? \(y/n\) \[.*\].*'
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+
+# wiper - the APIC provisioner
+#
+# Copyright (C) 2015 Cisco Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+"""
+Learn how long provisioning takes so waits can be sized from experience.
+
+Every run records how long each state took, keyed by the hardware model of the CIMC, in a small
+JSON history file.  Once a model has a few runs behind it the long waits (reboots, logging in after
+a reboot) are sized from that history instead of the fixed 600 and 60 second worst cases, so a hung
+node is given up on in minutes and a slow model is no longer timed out early.
+
+While an APIC reboots a BootProgress watches the console for the boot milestones, reports how far
+along the boot is with an ETA and notices when a milestone is overdue.
+"""
+
+# Standard Library imports
+import json
+import os
+import re
+import threading
+import time
+
+HISTORY_FILE = '~/.wiper_history.json'
+# Only the most recent runs are kept so the history follows firmware and software upgrades
+MAX_SAMPLES = 20
+# The history is not trusted until a model has been seen this many times
+MIN_SAMPLES = 3
+# A wait is allowed to take this many times the longest it has taken before
+DEADLINE_FACTOR = 2
+MIN_DEADLINE = 10
+
+# The milestones of an APIC boot in the order they are printed on the console.
+BOOT_MILESTONES = [
+    ('bios', r'Cisco Systems, Inc\.|Press <F2>|BIOS'),
+    ('kernel', r'Linux version|Booting the kernel|kernel:'),
+    ('services', r'Welcome to|Starting [A-Z]'),
+    ('setup', r'Press any key to continue|login:'),
+]
+_MILESTONE_REGEX = re.compile('|'.join('(?P<{0}>{1})'.format(name, regex)
+                                       for name, regex in BOOT_MILESTONES))
+_MILESTONE_NAMES = [name for name, _ in BOOT_MILESTONES]
+# How much of the previous output is searched again with new data
+_WINDOW_SIZE = 64
+
+
+def model_from_prompt(output):
+    """ Get the hardware model from a CIMC prompt, CIMC names itself after it (C220-FCH1234V5WX).
+
+    Returns:
+        str: The model or 'unknown' if the prompt is not in the output.
+    """
+    match = re.search(r'(\S+)-[^\s#-]+(?: /\S+)? ?\*?# ?$', output.rstrip('\n'))
+    if match is None:
+        return 'unknown'
+    return match.group(1)
+
+
+class StateHistory(object):
+    """ How long each state has taken, per hardware model, shared by every node in a run.
+
+    Args:
+        path (str): The JSON file the history is kept in, it is created on save.  Without a path
+            the history is only kept in memory.
+    """
+    def __init__(self, path=None):
+        self.path = path and os.path.expanduser(path)
+        self.lock = threading.Lock()
+        self.samples = {}
+        if self.path is None:
+            return
+        try:
+            with open(self.path) as history_file:
+                self.samples = json.load(history_file)
+        except (IOError, ValueError):
+            pass
+
+    def record(self, model, key, seconds):
+        with self.lock:
+            samples = self.samples.setdefault(model, {}).setdefault(key, [])
+            samples.append(round(seconds, 1))
+            del samples[:-MAX_SAMPLES]
+
+    def expected(self, model, key):
+        """ The median time the key has taken on the model, or None without enough history. """
+        with self.lock:
+            samples = sorted(self.samples.get(model, {}).get(key, []))
+        if len(samples) < MIN_SAMPLES:
+            return None
+        return samples[len(samples) / 2]
+
+    def deadline(self, model, key, default):
+        """ How long to wait on the key before giving up.
+
+        Args:
+            model (str): The hardware model.
+            key (str): The state or boot milestone.
+            default (int): The wait to use until the model has enough history.
+
+        Returns:
+            int: The number of seconds to wait.
+        """
+        with self.lock:
+            samples = self.samples.get(model, {}).get(key, [])
+        if len(samples) < MIN_SAMPLES:
+            return default
+        return max(int(max(samples) * DEADLINE_FACTOR), MIN_DEADLINE)
+
+    def save(self):
+        """ Write the history out, through a temporary file so a crash can not truncate it. """
+        if self.path is None:
+            return
+        with self.lock:
+            data = json.dumps(self.samples, indent=2, sort_keys=True)
+        temp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        with open(temp_path, 'w') as history_file:
+            history_file.write(data)
+        os.rename(temp_path, self.path)
+
+
+_HISTORIES = {}
+_HISTORIES_LOCK = threading.Lock()
+
+
+def load_history(path=None):
+    """ Get the StateHistory for a file, every node of a run shares the same one. """
+    path = os.path.expanduser(path or HISTORY_FILE)
+    with _HISTORIES_LOCK:
+        if path not in _HISTORIES:
+            _HISTORIES[path] = StateHistory(path)
+        return _HISTORIES[path]
+
+
+class BootProgress(object):
+    """ Follow an APIC boot through the console output.
+
+    Args:
+        history (StateHistory): Where the time to reach each milestone is learned from.
+        model (str): The hardware model of the node.
+        timeout (int): How long the whole boot may take when there is no history.
+        log (callable): Called with a message each time a milestone is reached.
+        clock: Where the time comes from, the time module unless replaying.
+    """
+    def __init__(self, history, model, timeout=600, log=None, clock=time):
+        self.history = history
+        self.model = model
+        self.log = log
+        self.clock = clock
+        self.started = clock.time()
+        self.timeout = history.deadline(model, 'reboot', timeout)
+        # The index of the last milestone reached and the seconds it took to reach each one
+        self.stage = -1
+        self.reached = []
+        self.tail = ''
+
+    def feed(self, data):
+        """ Look for milestones in newly received console output.
+
+        Milestones that were not printed are skipped, only the furthest one seen counts.
+        """
+        text = self.tail + data
+        self.tail = text[-_WINDOW_SIZE:]
+        stage = self.stage
+        for match in _MILESTONE_REGEX.finditer(text):
+            stage = max(stage, _MILESTONE_NAMES.index(match.lastgroup))
+        if stage == self.stage:
+            return
+        self.stage = stage
+        elapsed = self.clock.time() - self.started
+        self.reached.append((_MILESTONE_NAMES[stage], elapsed))
+        if self.log is not None:
+            message = "Boot reached the {0} stage after {1} seconds".format(
+                _MILESTONE_NAMES[stage], int(elapsed))
+            eta = self.eta()
+            if eta is not None:
+                message += ", about {0} seconds left".format(int(eta))
+            self.log(message + ".")
+
+    def eta(self):
+        """ The number of seconds the boot is expected to still take, or None without history. """
+        expected = self.history.expected(self.model, 'reboot')
+        if expected is None:
+            return None
+        return max(expected - (self.clock.time() - self.started), 0)
+
+    def deadline(self):
+        """ The time by which the next milestone has to show up before the boot is stalled. """
+        deadline = self.started + self.timeout
+        for name in _MILESTONE_NAMES[self.stage + 1:]:
+            seconds = self.history.deadline(self.model, 'reboot:' + name, None)
+            if seconds is not None:
+                return min(self.started + seconds, deadline)
+        return deadline
+
+    def remaining(self):
+        return self.deadline() - self.clock.time()
+
+    def finish(self):
+        """ Learn from a boot that completed. """
+        for name, elapsed in self.reached:
+            self.history.record(self.model, 'reboot:' + name, elapsed)
+        self.history.record(self.model, 'reboot', self.clock.time() - self.started)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+# wiper - the APIC provisioner
+#
+# Copyright (C) 2015 Cisco Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+"""
+Record everything sent to and received from the CIMC and APIC consoles.
+
+A transcript is a JSON lines file.  The first line holds the options the node was provisioned with
+and every line after that is one send, receive or read timeout on one of the consoles, with the time
+it happened relative to the start of the recording.  Passwords are replaced with SECRET wherever
+they are sent.  replay.py feeds a transcript back through ProvisionApic.
+"""
+
+# Standard Library imports
+import json
+import os
+import socket
+import threading
+import time
+
+SECRET = '<secret>'
+# The options that are needed to replay a transcript, passwords are left out on purpose
+RECORDED_OPTIONS = [
+    'cimc_ip',
+    'cimc_username',
+    'fabric_name',
+    'number_of_controllers',
+    'controller_number',
+    'controller_name',
+    'tep_address_pool',
+    'infra_vlan_id',
+    'bd_mc_addresses',
+    'oob_ip_address',
+    'oob_default_gateway',
+    'int_speed',
+    'strong_passwords',
+    'simulator',
+    'type_ahead',
+    'batch_cimc',
+]
+SECRET_OPTIONS = ['cimc_password', 'apic_admin_password']
+
+
+def mask(data, secrets):
+    for secret in secrets:
+        if secret:
+            data = data.replace(secret, SECRET)
+    return data
+
+
+class TranscriptWriter(object):
+    """ Write the transcript of one node.
+
+    Args:
+        path (str): The file to write.
+        opts (dict): The options the node is provisioned with.
+        clock: Where the time comes from, the time module unless replaying.
+    """
+    def __init__(self, path, opts, clock=time):
+        self.clock = clock
+        self.started = clock.time()
+        self.secrets = [opts[name] for name in SECRET_OPTIONS if opts.get(name)]
+        self.lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.transcript_file = open(path, 'w')
+        self._write({'opts': dict((name, opts[name]) for name in RECORDED_OPTIONS if name in opts),
+                     'started': self.started})
+
+    def record(self, conn_type, direction, data):
+        # Only what is sent is masked, masking the output could break the prompts on replay
+        if direction == 'send':
+            data = mask(data, self.secrets)
+        self._write({'t': round(self.clock.time() - self.started, 3), 'conn': conn_type,
+                     'dir': direction, 'data': data.decode('latin-1')})
+
+    def _write(self, event):
+        with self.lock:
+            if self.transcript_file is None:
+                return
+            self.transcript_file.write(json.dumps(event) + '\n')
+            self.transcript_file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.transcript_file is not None:
+                self.transcript_file.close()
+                self.transcript_file = None
+
+
+class RecordingChannel(object):
+    """ Wrap a paramiko channel and record everything that goes through it. """
+    def __init__(self, channel, transcript, conn_type):
+        self.channel = channel
+        self.transcript = transcript
+        self.conn_type = conn_type
+
+    def recv(self, nbytes):
+        try:
+            data = self.channel.recv(nbytes)
+        except socket.timeout:
+            # Recorded so a replay times out at exactly the same place
+            self.transcript.record(self.conn_type, 'timeout', '')
+            raise
+        self.transcript.record(self.conn_type, 'recv', data)
+        return data
+
+    def send(self, data):
+        sent = self.channel.send(data)
+        self.transcript.record(self.conn_type, 'send', data[:sent])
+        return sent
+
+    def sendall(self, data):
+        self.channel.sendall(data)
+        self.transcript.record(self.conn_type, 'send', data)
+
+    def __getattr__(self, name):
+        return getattr(self.channel, name)
+
+
+def read_transcript(path):
+    """ Read a transcript.
+
+    Returns:
+        tuple: The (header, events) of the transcript, header holds the recorded options.
+    """
+    with open(path) as transcript_file:
+        lines = [json.loads(line) for line in transcript_file if line.strip()]
+    if not lines or 'opts' not in lines[0]:
+        raise ValueError("{0} is not a wiper transcript".format(path))
+    # Console output is bytes, it is stored as latin-1 so any byte survives the trip through JSON
+    for event in lines[1:]:
+        event['data'] = event['data'].encode('latin-1')
+    return lines[0], lines[1:]
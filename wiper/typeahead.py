@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+# wiper - the APIC provisioner
+#
+# Copyright (C) 2015 Cisco Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+"""
+Answer the APIC setup script ahead of its questions.
+
+Answering one question at a time costs a round trip over the Serial Over LAN console per question.
+With --type-ahead the answers are planned from SETUP_ANSWERS (see states.py) once the first question
+shows up: every answer up to the admin password is sent at once and the console buffers them until
+the setup script reads them.  Only the passwords wait for their own prompt.
+
+Nothing checks the answers as they are read, so the configuration summary the setup script shows at
+the end is checked against them instead.  When it does not match the configuration is edited and the
+questions are answered again one at a time.
+"""
+
+# Standard Library imports
+import re
+
+# Local imports
+from states import EDIT_CONFIG_PROMPT, SETUP_ANSWERS
+
+# The seconds to wait for the setup script to read each answer sent
+ANSWER_TIMEOUT = 10
+
+
+class SetupAnswers(object):
+    """ The answers to the setup script of one APIC.
+
+    Args:
+        node: The ProvisionApic or ApicTask the answers are taken from, by the attribute names in
+            SETUP_ANSWERS.
+    """
+    def __init__(self, node):
+        apic1 = str(node.controller_id) == '1'
+        self.questions = [(prompt, str(getattr(node, attribute)), label, type_ahead)
+                          for prompt, attribute, label, apic1_only, type_ahead in SETUP_ANSWERS
+                          if apic1 or not apic1_only]
+
+    def steps(self):
+        """ Plan what to send once the first question is shown.
+
+        Returns:
+            list: (answers, prompts, timeout) tuples.  The answers are sent together and then the
+                next question is waited on for up to timeout seconds.  The edit configuration
+                prompt, shown once every question has been answered, is always the last prompt.
+        """
+        batches = []
+        for _, answer, _, type_ahead in self.questions:
+            if type_ahead and batches and batches[-1][1]:
+                batches[-1][0].append(answer)
+            else:
+                batches.append(([answer], type_ahead))
+        steps = []
+        asked = 0
+        for answers, _ in batches:
+            asked += len(answers)
+            prompts = [EDIT_CONFIG_PROMPT]
+            if asked < len(self.questions):
+                prompts.insert(0, self.questions[asked][0])
+            steps.append((answers, prompts, ANSWER_TIMEOUT * len(answers)))
+        return steps
+
+    def mismatches(self, summary):
+        """ Check the configuration summary against the answers that were sent.
+
+        Returns:
+            list: The labels of the summary lines that do not show the answer sent, an empty
+                answer takes the default so it is not checked.
+        """
+        mismatched = []
+        for _, answer, label, _ in self.questions:
+            if label is None or not answer:
+                continue
+            match = re.search(r'^\s*' + re.escape(label) + r'\s*:[ \t]*(.*?)\s*$', summary,
+                              re.MULTILINE)
+            if match is None or match.group(1) != answer:
+                mismatched.append(label)
+        return mismatched
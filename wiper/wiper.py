@@ -27,7 +27,6 @@ when trying to perform the task of provisioning an APIC.
 Requirements:
   pip install paramiko
   pip install git+https://github.com/fgimian/paramiko-expect.git
-  pip install git+https://github.com/tyarkoni/transitions.git
 
 There are a very large number of required options if you do not use an ini file to set the options:
 
@@ -111,657 +110,119 @@ specific section of the ini file.
 If no ini file is provided or if the ini file can not be found, the options must be set via the
 CLI arguments to the script.
 
+Every controller in the ini file can be provisioned at once with the --fleet option, in that case
+the cimc_ip argument is not needed and each section is provisioned concurrently using up to
+--workers (default 10) worker threads.  For very large fleets, --engine eventloop drives every APIC
+console from a single thread instead (see engine.py).  With --waves the reboot of every APIC is
+started first and the setup scripts are answered afterwards, so the reboots do not hold a worker.
+
+When wiper is called once per APIC by other automation, run wiperd.py instead and pass -S/--socket
+to each wiper call.  The job is run by the resident daemon, which already has the ini file parsed and
+everything imported, and its progress is shown as it happens.
+
+To share a large run between several processes or hosts, -Q/--queue adds the APICs to a job queue
+file instead of provisioning them, and any number of 'wiper worker --queue <file>' processes
+provision them (see worker.py).
+
+'wiper probe' takes the same arguments and only finds out where the console of each APIC stands,
+see probe.py.
+
 There is no warning or prompt asking you if you want the script to clear the config on an APIC, this
 script just does it.  This may change in the future.
 """
 
 # Standard Library imports
 from argparse import ArgumentParser
-import ConfigParser
+import json
 import logging
-import re
+import os
 import socket
 import sys
-import time
 #import telnetlib
 
-# Third party imports
-import paramiko
-from paramikoe import SSHClientInteraction
-from transitions import Machine
-
-
-class WiperApicInteract(SSHClientInteraction):
-    def __init__(self, client, **kwargs):
-        if 'timeout' not in kwargs or kwargs['timeout'] is None:
-            kwargs['timeout'] = 60
-        if 'newline' not in kwargs or kwargs['newline'] is None:
-            kwargs['newline'] = '\r'
-        if 'buffer_size' not in kwargs or kwargs['buffer_size'] is None:
-            kwargs['buffer_size'] = 1024
-        if 'display' not in kwargs or kwargs['display'] is None:
-            kwargs['display'] = False
-        if 'conn_type' not in kwargs or kwargs['conn_type'] is None:
-            self.conn_type = ''
-        else:
-            self.conn_type = kwargs['conn_type']
-        SSHClientInteraction.__init__(self, client, kwargs['timeout'],
-                                      kwargs['newline'], kwargs['buffer_size'],
-                                      kwargs['display'])
-
-
-class ProvisionApic(Machine):
-    def __init__(self, opts):
-        self.cimc = opts['cimc_ip']
-        self.cimc_username = opts['cimc_username']
-        self.cimc_password = opts['cimc_password']
-        self.apic_password = opts['apic_admin_password']
-        if opts['verbose'] == "True":
-            self.verbose = True
-        else:
-            self.verbose = False
-        if opts['quiet'] == 'True':
-            self.quiet = True
-        else:
-            self.quiet = False
-        if opts['simulator'] == True:
-            self.simulator = True
-        else:
-            self.simulator = False
-        self.fabric_name = opts['fabric_name']
-        self.num_controllers = opts['number_of_controllers']
-        self.controller_id = opts['controller_number']
-        self.controller_name = opts['controller_name']
-        self.tep_address_pool = opts['tep_address_pool']
-        self.infra_vlan_id = opts['infra_vlan_id']
-        self.bd_mc_address_pool = opts['bd_mc_addresses']
-        self.oob_ip_addr = opts['oob_ip_address']
-        self.oob_def_gw = opts['oob_default_gateway']
-        self.int_speed = opts['int_speed']
-        self.strong_passwd = opts['strong_passwords']
-        # Used to execute commands in CIMC
-        self.cimc_client = None
-        # Used to do things on the APIC, has to go through CIMC first of course
-        self.apic_client = None
-        self.cimc_interact = None
-        self.provided_fabric_name = False
-        self.states = [
-            # Start and initialization states
-            {'name': 'start'},
-            {'name': 'connect_cimc', 'on_enter': 'on_enter_connect_cimc'},
-            # CIMC related states
-            {'name': 'check_sol', 'on_enter': 'on_enter_check_sol'},
-            {'name': 'configure_sol', 'on_enter': 'on_enter_configure_sol'},
-            {'name': 'disconnect_cimc', 'on_enter': 'on_enter_disconnect_cimc'},
-            {'name': 'cycle_host', 'on_enter': 'on_enter_cycle_host'},
-            # APIC specific initialization states
-            {'name': 'connect_apic', 'on_enter': 'on_enter_connect_apic'},
-            {'name': 'logout_apic', 'on_enter': 'on_enter_logout_apic'},
-            {'name': 'login_apic', 'on_enter': 'on_enter_login_apic'},
-            {'name': 'password_login_apic', 'on_enter': 'on_enter_password_login_apic'},
-            {'name': 'eraseconfig', 'on_enter': 'on_enter_eraseconfig'},
-            # Setup script related states
-            {'name': 'press_any_key', 'on_enter': 'on_enter_press_any_key'},
-            {'name': 'provide_fabric_name', 'on_enter': 'on_enter_provide_fabric_name'},
-            {'name': 'provide_number_ctrlrs', 'on_enter': 'on_enter_provide_number_ctrlrs'},
-            {'name': 'provide_ctrlr_id', 'on_enter': 'on_enter_provide_ctrlr_id'},
-            {'name': 'provide_ctrlr_name', 'on_enter': 'on_enter_provide_ctrlr_name'},
-            {'name': 'provide_tep_addr_pool', 'on_enter': 'on_enter_provide_tep_addr_pool'},
-            {'name': 'provide_infra_vlan_id', 'on_enter': 'on_enter_provide_infra_vlan_id'},
-            {'name': 'provide_bd_mc_addr_pool', 'on_enter': 'on_enter_provide_bd_mc_addr_pool'},
-            {'name': 'provide_oob_address', 'on_enter': 'on_enter_provide_oob_address'},
-            {'name': 'provide_oob_def_gw', 'on_enter': 'on_enter_provide_oob_def_gw'},
-            {'name': 'provide_int_speed', 'on_enter': 'on_enter_provide_int_speed'},
-            {'name': 'provide_strong_passwd', 'on_enter': 'on_enter_provide_strong_passwd'},
-            {'name': 'provide_admin_passwd', 'on_enter': 'on_enter_provide_admin_passwd'},
-            {'name': 'provide_modify_config', 'on_enter': 'on_enter_provide_modify_config'},
-        ]
-        Machine.__init__(self, states=self.states, initial='start')
-
-        self.add_transition(trigger='start', source='start', dest='connect_cimc')
-
-        self.add_transition(trigger='cimc_prompt_detected',
-                            source='connect_cimc',
-                            dest='check_sol')
-
-        self.add_transition(trigger='sol_not_configured',
-                            source='check_sol',
-                            dest='configure_sol')
-
-        self.add_transition(trigger='sol_config_committed',
-                            source='configure_sol',
-                            dest='check_sol')
-
-        self.add_transition(trigger='cycle_host',
-                            source='connect_apic',
-                            dest='cycle_host')
-
-        # We can enter the connect_apic state from multiple sources, this states
-        # entry callback will need to be smarter than the average bear.
-        self.add_transition(trigger='connect_to_apic',
-                            source=['check_sol', 'logout_apic'],
-                            dest='connect_apic')
-
-        self.add_transition(trigger='apic_prompt_detected',
-                            source='connect_apic',
-                            dest='logout_apic')
-
-        self.add_transition(trigger='apic_login_detected',
-                            source=['connect_apic', 'logout_apic', 'password_login_apic',
-                                    'cycle_host'],
-                            dest='login_apic')
-
-        self.add_transition(trigger='apic_password_detected',
-                            source=['connect_apic', 'cycle_host'],
-                            dest='password_login_apic')
-
-        self.add_transition(trigger='apic_prompt_detected',
-                            source=['login_apic', 'cycle_host'],
-                            dest='eraseconfig')
-
-        self.add_transition(trigger='press_any_key',
-                            source=['connect_apic', 'eraseconfig', 'cycle_host'],
-                            dest='press_any_key')
-
-        # This transition can happen from connect_apic or provide_modify_config
-        self.add_transition(trigger='enter_fabric_name',
-                            source=['connect_apic', 'provide_modify_config', 'press_any_key'],
-                            dest='provide_fabric_name')
-
-        self.add_transition(trigger='enter_num_ctrlrs',
-                            source=['connect_apic', 'provide_fabric_name'],
-                            dest='provide_number_ctrlrs')
-
-        self.add_transition(trigger='enter_ctrlr_id',
-                            source=['connect_apic', 'provide_number_ctrlrs'],
-                            dest='provide_ctrlr_id')
-
-        self.add_transition(trigger='enter_ctrlr_name',
-                            source=['connect_apic', 'provide_ctrlr_id'],
-                            dest='provide_ctrlr_name')
-
-        self.add_transition(trigger='enter_tep_addr_pool',
-                            source=['connect_apic', 'provide_ctrlr_name'],
-                            dest='provide_tep_addr_pool')
-
-        self.add_transition(trigger='enter_infra_vlan_id',
-                            source=['connect_apic', 'provide_tep_addr_pool'],
-                            dest='provide_infra_vlan_id')
-
-        self.add_transition(trigger='enter_bd_mc_addr_pool',
-                            source=['connect_apic', 'provide_infra_vlan_id'],
-                            dest='provide_bd_mc_addr_pool')
-
-        self.add_transition(trigger='enter_oob_ip_addr',
-                            source=['connect_apic',
-                                    'provide_bd_mc_addr_pool',
-                                    'provide_infra_vlan_id'],
-                            dest='provide_oob_address')
-
-        self.add_transition(trigger='enter_oob_def_gw',
-                            source=['connect_apic', 'provide_oob_address'],
-                            dest='provide_oob_def_gw')
-
-        self.add_transition(trigger='enter_int_speed',
-                            source=['connect_apic', 'provide_oob_def_gw'],
-                            dest='provide_int_speed')
-
-        self.add_transition(trigger='enter_strong_passwd',
-                            source=['connect_apic', 'provide_int_speed'],
-                            dest='provide_strong_passwd')
-
-        self.add_transition(trigger='enter_admin_passwd',
-                            source=['connect_apic', 'provide_strong_passwd'],
-                            dest='provide_admin_passwd')
-
-        self.add_transition(trigger='reenter_admin_passwd',
-                            source=['connect_apic', 'provide_admin_passwd'],
-                            dest='provide_admin_passwd')
-
-        self.add_transition(trigger='enter_edit_cfg',
-                            source=['connect_apic', 'provide_admin_passwd', 'provide_int_speed'],
-                            dest='provide_modify_config')
-
-        self.add_transition(trigger='restart_setup',
-                            source='provide_modify_config',
-                            dest='provide_fabric_name')
-
-    def on_enter_connect_cimc(self):
-        prompt = r'.*C220.*# '
-        self.cimc_client = paramiko.SSHClient()
-        self.apic_client = paramiko.SSHClient()
-        self.cimc_client.load_system_host_keys()
-        self.apic_client.load_system_host_keys()
-        self.cimc_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        self.apic_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-
-        try:
-            self.log("Connecting to {0} as user {1} for CIMC control.".format(self.cimc,
-                                                                              self.cimc_username),
-                     print_only=True)
-            # TODO: put these in different threads to speed up connecting
-            self.cimc_client.connect(hostname=self.cimc, username=self.cimc_username,
-                                     password=self.cimc_password, look_for_keys=False)
-            self.log("Connecting to {0} as user {1} for APIC control.".format(self.cimc,
-                                                                              self.cimc_username),
-                     print_only=True)
-            self.apic_client.connect(hostname=self.cimc, username=self.cimc_username,
-                                     password=self.cimc_password, look_for_keys=False)
-        except paramiko.ssh_exception.PasswordRequiredException, err:
-            print("Unable to connect to CIMC - Password is required because: {0}".format(err))
-            sys.exit(-1)
-
-        self.cimc_interact = WiperApicInteract(self.cimc_client, timeout=10, display=self.verbose,
-                                               conn_type='cimc')
-        self.cimc_interact.send('\n')
+# Local imports
+from cache import load_cache
+from checkpoint import CHECKPOINT_DIR, Checkpoint
+from inventory import InventoryError, interpolate, load_inventory
+from jobqueue import JobQueue
+from probe import apply_report
+from retry import retry_policies
+from metrics import metrics_for
+from scheduler import check_leaders
+
+# Options that name files, made absolute when the APICs are provisioned from another directory
+PATH_OPTIONS = ['archive', 'ini_file', 'cache_file', 'checkpoint_dir', 'event_log',
+                'history_file', 'inventory_cache', 'metrics', 'probe_report', 'record',
+                'xml_api_cafile']
+
+
+def resolve_section(option_names, values, opts):
+    """ The options of a CIMC, the CLI options override the options in the inventory.
+
+    Args:
+        option_names (list): The names of the options to resolve.
+        values (dict): The options of the CIMC section, merged over the DEFAULT options.
+        opts (dict): The CLI options.
+    """
+    new_opts = {}
+    for name in option_names:
+        if name in opts:
+            new_opts[name] = opts[name]
+        elif name in values:
+            new_opts[name] = interpolate(name, values, opts)
+        # Missing options are optional settings, missing required ones are reported by
+        # check_required_options
+    return new_opts
 
-        self.apic_interact = WiperApicInteract(self.apic_client, timeout=10, display=self.verbose,
-                                               conn_type='apic')
-        self.apic_interact.send('\n')
 
-        try:
-            self.cimc_interact.expect(prompt)
-            self.clear_interact_output(self.cimc_interact)
-            self.apic_interact.expect(prompt)
-            self.clear_interact_output(self.apic_interact)
+def parse_ini(option_names, opts):
+    inventory = load_inventory(opts['ini_file'], opts.get('inventory_cache'))
 
-        except:
-            print("Failed to detect CIMC prompt using '{0}'".format(prompt))
-            raise
+    if inventory is None:
+        return None
 
-    def on_enter_check_sol(self):
-        prompt = r'.*C220.*# '
-        self.log("Ensuring Serial Over LAN is configured properly.", print_only=True)
-        while True:
-            self.do_cmd('show sol', prompt, self.cimc_interact)
-            try:
-                sol_list = re.split(r'\s*', self.cimc_interact.current_output_clean.split('\n')[2])
-                sol_enabled, sol_baud, sol_com = sol_list[0], sol_list[1], sol_list[2]
-                if 'yes' not in sol_enabled or '115200' not in sol_baud or 'com0' not in sol_com:
-                    self.log("Could not configure sol properly, trying again in 3 seconds")
-                    time.sleep(3)
-                    self.log("Serial Over LAN is not configured, moving to configure it.",
-                             print_only=True)
-                    self.sol_not_configured()
-                else:
-                    self.log("Serial Over LAN is configured.", print_only=True)
-                    return
-            except (KeyError, IndexError):
-                self.log("The command output for 'show sol' was not valid, trying again.",
-                         print_only=True)
-
-    def on_enter_configure_sol(self):
-        sol_prompt = r'C220-.* /sol # '
-        sol_needs_commit_prompt = r'C220-.* /sol \*# '
-        top_prompt = r'C220-.*# '
-        cmds = list()
-        cmds.append(('scope sol', sol_prompt, True, 10))
-        cmds.append(('set baud-rate 115200', sol_needs_commit_prompt, True, 10))
-        cmds.append(('set comport com0', sol_needs_commit_prompt, True, 10))
-        cmds.append(('set enabled yes', sol_needs_commit_prompt, True, 10))
-        cmds.append(('commit', sol_prompt, True, 30))
-        cmds.append(('top', top_prompt, True, 10))
-        self.do_cmds(cmds, self.cimc_interact)
-        self.log("Serial Over LAN is configured.", print_only=True)
-        self.sol_config_committed()
-
-    def on_enter_connect_apic(self):
-        # When we see one of these regex's we transition to the specified state.
-        transitions = {
-            r'.*login:.*': self.apic_login_detected,
-            r'.*Password:.*': self.apic_password_detected,
-            r'.*:~> ': self.apic_prompt_detected,
-            r'.*Press any key to continue....*': self.press_any_key,
-            r'.*Enter the fabric name \[.*\]:.*': self.enter_fabric_name,
-            r'.*Enter the number of controllers in the fabric \(1-[1-5]\) \[[0-9]+]:.*':
-                self.enter_num_ctrlrs,
-            r'.*Enter the controller ID \(1-[1-5]\) \[[0-9]+\]:.*': self.enter_ctrlr_id,
-            r'.*Enter the controller name \[.*\]:.*': self.enter_ctrlr_name,
-            r'.*Enter address pool for TEP addresses \[.*\]:.*': self.enter_tep_addr_pool,
-            r'.*Enter the VLAN ID for infra network \(1-4094\).*:.*': self.enter_infra_vlan_id,
-            r'.*Enter address pool for BD multicast addresses \(GIPO\) \[.*\]:.*':
-                self.enter_bd_mc_addr_pool,
-            r'.*Enter the IP address \[.*\].*': self.enter_oob_ip_addr,
-            r'.*Enter the IP address of the default gateway \[.*\]:.*': self.enter_oob_def_gw,
-            r'.*Enter the interface speed/duplex mode \[.*\]:.*': self.enter_int_speed,
-            r'.*Enable strong passwords\? \[.*\]:.*': self.enter_strong_passwd,
-            r'.*Enter the password for admin:.*': self.enter_admin_passwd,
-            r'.*Reenter the password for admin:.*': self.reenter_admin_passwd,
-            r'.*Would you like to edit the configuration\? \(y/n\) \[.*\].*': self.enter_edit_cfg,
-        }
-        # connect to the APIC console and send a newline
-        try:
-            self.log("Trying to connect to the APIC console via Serial Over LAN, " +
-                     "using a timeout of 10 seconds.", print_only=True)
-            index = self.do_cmd("connect host\n", transitions.keys(), self.apic_interact,
-                                clear_outputs=True)
-        except socket.timeout:
-            # Unable to connect to CIMC, try to power cycle the host
-            self.log("No prompt seen from the APIC, will try to power cycle the host.")
-            self.cycle_host()
-            return
-        # Transition to the state needed by the prompt we get back.
-        transitions[transitions.keys()[index]]()
-
-    def on_enter_cycle_host(self):
-        # If you connect to the APIC via KVM and start the initial setup script, the console (ttyS0)
-        # is no longer connected/updating.  So we have to cycle the host to recover.
-        chassis_prompt = r'C220-.* /chassis # '
-        power_cycle_prompt = r'.*Do you want to continue\?\[.*\].*'
-        top_prompt = r'C220-.*# '
-        cmds = list()
-        cmds.append(('scope chassis', chassis_prompt, True, 10))
-        cmds.append(('power cycle', power_cycle_prompt, True, 10))
-        cmds.append(('y', chassis_prompt, True, 10))
-        cmds.append(('top', top_prompt, True, 10))
-        self.log("Sending APIC power cycle commands to CIMC.", print_only=True)
-        self.do_cmds(cmds, self.cimc_interact)
-        # hopefully we would only end up at press any key, not sure how we end up in the others
-        # after no response from the APIC.
-        transitions = {
-            r'.*login:.*': self.apic_login_detected,
-            r'.*Password:.*': self.apic_password_detected,
-            r'.*:~> ': self.apic_prompt_detected,
-            r'.*Press any key to continue....*': self.press_any_key,
-        }
-        self.log("Waiting on a power cycle for up to 600 seconds.", print_only=True)
-        try:
-            index = self.apic_interact.expect(transitions.keys(), timeout=600)
-        except socket.timeout:
-            print "Unable to get a response from the controller after a power cycle."
-            print "Please verify that the controller software is installed correctly"
-            print "and that the controller boots up fine."
-            raise
-        transitions[transitions.keys()[index]]()
-
-    def on_enter_disconnect_cimc(self):
-        self.log("Disconnecting from both CIMC and the APIC by closing the connections.",
-                 print_only=True)
-        self.cimc_client.close()
-        self.apic_client.close()
-        self.cimc_client = self.apic_client = None
-
-    def on_enter_logout_apic(self):
-        prompt = r'.*login:.*'
-        self.log("Found a CLI prompt on the APIC, logging out.", print_only=True)
-        self.do_cmd("exit", prompt, self.apic_interact)
-        self.apic_login_detected()
-
-    def on_enter_login_apic(self):
-        prompts = [
-            r'.*Password:.*',
-            r'.*~> .*',
-        ]
-        self.log("Found a login prompt on the APIC, logging in as 'rescue-user'.", print_only=True)
-        index = self.do_cmd('rescue-user', prompts, self.apic_interact)
-        if index == 0:
-            # Typically this would be APIC1
-            prompt = r'.*~> .*'
-            self.log("Rescue-user was prompted for a password, sending the APIC admin password.",
-                     print_only=True)
-            # We need some extra time here because we may have just booted.
-            self.do_cmd(self.apic_password, prompt, self.apic_interact, timeout=60)
-            self.apic_prompt_detected()
-        elif index == 1:
-            self.log("Found a CLI prompt on the apic.", print_only=True)
-            self.apic_prompt_detected()
-        else:
-            raise ValueError("Index was invalid, this should never happen")
-
-    def on_enter_password_login_apic(self):
-        prompt = r'.*login:.*'
-        self.log("Login was already started, sending ctrl-d to start over.", print_only=True)
-        # Send a control-d (EOF) to start the login process over.
-        self.do_cmd(chr(4), prompt, self.apic_interact)
-        self.apic_login_detected()
-
-    def on_enter_eraseconfig(self):
-        prompt = (r'.*Do you want to cleanup the initial setup data\? The system will be ' +
-                  r'REBOOTED. \(Y/n\):.*')
-        self.log("Sending 'eraseconfig setup' command to the APIC", print_only=True)
-        self.do_cmd('eraseconfig setup', prompt, self.apic_interact)
-        prompt = r'.*Press any key to continue....*'
-        self.log("Sending 'Y' to continue with the eraseconfig setup, will wait for the reboot, " +
-                 "timeout is 600 seconds.", print_only=True)
-        self.do_cmd('Y', prompt, self.apic_interact, timeout=600)
-        self.press_any_key()
-
-    def on_enter_press_any_key(self):
-        prompt = r'.*Enter the fabric name \[.*\]:.*'
-        self.log("Starting the setup script on the APIC.", print_only=True)
-        # May need to wrap this in a try/except for socket.timeout if someone is able to catch
-        # steal the I/O on KVM before we get started, seems like a very unlikely thing to have
-        # happen though
-        self.do_cmd("", prompt, self.apic_interact)
-        self.enter_fabric_name()
-
-    def on_enter_provide_fabric_name(self):
-        prompt = r'.*Enter the number of controllers in the fabric \(1-9\) \[[0-9]+]:.*'
-        self.log("Setting the fabric name to '{0}' on the APIC.".format(self.fabric_name),
-                 print_only=True)
-        self.do_cmd(self.fabric_name, prompt, self.apic_interact)
-        self.provided_fabric_name = True
-        self.enter_num_ctrlrs()
-
-    def on_enter_provide_number_ctrlrs(self):
-        prompt = r'.*Enter the controller ID \(1-[1-5]\) \[[0-9]+\]:.*'
-        self.log("Setting number of controllers to '{0}' on the APIC.".format(self.num_controllers),
-                 print_only=True)
-        self.do_cmd(self.num_controllers, prompt, self.apic_interact)
-        self.enter_ctrlr_id()
-
-    def on_enter_provide_ctrlr_id(self):
-        prompt = r'.*Enter the controller name \[.*\]:.*'
-        self.log("Setting the controller id to '{0}' on the APIC.".format(self.controller_id),
-                 print_only=True)
-        self.do_cmd(self.controller_id, prompt, self.apic_interact)
-        self.enter_ctrlr_name()
-
-    def on_enter_provide_ctrlr_name(self):
-        prompt = r'.*Enter address pool for TEP addresses \[.*\]:.*'
-        self.log("Setting the controller name to '{0}' on the APIC.".format(self.controller_name),
-                 print_only=True)
-        self.do_cmd(self.controller_name, prompt, self.apic_interact)
-        self.enter_tep_addr_pool()
-
-    def on_enter_provide_tep_addr_pool(self):
-        prompt = r'.*Enter the VLAN ID for infra network \(1-4094\).*:.*'
-        self.log("Setting the TEP Address Pool to '{0}' on the APIC.".format(self.tep_address_pool),
-                 print_only=True)
-        self.do_cmd(self.tep_address_pool, prompt, self.apic_interact)
-        self.enter_infra_vlan_id()
-
-    def on_enter_provide_infra_vlan_id(self):
-        # APICs other than APIC1 go to a different prompt.
-        prompts = [
-            r'.*Enter address pool for BD multicast addresses \(GIPO\) \[.*\]:.*',
-            r'.*Enter the IP address \[.*\].*',
-        ]
-        self.log("Setting the infra VLAN ID to '{0}' on the APIC.".format(self.infra_vlan_id),
-                 print_only=True)
-        index = self.do_cmd(self.infra_vlan_id, prompts, self.apic_interact)
-        if index == 0:
-            self.enter_bd_mc_addr_pool()
-        elif index == 1:
-            self.enter_oob_ip_addr()
-
-    def on_enter_provide_bd_mc_addr_pool(self):
-        prompt = r'.*Enter the IP address \[.*\].*'
-        self.log("Setting the BD Multicast Address Pool to '{0}' on the APIC".format(
-            self.bd_mc_address_pool),
-                 print_only=True)
-        self.do_cmd(self.bd_mc_address_pool, prompt, self.apic_interact)
-        self.enter_oob_ip_addr()
-
-    def on_enter_provide_oob_address(self):
-        prompt = r'.*Enter the IP address of the default gateway \[.*\]:.*'
-        self.log("Setting the Out Of Band IP address to {0} on the APIC.".format(self.oob_ip_addr),
-                 print_only=True)
-        self.do_cmd(self.oob_ip_addr, prompt, self.apic_interact)
-        self.enter_oob_def_gw()
-
-    def on_enter_provide_oob_def_gw(self):
-        prompt = r'.*Enter the interface speed/duplex mode \[.*\]:.*'
-        self.log("Setting the Out Of Band default gateway to {0} ".format(self.oob_def_gw) +
-                 "on the APIC", print_only=True)
-        self.do_cmd(self.oob_def_gw, prompt, self.apic_interact)
-        self.enter_int_speed()
-
-    def on_enter_provide_int_speed(self):
-        prompts = [
-            r'.*Enable strong passwords\? \[.*\]:.*',
-            r'.*Would you like to edit the configuration\? \(y/n\) \[.*\].*',
-        ]
-        self.log("Setting the Out Of Band interface speed/duplex to {0} ".format(self.int_speed) +
-                 "on the APIC.", print_only=True)
-        index = self.do_cmd(self.int_speed, prompts, self.apic_interact)
-        if index == 0:
-            # We are on APIC1
-            self.enter_strong_passwd()
-        elif index == 1:
-            # We are not on APIC1
-            self.enter_edit_cfg()
-        else:
-            # Should never happen
-            raise ValueError("Index can not be {0}".format(index) + " here.")
-
-    def on_enter_provide_strong_passwd(self):
-        prompt = r'.*Enter the password for admin:.*'
-        self.log("Sending '{0}' for enabling strong passwords ".format(self.strong_passwd) +
-                 "on the APIC", print_only=True)
-        self.do_cmd(self.strong_passwd, prompt, self.apic_interact)
-        self.enter_admin_passwd()
-
-    def on_enter_provide_admin_passwd(self):
-        prompts = [
-            r'.*Reenter the password for admin:.*',
-            r'.*Would you like to edit the configuration\? \(y/n\) \[.*\].*',
-        ]
-        self.log("Setting the admin password on the APIC.", print_only=True)
-        index = self.do_cmd(self.apic_password, prompts, self.apic_interact)
-        if index == 0:
-            prompt = r'.*Would you like to edit the configuration\? \(y/n\) \[.*\].*'
-            self.log("Resending the admin password to the APIC.", print_only=True)
-            self.do_cmd(self.apic_password, prompt, self.apic_interact)
-        self.enter_edit_cfg()
-
-    def on_enter_provide_modify_config(self):
-        if self.provided_fabric_name:
-            self.log("Completed a full setup script attempt, waiting for the APIC login prompt " +
-                     "for up to 60 seconds.", print_only=True)
-            self.do_cmd('n', r'.*login:.*', self.apic_interact, timeout=60)
-        else:
-            prompt = r'.*Enter the fabric name \[.*\]:.*'
-            self.log("Setting the fabric name to '{0}' on the APIC.".format(self.fabric_name),
-                 print_only=True)
-            self.do_cmd('y', prompt, self.apic_interact)
-            self.enter_fabric_name()
-
-    def do_cmds(self, cmd_list, interact, clear_outputs=True):
-        """ Do multiple commands in a row
-
-        Each command needs to have its prompt defined.  This does not allow
-        identification of which prompt matched.
-
-        Args:
-            cmd_list (list of tuples):  A list of tuples in the form:
-
-                (cmd, prompt)
-
-            cmd is a string and prompt could be a string or a list of strings.
-        """
-        self.log("Sending a bulk set of commands to {0}".format(interact.conn_type))
-        for cmd_prompt in cmd_list:
-            if len(cmd_prompt) == 2:
-                self.do_cmd(cmd_prompt[0], cmd_prompt[1], interact,
-                            clear_outputs=clear_outputs)
-            elif len(cmd_prompt) == 3:
-                self.do_cmd(cmd_prompt[0], cmd_prompt[1], interact,
-                            clear_outputs=cmd_prompt[2])
-            elif len(cmd_prompt) == 4:
-                self.do_cmd(cmd_prompt[0], cmd_prompt[1], interact,
-                            clear_outputs=cmd_prompt[2], timeout=cmd_prompt[3])
-            else:
-                raise ValueError("Invalid command tuple do_cmds {0}".format(
-                    cmd_prompt))
-
-    def do_cmd(self, cmd, prompt, interact, **kwargs):
-        """ Do a command and expect a prompt.
-
-        Args:
-            cmd (str): the command to run
-            prompt (str or list): the prompt to expect
-            clear_outputs (bool): TODO
-            timeout (int): The time to wait before timing out the command
-
-        Raises:
-            Exception: Could raise an exception on send or expect.
-
-        Returns:
-            int: The index in the prompts list that matched.
-        """
-        if 'clear_outputs' not in kwargs or kwargs['clear_outputs'] is None:
-            clear_outputs = True
-        if 'timeout' not in kwargs or kwargs['timeout'] is None:
-            timeout = 10
-
-        if not interact:
-            raise RuntimeError("Paramiko-expect interact not initialized yet")
-        if clear_outputs is True:
-            self.clear_interact_output(interact)
-        try:
-            self.log("Sending cmd: '{0}'".format(cmd), debug_only=True)
-            interact.send(str(cmd))
-        except:
-            print("Failed to send the command: '{0}'".format(cmd))
-            raise
-        try:
-            self.log("Expecting prompt: '{0}' with a timeout of {1} seconds".format(prompt,
-                                                                                    timeout),
-                     debug_only=True)
-            return interact.expect(prompt, timeout=timeout)
-        except socket.timeout:
-            print("Failed to detect the prompt using: '{0}'".format(prompt))
-            print("current_output: {0}".format(interact.current_output))
-            raise
+    # CIMC IP address is used to load in the config for the specific controller
+    # if the config option does not exist for that controller, it falls back to the DEFAULT section
+    cimc_ip = opts['cimc_ip']
+    values = inventory.section(cimc_ip)
+    if values is None:
+        if opts.get('quiet') != 'True':
+            print("There is no section for {0} in '{1}', only its DEFAULT options are used.".format(
+                cimc_ip, opts['ini_file']))
+        values = inventory.defaults
+    return resolve_section(option_names, values, opts)
 
-    def clear_interact_output(self, interact):
-        if not interact:
-            raise RuntimeError("Paramiko-expect interact not initialized yet")
-        self.log("Clearing interact output for - {0}".format(interact.conn_type), debug_only=True)
-        interact.current_output = ''
-        interact.current_output_clean = ''
 
+def parse_ini_sections(option_names, opts):
+    """ Resolve the options for every CIMC section in the ini file.
 
-    def log(self, message, debug_only=False, print_only=False):
-        if not self.quiet and not debug_only:
-            print(message)
-        if self.verbose and not print_only:
-            logging.info(message)
+    Each non-DEFAULT section is treated as a CIMC ip address, CLI options still override both the
+    section and the DEFAULT options.
 
-def parse_ini(option_names, opts):
-    parser = ConfigParser.SafeConfigParser()
-    found_ini_file = parser.read([opts['ini_file']])
+    Returns:
+        list: A list of option dictionaries, one per CIMC section, or None if there is no ini file.
+    """
+    inventory = load_inventory(opts['ini_file'], opts.get('inventory_cache'))
 
-    if not found_ini_file:
+    if inventory is None:
         return None
 
-    # CIMC IP address is used to load in the config for the specific controller
-    # if the config option does not exist for that controller, it falls back to the DEFAULT section
-    cimc_ip = opts['cimc_ip']
-
-    new_opts = {}
-    for name in option_names:
-        try:
-            new_opts[name] = parser.get(cimc_ip, name, vars=opts)
-        except ConfigParser.NoSectionError:
-            return opts
-    return new_opts
+    node_opts = []
+    for cimc_ip, values in inventory.sections():
+        section_vars = dict(opts)
+        section_vars['cimc_ip'] = cimc_ip
+        node_opts.append(resolve_section(option_names, values, section_vars))
+    return node_opts
 
 
-def parse_args():
+def parse_args(argv=None):
     parser = ArgumentParser('Provision APICs via CIMC Serial Over LAN')
 
+    parser.add_argument('-ar', '--archive', required=False, default=None,
+                        help='Write a compressed archive of the consoles of each APIC into this ' +
+                             'directory, indexed by state and prompt, see archive.py.  Only the ' +
+                             'threads engine writes archives.')
+
     parser.add_argument('-ap', '--apic_admin_password', required=False, default=None,
                         help='The APIC admin user password to enter into the APIC setup script.')
 
@@ -769,7 +230,23 @@ def parse_args():
                         help='The Bridge Domain Multicast address range to enter into the APIC ' +
                              'setup script.')
 
-    parser.add_argument('cimc_ip', help='CIMC hostname or IP address used to ssh to CIMC')
+    parser.add_argument('-bc', '--batch-cimc', required=False, default='False',
+                        action='store_const', const='True',
+                        help='Send the CIMC commands that configure Serial Over LAN or power ' +
+                             'cycle the host in one write and check them from the output, ' +
+                             'sending them one at a time when that fails.  See batch.py.')
+
+    parser.add_argument('cimc_ip', nargs='?', default=None,
+                        help='CIMC hostname or IP address used to ssh to CIMC')
+
+    parser.add_argument('-cf', '--cache-file', required=False, default=None,
+                        help='Where to remember the CIMCs found with Serial Over LAN configured, ' +
+                             'they are not checked again.  Defaults to ~/.wiper_cache.json')
+
+    parser.add_argument('-cd', '--checkpoint-dir', required=False, default=None,
+                        help='Where to keep how far the provisioning of each APIC got, an ' +
+                             'interrupted run is resumed from there by the next one.  Defaults ' +
+                             'to ~/.wiper_checkpoints, only the threads engine keeps checkpoints.')
 
     parser.add_argument('-cna', '--controller-name', required=False, default=None,
                         help='The controller name to enter into the APIC setup script.')
@@ -780,11 +257,29 @@ def parse_args():
     parser.add_argument('-cp', '--cimc_password', required=False, default=None,
                         help='CIMC password')
 
+    parser.add_argument('-cpo', '--cimc-port', required=False, type=str, default=None,
+                        help='The ssh port of CIMC, defaults to 22.')
+
+    parser.add_argument('-ct', '--cache-ttl', required=False, type=str, default=None,
+                        help='The number of seconds a CIMC is remembered for, defaults to a ' +
+                             'day.  0 turns the cache off.')
+
     parser.add_argument('-cu', '--cimc_username', required=False, default=None,
                         help='CIMC username')
 
     parser.add_argument('-i', '--ini-file', required=False, default='wiper.ini',
-                        help='Use an ini file to find parameters to provision an APIC.')
+                        help='Use an ini file to find parameters to provision an APIC.  A CSV ' +
+                             'or JSON inventory can be used instead, see inventory.py.')
+
+    parser.add_argument('-ic', '--invalidate-cache', required=False, default='False',
+                        action='store_const', const='True',
+                        help='Forget what is cached about the CIMC (or every CIMC in the ini ' +
+                             'file with --fleet) and exit without provisioning.')
+
+    parser.add_argument('-inc', '--inventory-cache', required=False, default=None,
+                        help='Where to keep the compiled form of the ini file, it is compiled ' +
+                             'again only when the ini file changes.  Defaults to ' +
+                             '~/.wiper_inventory, an empty value keeps it in memory only.')
 
     parser.add_argument('-is', '--int-speed', required=False, default=None,
                         choices=[
@@ -796,16 +291,66 @@ def parse_args():
                             '1000baseT/Full'
                         ])
 
+    parser.add_argument('-if', '--if-changed', required=False, default='False',
+                        action='store_const', const='True',
+                        help='Read the setup configuration of each APIC before wiping it and ' +
+                             'leave the APICs that already match the options alone, the ' +
+                             'settings that differ are shown.  See drift.py.')
+
     parser.add_argument('-iv', '--infra-vlan-id', required=False, default=None,
                         help='The infra vlan id to enter into the APIC setup script.')
 
+    parser.add_argument('-e', '--engine', required=False, default='threads',
+                        choices=['threads', 'eventloop'],
+                        help='Drive each APIC console from its own thread or drive every console ' +
+                             'from a single event loop, the event loop scales to hundreds of ' +
+                             'APICs.')
+
+    parser.add_argument('-ec', '--echo-console', required=False, default=None,
+                        help='Echo the console output of these APICs to stdout, a comma ' +
+                             'separated list of CIMC ip addresses or all.  A single APIC run ' +
+                             'with --verbose echoes its console.')
+
+    parser.add_argument('-el', '--event-log', required=False, default=None,
+                        help='Write the messages, states and console output of each APIC to ' +
+                             '<cimc>.events.jsonl in this directory, from a background thread ' +
+                             'that samples and drops events rather than slowing the run down.  ' +
+                             'See events.py.')
+
     parser.add_argument('-f', '--fabric-name', required=False, default=None,
                         help='The fabric name to enter into the APIC setup script.')
 
+    parser.add_argument('-F', '--fleet', required=False, default='False', action='store_const',
+                        const='True',
+                        help='Provision every CIMC section of the ini file concurrently.')
+
+    parser.add_argument('-hf', '--history-file', required=False, default=None,
+                        help='Where to keep how long each step took on earlier runs, the long ' +
+                             'waits are sized from it.  Defaults to ~/.wiper_history.json')
+
     #parser.add_argument('-g', '--generate-ini', required=False, default="False",
     #                    action="store_const", const="True",
     #                    help='Generate an ini file with default settings for a specific controller')
 
+    parser.add_argument('-m', '--metrics', required=False, default=None,
+                        help='Write a JSON report of how long each state and command took, and ' +
+                             'a Prometheus textfile collector file (wiper.prom), into this ' +
+                             'directory.')
+
+    parser.add_argument('-mf', '--max-per-fabric', required=False, type=str, default=None,
+                        help='The maximum number of APICs of one fabric provisioned at the same ' +
+                             'time in fleet mode, no limit by default.')
+
+    parser.add_argument('-ms', '--max-per-subnet', required=False, type=str, default=None,
+                        help='The maximum number of APICs provisioned at the same time through ' +
+                             'one CIMC management subnet in fleet mode, no limit by default.  ' +
+                             'See --subnet-prefix.')
+
+    parser.add_argument('-nr', '--no-resume', required=False, default='False',
+                        action='store_const', const='True',
+                        help='Start from the beginning even if an earlier run of an APIC was ' +
+                             'interrupted, see --checkpoint-dir.')
+
     parser.add_argument('-nc', '--number-of-controllers', required=False, type=str, default=None,
                         help='The number of controllers to enter into the APIC setup script.')
 
@@ -816,30 +361,112 @@ def parse_args():
     parser.add_argument('-oi', '--oob-ip-address', required=False, default=None,
                         help='The APIC Out-Of-Band IP address to enter into the APIC setup script.')
 
+    parser.add_argument('-pr', '--probe-report', required=False, default=None,
+                        help='The report wiper probe writes (see probe.py), the APICs with the ' +
+                             'most to do are started first and the consoles the probe found ' +
+                             'unresponsive or booting are not waited on or power cycled again.')
+
     parser.add_argument('-q', '--quiet', required=False, default='False', action='store_const',
                         const='True',
                         help='Be quiet, do not provide status messages')
 
+    parser.add_argument('-st', '--separate-transports', required=False, default='False',
+                        action='store_const', const='True',
+                        help='Use a separate ssh connection to CIMC for the APIC console ' +
+                             'instead of a second channel on the same connection.')
+
+    parser.add_argument('-Q', '--queue', required=False, default=None,
+                        help='Add a job for each APIC to this job queue file and exit, the jobs ' +
+                             'are provisioned by wiper worker processes (see worker.py).')
+
+    parser.add_argument('-rec', '--record', required=False, default=None,
+                        help='Record everything sent to and received from the consoles of each ' +
+                             'APIC into a transcript in this directory, see replay.py.  Only ' +
+                             'the threads engine records transcripts.')
+
+    parser.add_argument('-rt', '--retry', required=False, default=None,
+                        help='Change how operations are retried, a list of ' +
+                             'operation:attempts[:backoff[:deadline]] entries.  The operations ' +
+                             'are connect_cimc, cimc_command, check_sol and connect_apic.')
+
     parser.add_argument('-sim', '--simulator', required=False, action="store_const", const='True',
                         default='False',
                         help='This flag identifies the APIC as a simulator.')
 
+    parser.add_argument('-S', '--socket', required=False, default=None,
+                        help='Hand the provisioning to the wiperd daemon listening on this unix ' +
+                             'socket and show its progress, see wiperd.py.')
+
     parser.add_argument('-sp', '--strong-passwords', required=False, default=None,
                         choices=['Y', 'n'],
                         help='Strong password option to enter into the APIC setup script.')
 
+    parser.add_argument('-sn', '--subnet-prefix', required=False, type=str, default=None,
+                        help='The prefix length of the CIMC management subnets limited by ' +
+                             '--max-per-subnet, defaults to 24.')
+
     parser.add_argument('-t', '--tep-address-pool', required=False, default=None,
                         help='The TEP address pool to enter into the APIC setup script.')
 
+    parser.add_argument('-ta', '--type-ahead', required=False, default='False',
+                        action='store_const', const='True',
+                        help='Answer the APIC setup script ahead of its questions and check the ' +
+                             'configuration summary at the end, rather than waiting for each ' +
+                             'question in turn.')
+
     parser.add_argument('-v', '--verbose', required=False, default='False', action='store_const',
                         const='True',
                         help='Enable debugging and be verbose.')
 
-    args = parser.parse_args()
+    parser.add_argument('-wv', '--waves', required=False, default='False', action='store_const',
+                        const='True',
+                        help='Provision the fleet in two waves: start the reboot of every APIC ' +
+                             'without waiting on it, then answer the setup script of each APIC ' +
+                             'as it comes up.  The reboots overlap so a few workers can drive a ' +
+                             'large fleet.  Only for --fleet with the threads engine, the ' +
+                             'eventloop engine already overlaps the reboots.')
+
+    parser.add_argument('-w', '--workers', required=False, type=str, default=None,
+                        help='The maximum number of APICs provisioned at the same time in fleet ' +
+                             'mode, defaults to 10.  With the eventloop engine this is the ' +
+                             'number of threads used to set up ssh connections.')
+
+    parser.add_argument('-xa', '--xml-api', required=False, default=None,
+                        choices=['https', 'http'],
+                        help='Check and configure Serial Over LAN and power cycle the host with ' +
+                             'the CIMC XML API rather than the CLI, falling back to the CLI ' +
+                             'when it fails.  See cimcapi.py.')
+
+    parser.add_argument('-xc', '--xml-api-cafile', required=False, default=None,
+                        help='Verify the certificate of CIMC against the CA certificates in ' +
+                             'this file, it is not verified otherwise.')
+
+    parser.add_argument('-xp', '--xml-api-port', required=False, type=str, default=None,
+                        help='The port of the CIMC XML API, defaults to 443 for https.')
+
+    args = parser.parse_args(argv)
+
+    if args.fleet != 'True' and args.cimc_ip is None:
+        parser.error('cimc_ip is required unless --fleet is used')
 
     if args.verbose == 'True':
         logging.basicConfig(level=logging.INFO)
+    return args
+
 
+def absolute_paths(args, cwd):
+    """ Make the options that name files absolute, relative to cwd. """
+    for name in PATH_OPTIONS:
+        if getattr(args, name, None):
+            setattr(args, name, os.path.join(cwd, os.path.expanduser(getattr(args, name))))
+
+
+def resolve_options(args):
+    """ Combine the CLI arguments with the ini file and check them.
+
+    Returns:
+        list: A list of option dictionaries, one per APIC to provision.
+    """
     option_names = args.__dict__.keys()
     opts = {}
     # Remove any CLI args that were set to None
@@ -847,12 +474,51 @@ def parse_args():
         if args.__dict__[option] is not None:
             opts[option] = args.__dict__[option]
 
-    # Parse an ini file if it exists, pass in the opts to override any options in that ini file.
-    combined_options = parse_ini(option_names, opts)
+    try:
+        if opts['fleet'] == 'True':
+            node_opts = parse_ini_sections(option_names, opts)
+            if not node_opts:
+                print("Unable to run in fleet mode, no CIMC sections found in '{0}'".format(
+                    opts['ini_file']))
+                sys.exit(-1)
+            for node in node_opts:
+                node['log_prefix'] = '[{0}] '.format(node['cimc_ip'])
+        else:
+            # Parse an ini file if it exists, pass in the opts to override any options in that ini
+            # file.
+            combined_options = parse_ini(option_names, opts)
+
+            if combined_options is not None:
+                opts = combined_options
+            node_opts = [opts]
+    except InventoryError, err:
+        print("Unable to use '{0}': {1}".format(opts['ini_file'], err))
+        sys.exit(-1)
+
+    if node_opts[0]['invalidate_cache'] == 'True':
+        invalidate_cache(node_opts)
+        sys.exit(0)
+
+    for opts in node_opts:
+        check_required_options(opts)
+        try:
+            retry_policies(opts.get('retry'))
+            check_scheduler_options(opts)
+            check_engine_options(opts)
+        except ValueError, err:
+            print("{0}{1}".format(opts.get('log_prefix', ''), err))
+            sys.exit(-1)
+    try:
+        check_leaders(node_opts)
+    except ValueError, err:
+        print("Unable to provision the fleet: {0}".format(err))
+        sys.exit(-1)
+    if node_opts[0].get('probe_report'):
+        node_opts = apply_report(node_opts, node_opts[0]['probe_report'])
+    return node_opts
 
-    if combined_options is not None:
-        opts = combined_options
 
+def check_required_options(opts):
     # Ensure we have the required options, otherwise exit
     required_options = [
         'controller_number',
@@ -875,8 +541,8 @@ def parse_args():
         try:
             opts[option_name]
         except KeyError:
-            print("Unable to complete provisioning.  Missing --{0} option".format(
-                option_name.replace('_', '-')))
+            print("{0}Unable to complete provisioning.  Missing --{1} option".format(
+                opts.get('log_prefix', ''), option_name.replace('_', '-')))
             print("")
             print("These options are all required:")
             for option in required_options:
@@ -884,28 +550,167 @@ def parse_args():
             print("")
             print("These can also be set via an ini file.")
             sys.exit(-1)
-    return opts
+
+
+def check_scheduler_options(opts):
+    """ Make sure the worker count and the fleet scheduler limits are numbers, see scheduler.py.
+
+    Raises:
+        ValueError: One of them is not.
+    """
+    workers = opts.get('workers')
+    if workers is not None and not (workers.isdigit() and int(workers) > 0):
+        raise ValueError("Invalid --workers '{0}', at least one worker is needed".format(workers))
+    for name in ['max_per_fabric', 'max_per_subnet', 'subnet_prefix']:
+        value = opts.get(name)
+        if value and not (value.isdigit() and (name != 'subnet_prefix' or int(value) <= 32)):
+            raise ValueError("Invalid --{0} '{1}'".format(name.replace('_', '-'), value))
+
+
+def check_engine_options(opts):
+    """ Make sure the event loop engine is not asked for what only the threads engine does.
+
+    The event loop does not write archives or transcripts, run in waves or resume from checkpoints,
+    so an APIC an interrupted run left rebooting would be erased or power cycled again.
+
+    Raises:
+        ValueError: One of those is asked for.
+    """
+    if opts.get('engine') != 'eventloop':
+        return
+    for name in ['archive', 'record']:
+        if opts.get(name):
+            raise ValueError("--{0} is only supported by the threads engine".format(name))
+    if opts.get('waves') == 'True':
+        raise ValueError("--waves is only supported by the threads engine")
+    if opts.get('no_resume') == 'True':
+        return
+    checkpoint = Checkpoint(opts.get('checkpoint_dir') or CHECKPOINT_DIR, opts['cimc_ip'])
+    if checkpoint.load() is not None:
+        raise ValueError("An interrupted run left a checkpoint in '{0}', only the threads engine "
+                         "resumes it.  Use --engine threads, or --no-resume to start over".format(
+                             checkpoint.path))
+
+
+def invalidate_cache(node_opts):
+    """ Remove the cached state of every node so the next run checks everything again. """
+    cache = load_cache(node_opts[0])
+    for opts in node_opts:
+        removed = cache.invalidate(opts['cimc_ip'])
+        print("{0}Removed {1} cached entries for {2}".format(opts.get('log_prefix', ''), removed,
+                                                            opts['cimc_ip']))
+    cache.save()
+
+
+def write_metrics(node_opts, failures, metrics):
+    """ Record the result of every node and write out the metrics, if --metrics was used. """
+    if metrics is None:
+        return
+    for opts in node_opts:
+        metrics.node_result(opts['cimc_ip'], failures.get(opts['cimc_ip']))
+    metrics.write(node_opts[0]['metrics'])
+
+
+def report_results(node_opts, failures, metrics=None):
+    """ Write out the metrics and show how each node did.
+
+    Returns:
+        int: The exit status of the run.
+    """
+    write_metrics(node_opts, failures, metrics)
+    for opts in node_opts:
+        print("{0}{1}".format(opts.get('log_prefix', ''),
+                              failures.get(opts['cimc_ip'], 'Provisioned')))
+    if failures:
+        return -1
+    return 0
+
+
+def queue_jobs(path, node_opts):
+    """ Add a job for each node to a job queue, see jobqueue.py.
+
+    Returns:
+        int: The exit status.
+    """
+    try:
+        added = JobQueue(path).submit(node_opts)
+    except ValueError, err:
+        print("Unable to queue the APICs: {0}".format(err))
+        return -1
+    print("Queued {0} APICs in '{1}', {2} already had a job waiting or running.".format(
+        added, path, len(node_opts) - added))
+    print("Run 'wiper worker --queue {0}' to provision them.".format(path))
+    return 0
+
+
+def submit_job(socket_path, argv):
+    """ Send the arguments to wiperd and show what it prints while it runs them.
+
+    Returns:
+        int: The exit status of the job.
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(os.path.expanduser(socket_path))
+    except socket.error, err:
+        print("Unable to reach wiperd on '{0}': {1}".format(socket_path, err))
+        return -1
+    client.sendall(json.dumps({'argv': argv, 'cwd': os.getcwd()}) + '\n')
+    for line in client.makefile('r'):
+        message = json.loads(line)
+        if 'exit' in message:
+            return message['exit']
+        for name, stream in (('stdout', sys.stdout), ('stderr', sys.stderr)):
+            if name in message:
+                stream.write(message[name])
+                stream.flush()
+    print("wiperd closed the connection before the job finished.")
+    return -1
 
 
 def main():
-    options = parse_args()
-    pa = ProvisionApic(opts=options)
-
-    # The start transition automatically moves the state to connect_cimc
-    pa.start()
-    # Once connected to CIMC, use the cimc_prompt_detected transition to move
-    # to the check_sol state, when this returns, we know we can connect to the
-    # apic over serial over LAN.
-    pa.cimc_prompt_detected()
-    # SOL is configured, so move the state to connect_apic via the connect_to_apic transition
-    # this is the heart of the provisioning process.  When this returns, the APIC
-    # should be provisioned.
-    pa.connect_to_apic()
-
-    # If we get here and still have a client, disconnect from it and set it to None (just in case)
-    if pa.client is not None:
-        pa.to_disconnect_cimc()
-        pa.client = None
+    if sys.argv[1:2] == ['worker']:
+        # Imported here so --help does not load it
+        from worker import main as worker_main
+        sys.exit(worker_main(sys.argv[2:]))
+    if sys.argv[1:2] == ['probe']:
+        from probe import main as probe_main
+        sys.exit(probe_main(sys.argv[2:]))
+    args = parse_args()
+    if args.socket is not None:
+        sys.exit(submit_job(args.socket, sys.argv[1:]))
+    if args.queue is not None:
+        # The workers may run in another directory or on another host
+        absolute_paths(args, os.getcwd())
+        sys.exit(queue_jobs(args.queue, resolve_options(args)))
+    node_opts = resolve_options(args)
+    workers = int(node_opts[0].get('workers') or 10)
+    # Every node of the run reports to the same recorder
+    metrics = metrics_for(node_opts[0])
+    # Imported here so --help and checking the options do not wait on paramiko
+    from engine import run_engine
+    from provisioner import provision, run_fleet, run_waves
+    if node_opts[0]['engine'] == 'eventloop':
+        print("Provisioning {0} APICs from one event loop.".format(len(node_opts)))
+        failures = run_engine(node_opts, connect_workers=workers, metrics=metrics)
+    elif node_opts[0]['fleet'] != 'True':
+        try:
+            provision(node_opts[0], metrics=metrics)
+        except (Exception, SystemExit, KeyboardInterrupt), err:
+            write_metrics(node_opts, {node_opts[0]['cimc_ip']: repr(err)}, metrics)
+            raise
+        write_metrics(node_opts, {}, metrics)
+        return
+    elif node_opts[0].get('waves') == 'True':
+        print("Provisioning {0} APICs in waves using up to {1} workers.".format(len(node_opts),
+                                                                               workers))
+        failures = run_waves(node_opts, workers, metrics=metrics)
+    else:
+        print("Provisioning {0} APICs using up to {1} workers.".format(len(node_opts), workers))
+        failures = run_fleet(node_opts, workers, metrics=metrics)
+    status = report_results(node_opts, failures, metrics)
+    if status:
+        sys.exit(status)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+
+# wiper - the APIC provisioner
+#
+# Copyright (C) 2015 Cisco Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+"""
+wiperd - a resident wiper that provisions APICs for jobs sent over a unix domain socket.
+
+Automation that calls wiper once per APIC pays for starting python, importing paramiko, parsing the
+ini file and loading the known hosts on every call.  wiperd pays for these once and keeps them, along
+with the run history, the CIMC cache and the CIMCs that need a transport per session, for as long as
+it runs.  A job is the same arguments wiper takes, sent by wiper -S/--socket:
+
+    python wiper/wiperd.py --socket ~/.wiperd.sock --workers 20
+    wiper -S ~/.wiperd.sock -i sample.ini 172.16.176.190
+
+Each job is one JSON line, {"argv": [...], "cwd": "..."}.  Everything the job prints is sent back as
+{"stdout": "..."} and {"stderr": "..."} lines as it happens, followed by {"exit": status} once every
+APIC of the job is done.  The APICs of every job share the --workers threads of the daemon and are
+ordered by one scheduler (see scheduler.py), so a CIMC asked for by two jobs at once is provisioned
+by one and then the other.  A job whose client goes away still runs to the end.
+"""
+
+# Standard Library imports
+from argparse import ArgumentParser
+import json
+import os
+import signal
+import socket
+import SocketServer
+import sys
+import threading
+
+# Local imports
+from connection import system_host_keys
+from metrics import metrics_for
+from provisioner import provision, run_waves
+from scheduler import FleetScheduler
+from wiper import absolute_paths, parse_args, report_results, resolve_options
+
+SOCKET_FILE = '~/.wiperd.sock'
+
+# The job of the thread that is running, if any
+_CURRENT = threading.local()
+
+
+class ThreadOutput(object):
+    """ Stands in for sys.stdout or sys.stderr, sending what a thread writes to the client of its job.
+    """
+    def __init__(self, name, default):
+        self.name = name
+        self.default = default
+
+    def write(self, data):
+        job = getattr(_CURRENT, 'job', None)
+        if job is None:
+            self.default.write(data)
+        elif data:
+            job.send({self.name: data})
+
+    def flush(self):
+        if getattr(_CURRENT, 'job', None) is None:
+            self.default.flush()
+
+
+class Job(object):
+    """ A provisioning request from one client.
+
+    Args:
+        connection (socket.socket): The connection to the client.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.connected = True
+        self.lock = threading.Lock()
+        self.done = threading.Condition(self.lock)
+        self.remaining = 0
+        self.failures = {}
+        # The recorder of the job when --metrics is used, see metrics.py
+        self.metrics = None
+
+    def send(self, message):
+        """ Send a message to the client, once the client has gone away messages are dropped. """
+        data = json.dumps(message) + '\n'
+        with self.lock:
+            if not self.connected:
+                return
+            try:
+                self.connection.sendall(data)
+            except socket.error:
+                self.connected = False
+
+    def start(self, count):
+        with self.lock:
+            self.remaining = count
+
+    def finished(self, cimc_ip, failure=None):
+        """ Called as each APIC of the job is done, failure is why it failed. """
+        with self.lock:
+            if failure is not None:
+                self.failures[cimc_ip] = failure
+            self.remaining -= 1
+            self.done.notify_all()
+
+    def wait(self):
+        """ Wait until every APIC of the job is done.
+
+        Returns:
+            dict: The CIMC ip address of each node that failed mapped to the reason it failed.
+        """
+        with self.lock:
+            while self.remaining > 0:
+                # Waiting with a timeout so a ctrl-c still reaches the daemon
+                self.done.wait(1)
+            return dict(self.failures)
+
+
+class JobHandler(SocketServer.StreamRequestHandler):
+    """ Reads a job from a client and answers with its output and exit status. """
+    def handle(self):
+        job = Job(self.request)
+        _CURRENT.job = job
+        try:
+            request = json.loads(self.rfile.readline())
+            status = self.server.run_job(job, request['argv'], request.get('cwd', '/'))
+        except SystemExit, err:
+            status = exit_status(err)
+        except Exception, err:
+            print("Unable to run the job: {0!r}".format(err))
+            status = -1
+        finally:
+            _CURRENT.job = None
+        job.send({'exit': status})
+
+
+class WiperDaemon(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """ Runs the jobs sent to a unix socket, every APIC is provisioned on a shared worker pool.
+
+    Args:
+        path (str): The unix socket to listen on.
+        workers (int): The maximum number of APICs provisioned at the same time, across every job.
+    """
+    daemon_threads = True
+
+    def __init__(self, path, workers):
+        self.path = path
+        self.workers = workers
+        # Orders the APICs of every job, see scheduler.py
+        self.scheduler = FleetScheduler(workers)
+        # The socket is as secret as the passwords sent over it, so it is created private rather
+        # than changed once it is already listening
+        umask = os.umask(0077)
+        try:
+            SocketServer.UnixStreamServer.__init__(self, path, JobHandler)
+        finally:
+            os.umask(umask)
+        for _ in range(workers):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+
+    def run_job(self, job, argv, cwd):
+        """ Provision the APICs of a job, like wiper does with the same arguments.
+
+        Returns:
+            int: The exit status of the job.
+        """
+        args = parse_args(argv)
+        # The files are relative to the directory of the client rather than the daemon
+        absolute_paths(args, cwd)
+        node_opts = resolve_options(args)
+        if node_opts[0]['engine'] == 'eventloop':
+            # The event loop would provision the APICs outside of the scheduler of the daemon
+            print("--engine eventloop cannot be used for a wiperd job, every APIC of a job is " +
+                  "provisioned by the workers of the daemon.")
+            return -1
+        job.metrics = metrics_for(node_opts[0])
+        if node_opts[0].get('waves') == 'True':
+            print("Provisioning {0} APICs in waves using up to {1} workers.".format(
+                len(node_opts), self.workers))
+            failures = run_waves(
+                node_opts, self.workers,
+                run=lambda wave_opts, workers, metrics: self.run_nodes(job, wave_opts))
+        else:
+            print("Provisioning {0} APICs using up to {1} workers.".format(len(node_opts),
+                                                                           self.workers))
+            failures = self.run_nodes(job, node_opts)
+        return report_results(node_opts, failures, job.metrics)
+
+    def run_nodes(self, job, node_opts):
+        """ Hand the APICs of a job to the workers and wait for them.
+
+        Returns:
+            dict: The CIMC ip address of each node that failed mapped to the reason it failed.
+        """
+        job.start(len(node_opts))
+        for opts in node_opts:
+            self.scheduler.add(opts, data=job)
+        return job.wait()
+
+    def work(self):
+        while True:
+            node = self.scheduler.next()
+            job = node.data
+            _CURRENT.job = job
+            try:
+                provision(node.opts, fleet_node=node, metrics=job.metrics)
+            # SystemExit is caught too, a single node bailing out should not stop the daemon
+            except (Exception, SystemExit), err:
+                print("{0}Provisioning failed: {1!r}".format(node.opts.get('log_prefix', ''),
+                                                            err))
+                job.finished(node.cimc, repr(err))
+            else:
+                job.finished(node.cimc)
+            finally:
+                node.finished()
+                _CURRENT.job = None
+
+
+def exit_status(err):
+    """ The exit status sys.exit would give for a SystemExit. """
+    if err.code is None:
+        return 0
+    if isinstance(err.code, int):
+        return err.code
+    print(err.code)
+    return 1
+
+
+def remove_stale_socket(path):
+    """ Remove the socket left behind by a daemon that is no longer running.
+
+    Raises:
+        RuntimeError: Another daemon is listening on the socket.
+    """
+    if not os.path.exists(path):
+        return
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except socket.error:
+        os.unlink(path)
+        return
+    finally:
+        client.close()
+    raise RuntimeError("wiperd is already listening on '{0}'".format(path))
+
+
+def main():
+    parser = ArgumentParser('Provision APICs for jobs sent over a unix socket by wiper --socket')
+    parser.add_argument('-s', '--socket', default=SOCKET_FILE,
+                        help='The unix socket to listen on, defaults to {0}'.format(SOCKET_FILE))
+    parser.add_argument('-w', '--workers', type=int, default=10,
+                        help='The maximum number of APICs provisioned at the same time across ' +
+                             'every job, defaults to 10.')
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("at least one worker is needed")
+
+    path = os.path.expanduser(args.socket)
+    try:
+        remove_stale_socket(path)
+    except RuntimeError, err:
+        print(err)
+        sys.exit(-1)
+    # Parsed now so the first job does not wait on it
+    system_host_keys()
+    server = WiperDaemon(path, args.workers)
+    sys.stdout = ThreadOutput('stdout', sys.stdout)
+    sys.stderr = ThreadOutput('stderr', sys.stderr)
+    print("wiperd is listening on '{0}' with {1} workers.".format(path, args.workers))
+    # Stopped like a ctrl-c so the socket is removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+# wiper - the APIC provisioner
+#
+# Copyright (C) 2015 Cisco Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+"""
+wiper worker - provision the APICs of a job queue, see jobqueue.py.
+
+Any number of workers can take jobs from the same queue, on the same host to use more than one core
+for the ssh sessions or on other hosts sharing the queue file:
+
+    wiper -i sample.ini --fleet --queue /shared/wiper_queue.db
+    wiper worker --queue /shared/wiper_queue.db --workers 20
+"""
+
+# Standard Library imports
+from argparse import ArgumentParser
+import os
+import socket
+import sys
+import threading
+import time
+
+# Local imports
+from jobqueue import JOB_QUEUE, LEASE_SECONDS, JobQueue
+
+
+def run_worker(queue, workers, lease=LEASE_SECONDS, exit_when_idle=False, poll=5):
+    """ Provision the APICs of a queue using a bounded pool of worker threads.
+
+    Args:
+        queue (JobQueue): Where the jobs come from.
+        workers (int): The maximum number of APICs provisioned at the same time by this worker.
+        lease (int): How long a lease lasts, leases are renewed three times as often.
+        exit_when_idle (bool): Return once every job of the queue is done, rather than waiting for
+            more jobs.
+        poll (int): How often to check for a job when none can start.
+    """
+    # Imported here so --status does not wait on paramiko
+    from provisioner import provision
+    name = '{0}:{1}'.format(socket.gethostname(), os.getpid())
+    # id -> QueueNode of the jobs running here, their leases are renewed until they are done
+    running = {}
+    running_lock = threading.Lock()
+
+    def heartbeat():
+        while True:
+            time.sleep(lease / 3.0)
+            with running_lock:
+                nodes = running.values()
+            for node in nodes:
+                if not queue.renew(node, lease):
+                    print("{0}The lease on the job was lost, another worker may take it.".format(
+                        node.opts['log_prefix']))
+
+    def work():
+        while True:
+            node = queue.lease(name, lease)
+            if node is None:
+                if exit_when_idle and not queue.pending():
+                    return
+                time.sleep(poll)
+                continue
+            with running_lock:
+                running[node.id] = node
+            error = None
+            try:
+                provision(node.opts, fleet_node=node)
+            # SystemExit is caught too, a single node bailing out should not stop the worker
+            except (Exception, SystemExit), err:
+                error = repr(err)
+                print("{0}Provisioning failed: {1}".format(node.opts['log_prefix'], error))
+            finally:
+                with running_lock:
+                    del running[node.id]
+                node.finished(error)
+
+    thread = threading.Thread(target=heartbeat)
+    thread.daemon = True
+    thread.start()
+    threads = [threading.Thread(target=work) for _ in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    # Join with a timeout so a ctrl-c still reaches the main thread, the leases of the jobs left
+    # running then run out and other workers take them
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(1)
+
+
+def show_status(queue):
+    """ Print the status of every job of a queue.
+
+    Returns:
+        int: The exit status, -1 if any job failed.
+    """
+    counts = {}
+    for cimc, status, worker, attempts, error in queue.jobs():
+        counts[status] = counts.get(status, 0) + 1
+        details = []
+        if status == 'leased':
+            details.append('on {0}'.format(worker))
+        if attempts > 1:
+            details.append('attempt {0}'.format(attempts))
+        if error:
+            details.append(error)
+        print("[{0}] {1}{2}".format(cimc, status,
+                                    ' ({0})'.format(', '.join(details)) if details else ''))
+    print(', '.join('{0} {1}'.format(counts.get(status, 0), status)
+                    for status in ['pending', 'leased', 'done', 'failed']))
+    if counts.get('failed'):
+        return -1
+    return 0
+
+
+def main(argv=None):
+    parser = ArgumentParser('wiper worker', description='Provision the APICs of a job queue ' +
+                                                        'filled by wiper --queue.')
+    parser.add_argument('-Q', '--queue', default=JOB_QUEUE,
+                        help='The job queue file, defaults to {0}'.format(JOB_QUEUE))
+    parser.add_argument('-w', '--workers', type=int, default=10,
+                        help='The maximum number of APICs provisioned at the same time by this ' +
+                             'worker, defaults to 10.')
+    parser.add_argument('-l', '--lease', type=int, default=LEASE_SECONDS,
+                        help='How many seconds a job is held without hearing from this worker ' +
+                             'before another worker may take it, defaults to ' +
+                             '{0}.'.format(LEASE_SECONDS))
+    parser.add_argument('-x', '--exit-when-idle', action='store_true',
+                        help='Exit once every job of the queue is done instead of waiting for ' +
+                             'more jobs.')
+    parser.add_argument('-s', '--status', action='store_true',
+                        help='Show the status of every job of the queue and exit.')
+    args = parser.parse_args(argv)
+    if args.workers < 1:
+        parser.error("at least one worker is needed")
+
+    queue = JobQueue(args.queue)
+    if args.status:
+        return show_status(queue)
+    print("Provisioning the APICs of '{0}' using up to {1} workers.".format(args.queue,
+                                                                            args.workers))
+    try:
+        run_worker(queue, args.workers, lease=args.lease, exit_when_idle=args.exit_when_idle)
+    except KeyboardInterrupt:
+        return -1
+    return show_status(queue)
+
+
+if __name__ == '__main__':
+    sys.exit(main())